@@ -2,6 +2,13 @@ from django import forms
 from django.core import validators
 
 from system.models import PostData
+from grading.scorers import BUILTIN_SCORER_CHOICES
+from grading.validation import DELIMITER_CHOICES, parse_columns, \
+    check_id_column
+from grading.models import Upload
+
+SCORER_CHOICES = (('', 'None, use the scoring script'),) + \
+    BUILTIN_SCORER_CHOICES
 
 
 class PostField(forms.Field):
@@ -66,6 +73,14 @@ class ContestForm(forms.Form):
     scoring_script = forms.FileField(required=False,
         help_text="A script used to score the results.",
         widget=ClearableFileInput())
+    persistent_scoring_script = forms.BooleanField(required=False,
+        help_text="The script defines load and score functions, so the "
+                  "answer is loaded once for many submissions. See hints "
+                  "for contest admins.")
+    builtin_scorer = forms.ChoiceField(required=False,
+        choices=SCORER_CHOICES,
+        help_text="A standard metric used instead of the scoring script. "
+                  "See hints for contest admins.")
     bigger_better = forms.BooleanField(
         label="The bigger the better",
         help_text="Are the bigger scores better (uncheck if smaller scores "
@@ -84,18 +99,82 @@ class ContestForm(forms.Form):
             "leaderboard in the test stage. Avoid changing this value once "
             "the test stage starts — contestants will need to adjust. "
             "<strong>Negative for unlimited selections.</strong>")
+    output_columns = forms.CharField(required=False, max_length=200,
+        help_text="Types of the columns of outputs, e.g. "
+                  "<em>int, float</em> (int, float or str). If set, outputs "
+                  "not in this format are rejected without scoring. "
+                  "The answers must be in the same format. See hints for "
+                  "contest admins.")
+    output_delimiter = forms.ChoiceField(required=False,
+        choices=DELIMITER_CHOICES)
+    output_header = forms.BooleanField(required=False,
+        help_text="The first line of outputs is a header.")
+    output_id_column = forms.IntegerField(required=False, min_value=1,
+        label="Output ID column",
+        help_text="Number of the column with IDs, which must be the same "
+                  "as in the answer, in the same order.")
+
+    def clean_output_columns(self):
+        columns = self.cleaned_data['output_columns'].strip()
+        if columns:
+            try:
+                parse_columns(columns)
+            except ValueError as e:
+                raise forms.ValidationError("Wrong column types: %s." % e)
+        return columns
+
+    def clean(self):
+        cleaned_data = super().clean()
+        columns = cleaned_data.get('output_columns')
+        if columns:
+            try:
+                check_id_column(cleaned_data.get('output_id_column'),
+                    len(parse_columns(columns)))
+            except ValueError as e:
+                self.add_error('output_id_column', "%s." % e)
+        return cleaned_data
 
 
 class SubmitForm(forms.Form):
     stage = forms.ChoiceField(choices=())  # we'll fill choices in __init__
-    output_file = forms.FileField()
-    source_code = forms.FileField(help_text="If your submission consists of "
-        "multiple files, please upload them as a zip archive.")
+    # Big files are sent in chunks before submitting (see upload views),
+    # the form gets just the keys of the uploads.
+    output_file = forms.FileField(required=False)
+    output_upload = forms.UUIDField(required=False,
+        widget=forms.HiddenInput)
+    source_code = forms.FileField(required=False, help_text="If your "
+        "submission consists of multiple files, please upload them as "
+        "a zip archive.")
+    source_upload = forms.UUIDField(required=False,
+        widget=forms.HiddenInput)
     comment = forms.CharField(required=False, help_text="You can add "
         "a comment to your solution, for your convenience only. "
         "For example the version number of your solution.")
 
+    file_fields = [('output_file', 'output_upload'),
+                   ('source_code', 'source_upload')]
+
     def __init__(self, *args, **kwargs):
         stages_available = kwargs.pop('stages_available')
+        # only the user's own uploads can be submitted
+        self.upload_owner = kwargs.pop('upload_owner', None)
+        self.upload_scope = kwargs.pop('upload_scope', "")
         self.base_fields['stage'].choices = stages_available
         super().__init__(*args, **kwargs)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for file_field, upload_field in self.file_fields:
+            key = cleaned_data.get(upload_field)
+            if key is not None:
+                try:
+                    cleaned_data[upload_field] = Upload.objects.get(key=key,
+                        owner=self.upload_owner, scope=self.upload_scope)
+                except Upload.DoesNotExist:
+                    self.add_error(file_field, "The upload has expired, "
+                        "please send the file again.")
+            elif not cleaned_data.get(file_field) and \
+                    file_field not in self.errors:
+                self.add_error(file_field,
+                    self.fields[file_field].error_messages['required'])
+        return cleaned_data
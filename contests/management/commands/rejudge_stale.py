@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from contests.models import Contest, rejudge_contest
+
+
+class Command(BaseCommand):
+    help = 'Rejudges submissions with results from outdated graders ' \
+        '(or errors), in the given contests or in all of them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('contest_codes', nargs='*')
+
+    def handle(self, *args, **options):
+        contests = Contest.objects.all()
+        if options['contest_codes']:
+            contests = contests.filter(code__in=options['contest_codes'])
+            missing = set(options['contest_codes']) - \
+                set(contests.values_list('code', flat=True))
+            if missing:
+                raise CommandError('No such contests: %s' %
+                    ', '.join(sorted(missing)))
+        for contest in contests:
+            count = rejudge_contest(contest, stale_only=True)
+            self.stdout.write('%s: %s submissions marked for rejudging' %
+                (contest.code, count))
@@ -1,3 +1,4 @@
+import hashlib
 from datetime import timedelta
 
 from django.db import models
@@ -8,8 +9,10 @@ from django.conf import settings
 
 from system.models import Post
 
-from grading.models import ScoringScript, DataGrader, Submission, \
-    request_submission_grading, request_qs_grading
+from grading.models import ScoringScript, DataGrader, Submission, Upload, \
+    request_submission_grading, request_qs_grading, PRIORITY_BULK, \
+    stale_submissions, save_content, take_upload, check_output_format
+from grading.wakeup import wait_for_results
 
 
 class Contest(models.Model):
@@ -51,6 +54,8 @@ class ContestFactory(object):
     description = None
     rules = None
     scoring_script = None
+    persistent_scoring_script = None
+    builtin_scorer = None
     bigger_better = None
     verification_begin = None
     verification_end = None
@@ -60,6 +65,10 @@ class ContestFactory(object):
     answer_for_test = None
     published_final_results = None
     selected_limit = None
+    output_columns = None
+    output_delimiter = None
+    output_header = None
+    output_id_column = None
 
     # TODO maybe move out of class. It is a proxy between ContestForm and this.
     @classmethod
@@ -70,6 +79,9 @@ class ContestFactory(object):
         factory.description = data.get('description')
         factory.rules = data.get('rules')
         factory.scoring_script = data.get('scoring_script')
+        factory.persistent_scoring_script = \
+            data.get('persistent_scoring_script')
+        factory.builtin_scorer = data.get('builtin_scorer')
         factory.bigger_better = data.get('bigger_better')
         factory.answer_for_verification = data.get('answer_for_verification')
         factory.verification_begin = data.get('verification_begin')
@@ -79,6 +91,10 @@ class ContestFactory(object):
         factory.test_end = data.get('test_end')
         factory.published_final_results = data.get('published_final_results')
         factory.selected_limit = data.get('selected_limit')
+        factory.output_columns = data.get('output_columns')
+        factory.output_delimiter = data.get('output_delimiter')
+        factory.output_header = data.get('output_header')
+        factory.output_id_column = data.get('output_id_column')
         return factory
 
     @transaction.atomic
@@ -138,6 +154,9 @@ class ContestFactory(object):
             contest.rules.from_data(self.rules)
             contest.rules.save()
         contest.scoring_script.save_source(self.scoring_script)
+        if self.persistent_scoring_script is not None:
+            contest.scoring_script.persistent = self.persistent_scoring_script
+        contest.scoring_script.save()
         if self.verification_begin:
             contest.verification_stage.begin = self.verification_begin
         if self.verification_end:
@@ -153,6 +172,17 @@ class ContestFactory(object):
             contest.bigger_better = self.bigger_better
         if self.selected_limit is not None:
             contest.test_stage.selected_limit = self.selected_limit
+        if self.builtin_scorer is not None:
+            contest.verification_stage.grader.builtin_scorer = \
+                self.builtin_scorer
+            contest.test_stage.grader.builtin_scorer = self.builtin_scorer
+        if self.output_columns is not None:
+            for grader in [contest.verification_stage.grader,
+                           contest.test_stage.grader]:
+                grader.format_columns = self.output_columns
+                grader.format_delimiter = self.output_delimiter or ','
+                grader.format_header = bool(self.output_header)
+                grader.format_id_column = self.output_id_column
         contest.verification_stage.grader.save_answer(
             self.answer_for_verification)
         contest.verification_stage.grader.save()
@@ -331,7 +361,7 @@ class ContestSubmission(models.Model):
 
     def save_source(self, source):
         if source:
-            self.source.save('submission_source', source)
+            save_content(self.source, 'submission_source', source)
         elif source is False:
             self.source.delete()
 
@@ -363,6 +393,7 @@ class ContestSubmissionEvent(models.Model):
 
 
 class SubmissionData(object):
+    # files, or grading.models.Upload instances
     output = None
     source = None
     comment = None
@@ -372,18 +403,46 @@ class StageIsClosed(Exception):
     pass
 
 
+def fair_share_key(contest, team):
+    """
+    Submissions of each team (and technical ones of each contest) get
+    a fair share of the grading queue.
+    """
+    if team is None:
+        return 'contest-%s/technical' % contest.id
+    return 'contest-%s/team-%s' % (contest.id, team.id)
+
+
+def upload_scope(contest):
+    """
+    Scope of the uploads for submissions to the contest, see
+    grading.models.Upload.
+    """
+    return 'contest-%s' % contest.id
+
+
 @transaction.atomic
 def submit(team, stage, submission_data):
     if team and not stage.is_open():
         raise StageIsClosed()
+    check_output_format(stage.grader, submission_data.output)
     cs = ContestSubmission()
     cs.stage = stage
-    submission = Submission.create(stage.grader, submission_data.output)
+    key = fair_share_key(stage.contest, team)
+    if isinstance(submission_data.output, Upload):
+        submission = Submission.create_from_upload(stage.grader,
+            submission_data.output, fair_share_key=key)
+    else:
+        submission = Submission.create(stage.grader, submission_data.output,
+            fair_share_key=key)
     request_submission_grading(submission)
     submission.save()
     cs.submission = submission
     cs.team = team
-    cs.save_source(submission_data.source)
+    if isinstance(submission_data.source, Upload):
+        take_upload(submission_data.source, cs.source)
+    else:
+        cs.save_source(submission_data.source)
     cs.comment = submission_data.comment
     cs.save()
     return cs
@@ -456,14 +515,25 @@ def unselect_submission(submission):
     submission.save()
 
 
+@transaction.atomic
 def rejudge_submission(contest_submission):
     request_submission_grading(contest_submission.submission)
     contest_submission.submission.save()
 
 
-def rejudge_contest(contest):
-    request_qs_grading(Submission.objects.filter(
-        contestsubmission__stage__contest=contest))
+def rejudge_contest(contest, stale_only=False):
+    """
+    Rejudges the submissions in the contest, or only the ones with results
+    from outdated graders (or errors). Returns the number of them.
+    """
+    submissions = Submission.objects.filter(
+        contestsubmission__stage__contest=contest)
+    if stale_only:
+        submissions = stale_submissions(submissions)
+    count = submissions.count()
+    # behind the submissions made in the meantime
+    request_qs_grading(submissions, priority=PRIORITY_BULK)
+    return count
 
 
 def remaining_selections(team, stage):
@@ -656,6 +726,17 @@ class ContestContext(object):
         return is_contest_admin(self.user, self.contest) or \
             (submission.team is not None and submission.team == self.user_team)
 
+    def visible_submissions(self, submissions):
+        """
+        Filters a queryset of contest submissions to those the user can see
+        (see can_see_submission).
+        """
+        if self.is_contest_admin:
+            return submissions
+        if self.user_team is None:
+            return submissions.none()
+        return submissions.filter(team=self.user_team)
+
     def can_see_stage_leaderboard(self, stage):
         return self.is_contest_admin or stage.published_results
 
@@ -679,3 +760,38 @@ class ContestContext(object):
             result.append(attr + ': ' + repr(getattr(self, attr, '?')))
         result.append('>')
         return ''.join(result)
+
+
+def _results_state(results):
+    return hashlib.sha1(repr(sorted(
+        (submission_id, result, submission.submission.score)
+        for submission_id, (submission, result) in results.items()
+    )).encode('utf-8')).hexdigest()
+
+
+def wait_for_submission_results(contest_context, submission_ids, state,
+                                timeout):
+    """
+    Returns the visible results of the contest submissions with the ids
+    which the user can see, as a dict id -> (submission, result), and
+    the state they are in. Waits up to timeout (in seconds) for the state
+    to differ from the given one, which the caller got before.
+    """
+    submissions = contest_context.visible_submissions(
+        ContestSubmission.objects.filter(id__in=submission_ids,
+            stage__contest=contest_context.contest)). \
+        select_related('submission', 'stage')
+    current = None
+
+    def check():
+        nonlocal current
+        results = {
+            submission.id: (submission,
+                contest_context.visible_submission_result(submission))
+            for submission in submissions.all()
+        }
+        current = results, _results_state(results)
+        return current if current[1] != state else None
+    grading_ids = submissions.values_list('submission_id', flat=True)
+    wait_for_results(list(grading_ids), check, timeout)
+    return current
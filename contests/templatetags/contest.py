@@ -4,39 +4,64 @@ from django.utils.safestring import mark_safe
 register = template.Library()
 
 
+RESULT_TEXT = {
+    'waiting': "Waiting for score...",
+    'rejected': "Rejected",
+    'accepted': "Accepted",
+    'error': "Grading Error",
+}
+RESULT_CSS_CLASS = {
+    'score': 'score-result',
+    'waiting': 'waiting-result',
+    'rejected': 'rejected-result',
+    'accepted': 'accepted-result',
+    'error': 'error-result'
+}
+RESULT_HELPTEXT = {
+    'rejected': "There is something wrong with your submission.",
+    'accepted': "Exact score is not available at this point.",
+    'error': "Don't worry. We'll take care of that."
+}
+
+
+def result_text(submission, result):
+    if result == 'score':
+        return mark_safe(
+            "Score: <strong>%s</strong>" % submission.submission.score)
+    return RESULT_TEXT[result]
+
+
+def result_css_class(result):
+    return RESULT_CSS_CLASS.get(result, 'strange-result')
+
+
+@register.simple_tag
+def scoring_msg_title(result, scoring_msg):
+    """
+    Title of the scoring message shown with the result, or '' if it
+    isn't shown.
+    """
+    if result == 'rejected':
+        return "Rejection Reason"
+    if result == 'accepted' and scoring_msg:
+        return "Scoring Comment"
+    return ''
+
+
 @register.inclusion_tag('contests/submission_result.html')
 def submission_result(submission, contest_context, html_tag='div',
                       additional_css_classes="", with_helptext=False):
-    text = {
-        'score': "Score: <strong>%s</strong>" % submission.submission.score,
-        'waiting': "Waiting for score...",
-        'rejected': "Rejected",
-        'accepted': "Accepted",
-        'error': "Grading Error",
-    }
-    css_class = {
-        'score': 'score-result',
-        'waiting': 'waiting-result',
-        'rejected': 'rejected-result',
-        'accepted': 'accepted-result',
-        'error': 'error-result'
-    }
-    helptext = {
-        'rejected': "There is something wrong with your submission.",
-        'accepted': "Exact score is not available at this point.",
-        'error': "Don't worry. We'll take care of that."
-    }
     result = contest_context.visible_submission_result(submission)
-    base_classes = css_class.get(result, 'strange-result')
-    classes = ' '.join(['submission-result', base_classes,
+    classes = ' '.join(['submission-result', result_css_class(result),
         additional_css_classes])
     displayed_helptext = ''
     if with_helptext:
-        displayed_helptext = helptext.get(result)
+        displayed_helptext = RESULT_HELPTEXT.get(result)
     return {
         'html_tag': html_tag,
         'classes': classes,
-        'text': mark_safe(text[result]),
+        'submission_id': submission.id,
+        'text': result_text(submission, result),
         'helptext': displayed_helptext
     }
 
@@ -3,13 +3,19 @@ from django_webtest import WebTest
 from django.utils import timezone
 from django.core.urlresolvers import reverse
 from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from datetime import timedelta
+from io import StringIO
 
 from .models import *
 from .views import ContestContext
+from .forms import ContestForm
 
 from system.tests import new_user
 from grading.tests import script_always_42
+from grading.models import GradingAttempt, DataGrader, grader_version
+from grading.storage import content_chunks, is_compressed
 
 from system.models import PostData
 
@@ -60,8 +66,10 @@ class ContestFactoryTest(TestCase):
         scoring_script = verification.grader.scoring_script
         self.assertEqual(scoring_script.source.read(),
                          b'from __future__ import skynet')
-        self.assertEqual(verification.grader.answer.read(), b'bla')
-        self.assertEqual(test.grader.answer.read(), b'blabla')
+        self.assertEqual(b''.join(content_chunks(verification.grader.answer)),
+            b'bla')
+        self.assertEqual(b''.join(content_chunks(test.grader.answer)),
+            b'blabla')
         self.assertEqual(verification.published_results, True)
         self.assertEqual(test.published_results, False)
         self.assertEqual(verification.requires_selection, False)
@@ -107,6 +115,34 @@ class ContestFactoryTest(TestCase):
         self.assertEqual(contest.description.html, 'test')
         self.assertEqual(contest.rules.html, 'test')
 
+    def test_output_format(self):
+        contest = self.example_contest()
+        ContestFactory.from_dict({
+            'output_columns': 'str, float',
+            'output_delimiter': ';',
+            'output_header': True,
+            'output_id_column': 1,
+        }).update(contest)
+        for stage in [contest.verification_stage, contest.test_stage]:
+            grader = DataGrader.objects.get(id=stage.grader.id)
+            self.assertEqual(grader.format_columns, 'str, float')
+            self.assertEqual(grader.format_delimiter, ';')
+            self.assertTrue(grader.format_header)
+            self.assertEqual(grader.format_id_column, 1)
+        ContestFactory.from_dict({'output_columns': ''}).update(contest)
+        grader = DataGrader.objects.get(id=contest.test_stage.grader.id)
+        self.assertEqual(grader.format_columns, '')
+        self.assertEqual(grader.format_delimiter, ',')
+
+    def test_output_id_column_form(self):
+        data = {'name': 'test', 'code': 'test', 'description': '',
+                'rules': '', 'output_columns': 'str, int',
+                'output_delimiter': ','}
+        self.assertTrue(ContestForm(dict(data, output_id_column=2)).is_valid())
+        form = ContestForm(dict(data, output_id_column=3))
+        self.assertFalse(form.is_valid())
+        self.assertIn('output_id_column', form.errors)
+
 
 class ContestContextTest(TestCase):
     def setUp(self):
@@ -464,8 +500,123 @@ class SubmitTest(WebTest):
         self.assertEqual(cs.stage, self.contest.verification_stage)
         self.assertEqual(cs.team, self.team)
         self.assertEqual(cs.comment, '')
-        self.assertEqual(cs.submission.output.read(), b'output_data')
-        self.assertEqual(cs.source.read(), b'source_data')
+        self.assertTrue(is_compressed(cs.submission.output))
+        self.assertEqual(b''.join(content_chunks(cs.submission.output)),
+            b'output_data')
+        self.assertEqual(b''.join(content_chunks(cs.source)), b'source_data')
+        self.assertEqual(cs.submission.fair_share_key,
+            'contest-%s/team-%s' % (self.contest.id, self.team.id))
+
+    def test_download(self):
+        page = self.app.get(reverse('contests:submit',
+            args=[self.contest.code]), user='user')
+        submit_form = page.forms['submit-form']
+        submit_form['stage'] = str(self.contest.verification_stage.id)
+        submit_form['output_file'] = 'output', b'output_data'
+        submit_form['source_code'] = 'source', b'source_data'
+        submit_form.submit()
+        cs = ContestSubmission.objects.get()
+        for name, data in [('submission_answer', b'output_data'),
+                           ('submission_source', b'source_data')]:
+            response = self.app.get(reverse('contests:' + name,
+                args=[self.contest.code, cs.id]), user='user')
+            self.assertEqual(response.body, data)
+            self.assertNotIn('.gz', response['Content-Disposition'])
+
+    def test_chunked_upload(self):
+        page = self.app.get(reverse('contests:submit',
+            args=[self.contest.code]), user='user')
+        submit_form = page.forms['submit-form']
+        headers = {'X-CSRFToken': submit_form['csrfmiddlewaretoken'].value}
+        url = reverse('contests:upload', args=[self.contest.code])
+        for field, upload_field, data in [
+                ('output_file', 'output_upload', b'output_data'),
+                ('source_code', 'source_upload', b'source_data')]:
+            upload = self.app.post(url, {'field': field}, user='user',
+                headers=headers).json
+            self.assertEqual(upload['offset'], 0)
+            response = self.app.put(upload['url'] + '?offset=0', data,
+                content_type='application/octet-stream', user='user',
+                headers=headers)
+            self.assertEqual(response.json['offset'], len(data))
+            # resuming
+            response = self.app.get(upload['url'], user='user')
+            self.assertEqual(response.json['offset'], len(data))
+            response = self.app.put(upload['url'] + '?offset=0', data,
+                content_type='application/octet-stream', user='user',
+                headers=headers, status=409)
+            self.assertEqual(response.json['offset'], len(data))
+            submit_form[upload_field] = upload['key']
+        submit_form['stage'] = str(self.contest.verification_stage.id)
+        submit_form.submit().follow()
+        cs = ContestSubmission.objects.get()
+        self.assertEqual(b''.join(content_chunks(cs.submission.output)),
+            b'output_data')
+        self.assertEqual(b''.join(content_chunks(cs.source)), b'source_data')
+        self.assertTrue(cs.submission.needs_grading)
+
+    def test_upload_required(self):
+        page = self.app.get(reverse('contests:submit',
+            args=[self.contest.code]), user='user')
+        submit_form = page.forms['submit-form']
+        submit_form['stage'] = str(self.contest.verification_stage.id)
+        submit_form['source_code'] = 'source', b'source_data'
+        page = submit_form.submit()
+        page.mustcontain('This field is required')
+        self.assertFalse(ContestSubmission.objects.exists())
+
+    def test_wrong_output_format(self):
+        ContestFactory.from_dict({
+            'output_columns': 'int',
+            'output_delimiter': ',',
+        }).update(self.contest)
+        page = self.app.get(reverse('contests:submit',
+            args=[self.contest.code]), user='user')
+        submit_form = page.forms['submit-form']
+        submit_form['stage'] = str(self.contest.verification_stage.id)
+        submit_form['output_file'] = 'output', b'x\n'
+        submit_form['source_code'] = 'source', b'source_data'
+        page = submit_form.submit()
+        page.mustcontain('Wrong output format: line 1, column 1: '
+            'expected an integer')
+        self.assertFalse(ContestSubmission.objects.exists())
+        submit_form = page.forms['submit-form']
+        submit_form['output_file'] = 'output', b'1\n'
+        submit_form['source_code'] = 'source', b'source_data'
+        submit_form.submit().follow()
+        self.assertEqual(ContestSubmission.objects.count(), 1)
+
+    def test_upload_permissions(self):
+        client = Client()
+        client.force_login(new_user('outsider'))
+        response = client.post(reverse('contests:upload',
+            args=[self.contest.code]), {'field': 'output_file'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_foreign_upload(self):
+        client = Client()
+        client.force_login(self.user)
+        upload = client.post(reverse('contests:upload',
+            args=[self.contest.code]), {'field': 'output_file'}).json()
+        other = new_user('other')
+        other_team = Team(contest=self.contest, name='Other')
+        other_team.save()
+        join_team(other, other_team)
+        client.force_login(other)
+        self.assertEqual(client.get(upload['url']).status_code, 404)
+        response = client.put(upload['url'] + '?offset=0', b'output_data',
+            content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 404)
+        data = {
+            'stage': self.contest.verification_stage.id,
+            'output_upload': upload['key'],
+            'source_code': ContentFile(b'source_data', name='source'),
+        }
+        response = client.post(reverse('contests:submit',
+            args=[self.contest.code]), data)
+        self.assertContains(response, 'The upload has expired')
+        self.assertFalse(ContestSubmission.objects.exists())
+        self.assertEqual(Upload.objects.get().size, 0)
 
 
 class MySubmissionsTest(WebTest):
@@ -491,6 +642,65 @@ class MySubmissionsTest(WebTest):
         page.mustcontain('My Submissions')
 
 
+class SubmissionResultsTest(WebTest):
+    def setUp(self):
+        standard_base(self)
+        self.team = Team(contest=self.contest, name='Team')
+        self.team.save()
+        join_team(self.user, self.team)
+        self.submission = submit_with_score(self.team,
+            self.contest.verification_stage, None)
+        self.submission.submission.scoring_status = 'waiting'
+        self.submission.submission.save()
+        other_team = Team(contest=self.contest, name='Other Team')
+        other_team.save()
+        self.other = submit_with_score(other_team,
+            self.contest.verification_stage, 42)
+
+    def results(self, user, state=''):
+        params = {
+            'ids': '%s,%s' % (self.submission.id, self.other.id),
+            'state': state,
+        }
+        return self.app.get(reverse('contests:submission_results',
+            args=['contest']), params, user=user).json
+
+    def test_results(self):
+        page = self.app.get(reverse('contests:submission',
+            args=['contest', self.submission.id]), user='user')
+        page.mustcontain('data-submission-id="%s"' % self.submission.id,
+            reverse('contests:submission_results', args=['contest']))
+        results = self.results('user')
+        self.assertEqual(list(results['submissions']),
+            [str(self.submission.id)])
+        self.assertEqual(results['submissions'][str(self.submission.id)],
+            {'result': 'waiting', 'text': 'Waiting for score...',
+             'css_class': 'waiting-result', 'helptext': '',
+             'msg_title': '', 'scoring_msg': ''})
+        unchanged = self.results('user', results['state'])
+        self.assertEqual(unchanged['state'], results['state'])
+
+        self.submission.submission.scoring_status = 'rejected'
+        self.submission.submission.scoring_msg = 'bad output'
+        self.submission.submission.save()
+        changed = self.results('user', results['state'])
+        self.assertNotEqual(changed['state'], results['state'])
+        result = changed['submissions'][str(self.submission.id)]
+        self.assertEqual(result['result'], 'rejected')
+        self.assertEqual(result['msg_title'], 'Rejection Reason')
+        self.assertEqual(result['scoring_msg'], 'bad output')
+
+    def test_results_admin(self):
+        results = self.results('admin')
+        self.assertEqual(len(results['submissions']), 2)
+        self.assertEqual(results['submissions'][str(self.other.id)]['text'],
+            'Score: <strong>42.000000</strong>')
+
+    def test_bad_ids(self):
+        self.app.get(reverse('contests:submission_results', args=['contest']),
+            {'ids': 'x'}, user='user', status=400)
+
+
 def unauthorized_get(app, url, user):
     page = app.get(url, user=user.username)
     page = page.follow()
@@ -532,8 +742,41 @@ class RejudgeTest(WebTest):
         page = self.app.get(reverse('contests:rejudge',
             args=['contest']), user='admin')
         page.mustcontain('Rejudge All Submissions')
+        submission = submit_with_score(None, self.contest.test_stage, 42)
         page = page.forms['rejudge-all'].submit().follow()
         page.mustcontain('All submissions', 'marked for rejudging')
+        submission.submission.refresh_from_db()
+        self.assertTrue(submission.submission.needs_grading)
+        self.assertEqual(submission.submission.grading_priority,
+            PRIORITY_BULK)
+
+    def test_rejudge_stale(self):
+        graded = submit_with_score(None, self.contest.test_stage, 42)
+        attempt = GradingAttempt.objects.create(submission=graded.submission,
+            finished=True, grader_version=grader_version(
+                self.contest.test_stage.grader))
+        graded.submission.current_attempt = attempt
+        graded.submission.save()
+        stale = submit_with_score(None, self.contest.test_stage, 42)
+        page = self.app.get(reverse('contests:rejudge',
+            args=['contest']), user='admin')
+        page = page.forms['rejudge-stale'].submit().follow()
+        page.mustcontain('1 submissions with outdated results')
+        graded.submission.refresh_from_db()
+        stale.submission.refresh_from_db()
+        self.assertFalse(graded.submission.needs_grading)
+        self.assertTrue(stale.submission.needs_grading)
+
+    def test_rejudge_stale_command(self):
+        submission = submit_with_score(None, self.contest.test_stage, 42)
+        out = StringIO()
+        call_command('rejudge_stale', 'contest', stdout=out)
+        self.assertIn('contest: 1 submissions marked for rejudging',
+            out.getvalue())
+        submission.submission.refresh_from_db()
+        self.assertTrue(submission.submission.needs_grading)
+        with self.assertRaises(CommandError):
+            call_command('rejudge_stale', 'nonexistent')
 
     def test_rejudge_user(self):
         unauthorized_get(self.app,
@@ -12,10 +12,17 @@ urlpatterns = [
         name='rules'),
     url(r'^contest/(?P<contests_code>[-\w]+)/submit/$',
         views.Submit.as_view(), name='submit'),
+    url(r'^contest/(?P<contests_code>[-\w]+)/upload/$',
+        views.CreateUpload.as_view(), name='upload'),
+    url(r'^contest/(?P<contests_code>[-\w]+)/'
+        r'upload/(?P<upload_key>[-0-9a-f]+)/$',
+        views.UploadChunk.as_view(), name='upload_chunk'),
     url(r'^contest/(?P<contests_code>[-\w]+)/submissions/$',
         views.Submissions.as_view(), name='submissions'),
     url(r'^contest/(?P<contests_code>[-\w]+)/my_submissions/$',
         views.MySubmissions.as_view(), name='my_submissions'),
+    url(r'^contest/(?P<contests_code>[-\w]+)/submissions/results/$',
+        views.SubmissionResults.as_view(), name='submission_results'),
     url(r'^contest/(?P<contests_code>[-\w]+)/'
         r'submission/(?P<submission_id>[0-9]+)/$',
         views.SubmissionView.as_view(), name='submission'),
@@ -30,6 +37,8 @@ urlpatterns = [
         views.SubmissionRejudgeView.as_view(), name='rejudge'),
     url(r'^contest/(?P<contests_code>[-\w]+)/rejudge/$',
         views.ContestRejudgeView.as_view(), name='rejudge'),
+    url(r'^contest/(?P<contests_code>[-\w]+)/rejudge/stale/$',
+        views.ContestRejudgeStaleView.as_view(), name='rejudge_stale'),
     url(r'^contest/(?P<contests_code>[-\w]+)/setup/$',
         views.ContestUpdate.as_view(), name='setup'),
     url(r'^contest/(?P<contests_code>[-\w]+)/teams/$',
@@ -1,4 +1,5 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse, Http404
 from django.core.urlresolvers import reverse
 from django.views.generic.base import ContextMixin, TemplateView, \
     View
@@ -11,7 +12,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.db import transaction
 from django.contrib import messages
 from django.utils.safestring import mark_safe
-from django_downloadview import BaseDownloadView
+from django_downloadview import BaseDownloadView, VirtualFile
 from django.conf import settings
 
 from allauth.utils import build_absolute_uri
@@ -28,11 +29,17 @@ from .models import Team, TeamMember, TeamInvitation, leave_team, \
 # submission stuff
 from .models import ContestSubmission, SubmissionData, submit, \
     rejudge_submission, SelectionError, select_submission, \
-    unselect_submission, remaining_selections, ContestSubmissionEvent
+    unselect_submission, remaining_selections, ContestSubmissionEvent, \
+    wait_for_submission_results, upload_scope
 
 from .forms import ContestForm, ContestCreateForm, SubmitForm
+from .templatetags.contest import RESULT_HELPTEXT, result_text, \
+    result_css_class, scoring_msg_title
 
-from grading.models import GradingAttempt
+from grading.models import GradingAttempt, Upload, UploadError, \
+    UploadOffsetMismatch, append_upload
+from grading.storage import is_compressed, open_content, content_name
+from grading.validation import InvalidOutput
 from system.models import ClientInfo
 from system.views import PostDataView, add_static_message
 from system.utils import calculate_once
@@ -175,6 +182,10 @@ class ContestUpdate(UserPassesTestMixin, ContestMixin, FormView):
         initial['description'] = contest.description.source
         initial['rules'] = contest.rules.source
         initial['scoring_script'] = contest.scoring_script.source
+        initial['persistent_scoring_script'] = \
+            contest.scoring_script.persistent
+        initial['builtin_scorer'] = contest.verification_stage. \
+            grader.builtin_scorer
         initial['bigger_better'] = contest.bigger_better
         initial['answer_for_verification'] = contest.verification_stage. \
             grader.answer
@@ -187,6 +198,11 @@ class ContestUpdate(UserPassesTestMixin, ContestMixin, FormView):
         initial['published_final_results'] = \
             contest.test_stage.published_results
         initial['selected_limit'] = contest.test_stage.selected_limit
+        grader = contest.verification_stage.grader
+        initial['output_columns'] = grader.format_columns
+        initial['output_delimiter'] = grader.format_delimiter
+        initial['output_header'] = grader.format_header
+        initial['output_id_column'] = grader.format_id_column
         return initial
 
     def get_context_data(self, **kwargs):
@@ -280,6 +296,8 @@ class Submit(UserPassesTestMixin, ContestMixin, FormView):
         kwargs = super().get_form_kwargs()
         choices = self.stage_choices
         kwargs['stages_available'] = choices
+        kwargs['upload_owner'] = self.request.user
+        kwargs['upload_scope'] = upload_scope(self.contest)
         return kwargs
 
     def get_context_data(self, **kwargs):
@@ -287,13 +305,18 @@ class Submit(UserPassesTestMixin, ContestMixin, FormView):
         if not self.stage_choices:
             add_static_message(context, messages.WARNING,
                 "Currently no stage is open for submissions.")
+        context['upload_url'] = reverse('contests:upload',
+            args=[self.contest.code])
+        context['upload_chunk_bytes'] = settings.GRADING_UPLOAD_CHUNK_BYTES
         return context
 
     @transaction.atomic
     def form_valid(self, form):
         data = SubmissionData()
-        data.output = self.request.FILES['output_file']
-        data.source = self.request.FILES['source_code']
+        data.output = form.cleaned_data['output_upload'] or \
+            form.cleaned_data['output_file']
+        data.source = form.cleaned_data['source_upload'] or \
+            form.cleaned_data['source_code']
         data.comment = form.cleaned_data['comment']
         stage = self.get_stage(form)
         # TODO move to model
@@ -308,9 +331,81 @@ class Submit(UserPassesTestMixin, ContestMixin, FormView):
             ContestSubmissionEvent.create(submission, client_info)
         except StageIsClosed:
             raise PermissionDenied()  # TODO be nicer
+        except Upload.DoesNotExist:
+            form.add_error(None, "The upload was already submitted.")
+            return self.form_invalid(form)
+        except InvalidOutput as e:
+            form.add_error('output_file', "Wrong output format: %s." % e)
+            return self.form_invalid(form)
         return super().form_valid(form)
 
 
+UPLOAD_NAMES = {
+    'output_file': 'output',
+    'source_code': 'submission_source',
+}
+
+
+class UploadMixin(UserPassesTestMixin, ContestMixin):
+    """
+    Chunked uploads of the files of the submit form, see
+    grading.models.append_upload. The client creates an upload, sends
+    the chunks with PUT and submits the form with the key of the upload.
+    """
+    raise_exception = True
+
+    def test_func(self):
+        return self.contest_context.can_submit
+
+    def get_upload(self, **kwargs):
+        return get_object_or_404(Upload, owner=self.request.user,
+            scope=upload_scope(self.contest), **kwargs)
+
+    def upload_status(self, upload):
+        return JsonResponse({
+            'key': str(upload.key),
+            'url': reverse('contests:upload_chunk',
+                args=[self.contest.code, upload.key]),
+            'offset': upload.size,
+            'chunk_bytes': settings.GRADING_UPLOAD_CHUNK_BYTES,
+        })
+
+
+class CreateUpload(UploadMixin, View):
+    def post(self, request, *args, **kwargs):
+        name = UPLOAD_NAMES.get(request.POST.get('field'))
+        if name is None:
+            return JsonResponse({'error': 'unknown field'}, status=400)
+        response = self.upload_status(Upload.create(name,
+            owner=request.user, scope=upload_scope(self.contest)))
+        response.status_code = 201
+        return response
+
+
+class UploadChunk(UploadMixin, View):
+    def get(self, request, *args, **kwargs):
+        return self.upload_status(self.get_upload(key=kwargs['upload_key']))
+
+    def put(self, request, *args, **kwargs):
+        try:
+            offset = int(request.GET['offset'])
+            length = int(request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'offset and Content-Length '
+                'are required'}, status=400)
+        try:
+            upload = append_upload(kwargs['upload_key'], offset, request,
+                length, owner=request.user, scope=upload_scope(self.contest))
+        except Upload.DoesNotExist:
+            raise Http404()
+        except UploadOffsetMismatch as e:
+            return JsonResponse({'error': str(e), 'offset': e.offset},
+                status=409)
+        except UploadError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return self.upload_status(upload)
+
+
 class Submissions(UserPassesTestMixin, ContestMixin, ListView):
     context_object_name = 'submissions'
     template_name = "contests/submissions.html"
@@ -346,6 +441,51 @@ class MySubmissions(UserPassesTestMixin, ContestMixin, ListView):
             order_by('-submission__created_at')
 
 
+MAX_RESULTS_IDS = 100
+
+
+def _result_json(submission, result):
+    msg_title = scoring_msg_title(result, submission.submission.scoring_msg)
+    return {
+        'result': result,
+        'text': result_text(submission, result),
+        'css_class': result_css_class(result),
+        'helptext': RESULT_HELPTEXT.get(result, ''),
+        'msg_title': msg_title,
+        'scoring_msg': submission.submission.scoring_msg if msg_title else '',
+    }
+
+
+class SubmissionResults(ContestMixin, View):
+    """
+    Results of the submissions given as `ids`, as JSON, so that pages can
+    show new results without reloading. The response says in what `state`
+    they are. Unless it is other than the `state` the client sends,
+    the request waits up to GRADING_RESULTS_WAIT_SECONDS for a change.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            ids = [int(i) for i in request.GET['ids'].split(',')]
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'ids are required'}, status=400)
+        if len(ids) > MAX_RESULTS_IDS:
+            return JsonResponse({'error': 'too many ids'}, status=400)
+        wait = settings.GRADING_RESULTS_WAIT_SECONDS
+        results, state = wait_for_submission_results(self.contest_context,
+            ids, request.GET.get('state'), wait)
+        # after waiting the client can ask again right away
+        retry_ms = 0 if wait else 1000 * settings.GRADING_RESULTS_POLL_SECONDS
+        return JsonResponse({
+            'state': state,
+            'submissions': {
+                str(submission_id): _result_json(submission, result)
+                for submission_id, (submission, result) in results.items()
+            },
+            'retry_ms': retry_ms,
+        })
+
+
 def ensure_submission_contest_match(submission, contest):
     if submission.stage.contest != contest:
         raise PermissionDenied()
@@ -413,13 +553,20 @@ class SubmissionView(UserPassesTestMixin, SubmissionMixin, TemplateView):
         return context
 
 
+def _download_file(field_file):
+    # compressed files are downloaded decompressed, under the original name
+    if not field_file or not is_compressed(field_file):
+        return field_file
+    return VirtualFile(open_content(field_file), name=content_name(field_file))
+
+
 class DownloadSubmissionAnswer(UserPassesTestMixin, SubmissionMixin,
                                BaseDownloadView):
     def test_func(self):
         return self.contest_context.can_see_submission(self.submission)
 
     def get_file(self):
-        return self.submission.submission.output
+        return _download_file(self.submission.submission.output)
 
 
 class DownloadSubmissionSource(UserPassesTestMixin, SubmissionMixin,
@@ -428,7 +575,7 @@ class DownloadSubmissionSource(UserPassesTestMixin, SubmissionMixin,
         return self.contest_context.can_see_submission(self.submission)
 
     def get_file(self):
-        return self.submission.source
+        return _download_file(self.submission.source)
 
 
 class ContestRejudgeView(UserPassesTestMixin, ContestMixin, TemplateView):
@@ -448,6 +595,17 @@ class ContestRejudgeView(UserPassesTestMixin, ContestMixin, TemplateView):
         return redirect(request.GET.get('next', default=self.contest_url))
 
 
+class ContestRejudgeStaleView(ContestRejudgeView):
+    rejudge_stale_msg = "%s submissions with outdated results in the " \
+        "contest <strong>%s</strong> were marked for rejudging."
+
+    def post(self, request, *args, **kwargs):
+        count = rejudge_contest(self.contest, stale_only=True)
+        messages.add_message(self.request, messages.SUCCESS,
+            mark_safe(self.rejudge_stale_msg % (count, self.contest.name)))
+        return redirect(request.GET.get('next', default=self.contest_url))
+
+
 class SubmissionRejudgeView(UserPassesTestMixin, SubmissionMixin, ContextMixin,
                             View):
     rejudge_single_msg = "Submission <strong>%s</strong> was successfully " \
@@ -141,6 +141,21 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'grading.storage': {
+            'handlers': ['console', 'grading_file'],
+            'level': 'DEBUG',
+            'propagate': True,
+        },
+        'grading.wakeup': {
+            'handlers': ['console', 'grading_overseer_file'],
+            'level': 'DEBUG',
+            'propagate': True,
+        },
+        'grading.workers': {
+            'handlers': ['console', 'grading_overseer_file'],
+            'level': 'DEBUG',
+            'propagate': True,
+        },
         'grading.management.commands.grading_attempt_safe': {
             'handlers': ['console', 'grading_overseer_file'],
             'level': 'DEBUG',
@@ -194,12 +209,95 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_dir')]
 
 ATTEMPT_GRADING_COMMAND = [os.path.join(BASE_DIR, './manage.py'),
                            'grading_attempt']
+SAFE_ATTEMPT_GRADING_COMMAND = [os.path.join(BASE_DIR, './manage.py'),
+                                'grading_attempt_safe']
 RUNNER_PATH = os.path.join(BASE_DIR, 'run_scoring.py')
 
+# Scoring inputs are reflinked rather than copied only if SCORING_TMP is
+# on the same copy-on-write filesystem (e.g. btrfs, XFS) as MEDIA_ROOT
+# and the input cache.
 SCORING_TMP = '/tmp/evolution_scoring'
+# Scoring directories are removed when the attempt is done, unless kept
+# for debugging. The grading daemon removes the ones left by crashes
+# when it starts.
+SCORING_KEEP_WORKSPACES = False
+# Inputs up to SCORING_TMPFS_MAX_INPUT_BYTES in total are scored in this
+# directory instead, e.g. '/dev/shm/evolution_scoring' (they are copied,
+# reflinks can't cross filesystems).
+SCORING_TMPFS_DIR = None
+SCORING_TMPFS_MAX_INPUT_BYTES = 64 * 2**20  # 64 MiB
+# Limit of the size of a file written by a scoring script
+SCORING_MAX_FILE_BYTES = 256 * 2**20  # 256 MiB
+# Limit of the disk space taken by all the files a scoring script writes
+# in its scoring directory, checked every half a second. Files written
+# elsewhere (e.g. in /tmp) are limited only by SCORING_MAX_FILE_BYTES
+# each.
+SCORING_MAX_WORKSPACE_BYTES = 1024 * 2**20  # 1 GiB
+
+# A cgroup v2 directory delegated to the grading user (with no processes
+# in it). If set, each scoring script runs in its own cgroup created there,
+# with memory.max, cpu.max and pids.max set, rather than under RLIMIT_AS.
+SCORING_CGROUP_ROOT = None
+SCORING_CGROUP_CPU_MAX = '100000 100000'  # one CPU
+SCORING_CGROUP_PIDS_MAX = 64
+
+# Node-local copies of answers and scoring scripts,
+# by default in SCORING_TMP/input_cache
+GRADING_INPUT_CACHE_ENABLED = True
+GRADING_INPUT_CACHE_DIR = None
+GRADING_INPUT_CACHE_MAX_BYTES = 10 * 2**30  # 10 GiB
+
+# Warm servers of persistent scoring scripts listen on sockets here,
+# by default in SCORING_TMP/warm
+SCORING_WARM_DIR = None
+SCORING_WARM_MAX_JOBS = 100
+SCORING_WARM_IDLE_SECONDS = 600
+
+# Submission outputs, answers and contest submission sources are stored
+# gzip-compressed. Files stored before stay as they are and are read
+# the same way.
+GRADING_COMPRESS_FILES = True
+GRADING_COMPRESSION_LEVEL = 6
+
+# Big outputs can be uploaded in chunks, see grading.models.append_upload.
+# The chunk size must be a multiple of grading.storage.HASH_BLOCK_SIZE.
+GRADING_UPLOAD_CHUNK_BYTES = 16 * 2**20  # 16 MiB
+GRADING_UPLOAD_MAX_BYTES = 20 * 2**30  # 20 GiB
+# Unfinished uploads are deleted by ./manage.py delete_abandoned_uploads
+GRADING_UPLOAD_EXPIRY_SECONDS = 24 * 3600
+
+# Outputs up to this size are checked against the grader's output format
+# when submitted, bigger ones only before scoring.
+GRADING_VALIDATE_ON_SUBMIT_MAX_BYTES = 64 * 2**20  # 64 MiB
+
+# Reuse the result of an attempt with the same output, answer, scoring
+# script and limits. Turn off for scoring scripts which aren't deterministic.
+GRADING_RESULT_CACHE_ENABLED = True
 
 GRADING_POLL_FOR_JOB_INTERVAL_SECONDS = 1
+# Used when the db is not PostgreSQL: each daemon listens on its own socket
+# in this directory, by default SCORING_TMP/grading_wakeup
+GRADING_WAKEUP_DIR = None
 GRADING_CHECK_STATUS_INTERVAL_SECONDS = 1
+GRADING_WORKER_CHECK_INTERVAL_SECONDS = 0.1
+GRADING_SHUTDOWN_GRACE_SECONDS = 3
+# Then the rest is terminated, and killed if still running after this
+GRADING_SHUTDOWN_KILL_SECONDS = 5
+# How often the daemon exports metrics (with --metrics-file/--metrics-port)
+GRADING_METRICS_INTERVAL_SECONDS = 15
+# Workers (the grading daemon and remote agents) renew the leases of
+# the attempts they grade every GRADING_HEARTBEAT_INTERVAL_SECONDS.
+# Unfinished attempts whose lease expired, because the worker died or lost
+# contact, are requeued. Keep the lease several heartbeats long.
+GRADING_HEARTBEAT_INTERVAL_SECONDS = 10
+GRADING_LEASE_SECONDS = 60
+# Submission pages waiting for score ask for new results every
+# GRADING_RESULTS_POLL_SECONDS. With GRADING_RESULTS_WAIT_SECONDS > 0 each
+# request waits that long for grading to finish and they get the results
+# right away (keep it below the proxy's read timeout). A waiting request
+# occupies a web worker, so do it only with threaded or async workers.
+GRADING_RESULTS_WAIT_SECONDS = 0
+GRADING_RESULTS_POLL_SECONDS = 2
 
 # Downloads
 
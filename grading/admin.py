@@ -1,13 +1,36 @@
 from django.contrib import admin
+from django.db.models import Avg, Count, F, Max
 
-from .models import ScoringScript, DataGrader, Submission, GradingAttempt
+from .models import ScoringScript, DataGrader, Submission, \
+    GradingAttempt, FairShare, GradingAgent
+
+
+def _round(value):
+    if value is None:
+        return None
+    return round(value)
 
 
 @admin.register(Submission)
 class SubmissionAdmin(admin.ModelAdmin):
     list_display = ['id', 'created_at', 'current_attempt', 'needs_grading',
-    'needs_grading_at', 'score', 'scoring_status']
-    list_filter = ['needs_grading', 'scoring_status']
+    'needs_grading_at', 'grading_priority', 'fair_share_key', 'score',
+    'scoring_status']
+    list_filter = ['needs_grading', 'grading_priority', 'scoring_status']
+
+
+@admin.register(FairShare)
+class FairShareAdmin(admin.ModelAdmin):
+    list_display = ['key', 'weight']
+    list_editable = ['weight']
+    search_fields = ['key']
+
+
+@admin.register(GradingAgent)
+class GradingAgentAdmin(admin.ModelAdmin):
+    list_display = ['name', 'enabled', 'created_at', 'last_seen_at']
+    list_editable = ['enabled']
+    readonly_fields = ['token_hash', 'last_seen_at']
 
 
 @admin.register(ScoringScript)
@@ -17,14 +40,48 @@ class ScoringScriptAdmin(admin.ModelAdmin):
 
 @admin.register(DataGrader)
 class DataGraderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'scoring_script', 'time_limit_ms',
-        'memory_limit_bytes']
+    list_display = ['id', 'scoring_script', 'builtin_scorer', 'time_limit_ms',
+        'cpu_time_limit_ms', 'memory_limit_bytes', 'attempts',
+        'avg_wall_time_ms', 'max_wall_time_ms', 'avg_cpu_ms', 'max_rss_bytes']
     search_fields = ['scoring_script__id']
 
+    def get_queryset(self, request):
+        attempts = 'submission__gradingattempt__'
+        return super().get_queryset(request).annotate(
+            attempts=Count(attempts + 'id'),
+            avg_wall_time_ms=Avg(attempts + 'wall_time_ms'),
+            max_wall_time_ms=Max(attempts + 'wall_time_ms'),
+            avg_cpu_ms=Avg(F(attempts + 'cpu_user_ms') +
+                           F(attempts + 'cpu_system_ms')),
+            max_rss_bytes=Max(attempts + 'max_rss_bytes'))
+
+    def attempts(self, grader):
+        return grader.attempts
+    attempts.admin_order_field = 'attempts'
+
+    def avg_wall_time_ms(self, grader):
+        return _round(grader.avg_wall_time_ms)
+    avg_wall_time_ms.admin_order_field = 'avg_wall_time_ms'
+
+    def max_wall_time_ms(self, grader):
+        return grader.max_wall_time_ms
+    max_wall_time_ms.admin_order_field = 'max_wall_time_ms'
+
+    def avg_cpu_ms(self, grader):
+        return _round(grader.avg_cpu_ms)
+    avg_cpu_ms.admin_order_field = 'avg_cpu_ms'
+
+    def max_rss_bytes(self, grader):
+        return grader.max_rss_bytes
+    max_rss_bytes.admin_order_field = 'max_rss_bytes'
+
 
 @admin.register(GradingAttempt)
 class GradingAttemptAdmin(admin.ModelAdmin):
     list_display = ['id', 'created_at', 'finished_at', 'scoring_status',
-        'started', 'finished', 'succeeded', 'aborted']
+        'started', 'finished', 'succeeded', 'aborted', 'worker',
+        'wall_time_ms', 'cpu_user_ms', 'cpu_system_ms', 'max_rss_bytes',
+        'limit_exceeded', 'cache_hit_of']
     list_filter = ['scoring_status', 'started', 'finished', 'succeeded',
-        'aborted']
+        'aborted', 'limit_exceeded']
+    search_fields = ['cache_key']
@@ -0,0 +1,208 @@
+"""
+Grading by remote agents (grading_agent.py), which have no access to
+the db or the media storage. An agent leases an attempt, downloads its
+inputs by content hash, runs run_scoring.py itself and sends the result
+back. While scoring, it renews the lease of the attempt with heartbeats
+(see requeue_expired_leases).
+"""
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils.crypto import get_random_string
+from django.utils import timezone
+
+from .models import GradingAgent, GradingAttempt, choose_batch_for_grading, \
+    grade_from_cache, mark_started, requeue_expired_leases, lease_expiry, \
+    renew_leases, scoring_limits, warm_server_name, grader_answer_hash, \
+    script_source_hash, set_usage, _reject_invalid_outputs, \
+    _apply_scoring_result, _fail_modified_inputs, _finish_aborted, \
+    _set_phase, _finish_grading_timed
+from .storage import stored_content_hash
+
+logger = logging.getLogger(__name__)
+
+AGENT_WORKER_PREFIX = 'agent:'
+
+
+class LeaseLost(Exception):
+    """
+    The attempt is not (or no longer) leased to the agent.
+    """
+    pass
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def create_agent(name):
+    """
+    Returns the new agent and its token, which isn't stored anywhere.
+    """
+    token = get_random_string(64)
+    agent = GradingAgent(name=name, token_hash=_token_hash(token))
+    agent.save()
+    return agent, token
+
+
+def authenticate_agent(token):
+    """
+    Returns the enabled agent with the token, or None.
+    """
+    try:
+        agent = GradingAgent.objects.get(token_hash=_token_hash(token),
+            enabled=True)
+    except GradingAgent.DoesNotExist:
+        return None
+    agent.last_seen_at = timezone.now()
+    agent.save(update_fields=['last_seen_at'])
+    return agent
+
+
+def agent_worker_name(agent):
+    return AGENT_WORKER_PREFIX + agent.name
+
+
+def lease_attempt(agent):
+    """
+    Takes the first submission in the queue with a scoring script (builtin
+    scorers run only on the server) for the agent. Returns the started
+    attempt, leased until its lease_expires_at, or None if nothing waits.
+    Results known from the cache and outputs not in the grader's format
+    are finished right away, without the agent.
+    """
+    requeue_expired_leases()
+    while True:
+        chosen = choose_batch_for_grading([agent_worker_name(agent)],
+            scripts_only=True)
+        if not chosen:
+            return None
+        _, attempt = chosen[0]
+        if not grade_from_cache([attempt]):
+            continue
+        mark_started(attempt)
+        if not _reject_invalid_outputs([attempt]):
+            continue
+        attempt.lease_expires_at = lease_expiry()
+        attempt.save(update_fields=['lease_expires_at'])
+        logger.info('Attempt %s leased to agent %s', attempt.id, agent.name)
+        return attempt
+
+
+def _output_hash(submission):
+    # Outputs submitted before hashing get it on first use.
+    if not submission.output_hash:
+        submission.output_hash = stored_content_hash(submission.output)
+        submission.save(update_fields=['output_hash'])
+    return submission.output_hash
+
+
+def _inputs(attempt):
+    # file name in the scoring directory -> (content hash, field file)
+    submission = attempt.submission
+    grader = submission.grader
+    return {
+        'user_output': (_output_hash(submission), submission.output),
+        'answer': (grader_answer_hash(grader), grader.answer),
+        'scoring_script.py': (script_source_hash(grader.scoring_script),
+            grader.scoring_script.source),
+    }
+
+
+def attempt_job(attempt):
+    """
+    What the agent needs to grade the leased attempt, JSON-serializable.
+    """
+    grader = attempt.submission.grader
+    job = {
+        'attempt': attempt.id,
+        'lease_expires_at': attempt.lease_expires_at.isoformat(),
+        'inputs': {name: content_hash for name, (content_hash, _) in
+                   _inputs(attempt).items()},
+        'config': scoring_limits(grader),
+        'heartbeat_seconds': settings.GRADING_HEARTBEAT_INTERVAL_SECONDS,
+        'persistent': grader.scoring_script.persistent,
+    }
+    if grader.scoring_script.persistent:
+        job['warm_server'] = warm_server_name(grader)
+    return job
+
+
+def _leased_attempt(agent, attempt_id, lock=False):
+    attempts = GradingAttempt.objects.filter(id=attempt_id,
+        worker=agent_worker_name(agent), finished=False)
+    if lock:
+        attempts = attempts.select_for_update()
+    attempt = attempts.first()
+    if attempt is None:
+        raise LeaseLost()
+    return attempt
+
+
+def heartbeat(agent, attempt_id):
+    """
+    Renews the lease of the attempt. Raises LeaseLost if it was lost or
+    the attempt was aborted in the meantime, so the agent should stop.
+    """
+    attempt = _leased_attempt(agent, attempt_id)
+    if not _finish_aborted([attempt]):
+        raise LeaseLost()
+    renew_leases([attempt.id])
+
+
+def attempt_input(agent, attempt_id, content_hash):
+    """
+    Returns the field file of the leased attempt's input with the content
+    hash, or None if it has no such input.
+    """
+    attempt = _leased_attempt(agent, attempt_id)
+    for input_hash, field_file in _inputs(attempt).values():
+        if input_hash == content_hash:
+            return field_file
+    return None
+
+
+@transaction.atomic
+def complete_attempt(agent, attempt_id, result):
+    """
+    Finishes the leased attempt with the result sent by the agent:
+    a dict with exit_code and output of run_scoring.py, usage (as in its
+    usage.json), log of the scoring script, modified_inputs and durations
+    of the prepare and run phases. Raises ValueError if it is malformed.
+    """
+    attempt = _leased_attempt(agent, attempt_id, lock=True)
+    try:
+        exit_code = int(result['exit_code'])
+        output = str(result['output'])
+        log = str(result.get('log', ''))
+        usage = result.get('usage')
+        if usage is not None and not isinstance(usage, dict):
+            raise ValueError('usage is not a dict')
+        prepare_ms = result.get('prepare_ms')
+        run_ms = result.get('run_ms')
+        prepare_ms = None if prepare_ms is None else int(prepare_ms)
+        run_ms = None if run_ms is None else int(run_ms)
+    except (KeyError, TypeError) as e:
+        raise ValueError('bad result: %s' % e)
+    phase_start = time.monotonic()
+    attempt.log.save('scoring_log', ContentFile(log.encode('utf-8')),
+        save=False)
+    GradingAttempt.objects.filter(id=attempt.id).update(log=attempt.log.name)
+    if attempt.aborted:
+        attempt.scoring_status = 'error'
+        attempt.scoring_msg = 'aborted'
+        attempt.succeeded = False
+    elif result.get('modified_inputs'):
+        _fail_modified_inputs(attempt, 'agent %s' % agent.name)
+    else:
+        _apply_scoring_result(attempt, exit_code, output)
+        if usage is not None:
+            set_usage(attempt, usage, usage.get('limit_exceeded'))
+    attempt.prepare_ms = prepare_ms
+    attempt.run_ms = run_ms
+    _set_phase([attempt], 'parse_ms', phase_start)
+    _finish_grading_timed(attempt)
@@ -0,0 +1,275 @@
+"""
+End-to-end benchmark of grading: synthetic graders and submissions are
+queued and graded by a WorkerPool, the same way as by ./manage.py grading,
+and the timings recorded in the attempts are summarized.
+
+It uses the configured db and storage, so it should be run against
+a separate instance, or at least with an empty queue - the pool would take
+real submissions as well. Everything it creates has fair_share_key
+starting with BENCHMARK_KEY_PREFIX and is deleted at the end.
+"""
+import json
+import logging
+import random
+import socket
+import time
+import uuid
+
+from django.core.files.base import ContentFile
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ScoringScript, DataGrader, Submission, GradingAttempt, \
+    FairShare, request_submission_grading, PHASE_FIELDS
+from .workers import WorkerPool, launch_safe_attempt
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_KEY_PREFIX = 'benchmark-'
+
+# Burns `cost_ms` of CPU, then counts equal lines, so the whole output
+# and answer are read.
+SCORING_SCRIPT = """\
+import sys
+import time
+
+end = time.process_time() + {cost_ms} / 1000
+while time.process_time() < end:
+    pass
+with open(sys.argv[1]) as output, open(sys.argv[2]) as answer:
+    score = sum(1 for a, b in zip(output, answer) if a == b)
+print("ACCEPTED")
+print(score)
+"""
+
+PERSISTENT_SCORING_SCRIPT = """\
+import time
+
+answer = None
+
+
+def load(answer_path):
+    global answer
+    with open(answer_path) as answer_file:
+        answer = answer_file.readlines()
+
+
+def score(output_path):
+    end = time.process_time() + {cost_ms} / 1000
+    while time.process_time() < end:
+        pass
+    with open(output_path) as output:
+        score = sum(1 for a, b in zip(output, answer) if a == b)
+    print("ACCEPTED")
+    print(score)
+"""
+
+PHASES = [field[:-len('_ms')] for field in PHASE_FIELDS] + ['finish']
+
+
+class QueueNotEmpty(Exception):
+    pass
+
+
+class BenchmarkTimeout(Exception):
+    pass
+
+
+def _column(rows, seed):
+    rng = random.Random(seed)
+    return ''.join('%s\n' % rng.randint(0, 1) for _ in range(rows))
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(p):
+        # nearest rank
+        return values[max(0, -(-len(values) * p // 100) - 1)]
+
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': values[-1],
+    }
+
+
+def create_graders(count, answer_rows, scorer_cost_ms, builtin_scorer,
+                   persistent):
+    graders = []
+    source = PERSISTENT_SCORING_SCRIPT if persistent else SCORING_SCRIPT
+    for index in range(count):
+        script = ScoringScript.create(ContentFile(
+            source.format(cost_ms=scorer_cost_ms)))
+        script.persistent = persistent
+        script.save()
+        grader = DataGrader.create(script,
+            ContentFile(_column(answer_rows, seed=index)))
+        grader.builtin_scorer = builtin_scorer
+        grader.save()
+        graders.append(grader)
+    return graders
+
+
+def enqueue(graders, count, answer_rows, queues, teams, run_id):
+    """
+    Queues `count` submissions (with different outputs, so that none is
+    graded from the result cache), spread over the graders, and over
+    `queues` * `teams` fair share keys.
+    """
+    submissions = []
+    for index in range(count):
+        key = '%s%s-contest-%s/team-%s' % (BENCHMARK_KEY_PREFIX, run_id,
+            index % queues, index % teams)
+        output = _column(answer_rows, seed='%s-%s' % (run_id, index))
+        # the wakeup is sent at the commit, after the submission is saved
+        with transaction.atomic():
+            submission = Submission.create(graders[index % len(graders)],
+                ContentFile(output), fair_share_key=key)
+            request_submission_grading(submission)
+            submission.save()
+        submissions.append(submission)
+    return submissions
+
+
+def grade_all(pool, submission_ids, timeout_seconds):
+    """
+    Runs the pool until all the submissions are graded.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    waiting = Submission.objects.filter(id__in=submission_ids). \
+        exclude(current_attempt__finished=True)
+    next_heartbeat = 0
+    try:
+        while True:
+            # as the grading daemon does, or long attempts would be
+            # requeued while still running
+            if time.monotonic() >= next_heartbeat:
+                pool.heartbeat()
+                next_heartbeat = time.monotonic() + \
+                    settings.GRADING_HEARTBEAT_INTERVAL_SECONDS
+            pool.reap()
+            pool.fill()
+            pool.export_metrics()
+            if not pool.running and not waiting.exists():
+                return
+            if time.monotonic() > deadline:
+                raise BenchmarkTimeout()
+            time.sleep(settings.GRADING_WORKER_CHECK_INTERVAL_SECONDS)
+    finally:
+        pool.shutdown()
+
+
+def summarize(submission_ids, elapsed_seconds):
+    attempts = GradingAttempt.objects.filter(
+        submission_id__in=submission_ids, finished=True)
+    latency = []
+    dequeue_latency = []
+    overhead = []
+    phases = {phase: [] for phase in PHASES}
+    statuses = {}
+    for attempt in attempts:
+        statuses[attempt.scoring_status] = \
+            statuses.get(attempt.scoring_status, 0) + 1
+        if attempt.queued_at is None or attempt.started_at is None:
+            continue
+        latency.append(
+            (attempt.finished_at - attempt.queued_at).total_seconds())
+        dequeue_latency.append(
+            (attempt.started_at - attempt.queued_at).total_seconds())
+        for phase in PHASES:
+            value = getattr(attempt, phase + '_ms')
+            if value is not None:
+                phases[phase].append(value)
+        if attempt.run_ms is not None:
+            # everything but running the scoring script
+            overhead.append((attempt.finished_at -
+                attempt.started_at).total_seconds() * 1000 - attempt.run_ms)
+    return {
+        'submissions': len(submission_ids),
+        'elapsed_seconds': elapsed_seconds,
+        'throughput_per_minute': len(submission_ids) / elapsed_seconds * 60,
+        'statuses': statuses,
+        'latency_seconds': _percentiles(latency),
+        'dequeue_latency_seconds': _percentiles(dequeue_latency),
+        'phases_ms': {phase: _percentiles(values)
+                      for phase, values in phases.items()},
+        'overhead_ms': _percentiles(overhead),
+    }
+
+
+def delete_benchmark_data():
+    submissions = Submission.objects.filter(
+        fair_share_key__startswith=BENCHMARK_KEY_PREFIX)
+    graders = list(DataGrader.objects.filter(submission__in=submissions).
+        distinct())
+    submissions.update(current_attempt=None)
+    attempts = GradingAttempt.objects.filter(submission__in=submissions)
+    for attempt in attempts:
+        attempt.log.delete(save=False)
+    attempts.delete()
+    for submission in submissions:
+        submission.output.delete(save=False)
+    submissions.delete()
+    for grader in graders:
+        script = grader.scoring_script
+        grader.answer.delete(save=False)
+        grader.delete()
+        script.source.delete(save=False)
+        script.delete()
+    FairShare.objects.filter(key__startswith=BENCHMARK_KEY_PREFIX).delete()
+
+
+def run_benchmark(submissions=100, graders=1, answer_rows=1000,
+                  scorer_cost_ms=0, builtin_scorer='', persistent=False,
+                  queues=1, teams=10, workers=1, batch_size=1,
+                  launch=launch_safe_attempt, timeout_seconds=3600,
+                  keep=False):
+    """
+    Runs the benchmark. Returns the results, with the parameters, as
+    a JSON-serializable dict. Raises QueueNotEmpty if other submissions
+    are waiting for grading.
+    """
+    params = {
+        'submissions': submissions, 'graders': graders,
+        'answer_rows': answer_rows, 'scorer_cost_ms': scorer_cost_ms,
+        'builtin_scorer': builtin_scorer, 'persistent': persistent,
+        'queues': queues, 'teams': teams, 'workers': workers,
+        'batch_size': batch_size, 'launch': launch.__name__,
+    }
+    if Submission.objects.filter(needs_grading=True).exists():
+        raise QueueNotEmpty()
+    run_id = uuid.uuid4().hex[:8]
+    started_at = timezone.now()
+    try:
+        setup_started = time.monotonic()
+        created_graders = create_graders(graders, answer_rows,
+            scorer_cost_ms, builtin_scorer, persistent)
+        queued = enqueue(created_graders, submissions, answer_rows, queues,
+            teams, run_id)
+        setup_seconds = time.monotonic() - setup_started
+        logger.info('Benchmark %s: %s submissions queued in %.1f s', run_id,
+            submissions, setup_seconds)
+        pool = WorkerPool(workers, launch=launch, batch_size=batch_size)
+        grading_started = time.monotonic()
+        submission_ids = [submission.id for submission in queued]
+        grade_all(pool, submission_ids, timeout_seconds)
+        results = summarize(submission_ids,
+            time.monotonic() - grading_started)
+        results['worker_busy_seconds'] = pool.metrics.busy_seconds
+    finally:
+        if not keep:
+            delete_benchmark_data()
+    return dict(results, params=params, run_id=run_id,
+        host=socket.gethostname(), started_at=started_at.isoformat(),
+        setup_seconds=setup_seconds)
+
+
+def save_results(results, path):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from grading.agents import create_agent
+from grading.models import GradingAgent
+
+
+class Command(BaseCommand):
+    help = 'Creates a remote grading agent and prints its token'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name')
+
+    def handle(self, *args, **options):
+        if GradingAgent.objects.filter(name=options['name']).exists():
+            raise CommandError('Agent %s already exists' % options['name'])
+        _, token = create_agent(options['name'])
+        self.stdout.write(token)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from grading.models import delete_abandoned_uploads
+
+
+class Command(BaseCommand):
+    help = 'Deletes chunked uploads which were not continued for ' \
+        'GRADING_UPLOAD_EXPIRY_SECONDS and never submitted'
+
+    def handle(self, *args, **options):
+        count = delete_abandoned_uploads()
+        self.stdout.write('%s abandoned uploads deleted' % count)
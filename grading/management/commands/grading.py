@@ -1,34 +1,54 @@
 import logging
 import signal
-import sys
-import time
-
-from django.conf import settings
 
 from django.core.management.base import BaseCommand
-from django.core.management import call_command
 
-from grading.models import choose_for_grading
+from grading.workers import WorkerPool, launch_safe_attempt, \
+    launch_forked_attempt
+from grading.monitoring import GradingMetrics, MetricsExporter
 
 logger = logging.getLogger(__name__)
 
 
-def exit_on_signal(signum, frame):
-    logger.info('Grading terminated by signal %s', signum)
-    sys.exit(1)
-
-
 class Command(BaseCommand):
     help = 'Runs grading'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of attempts graded at the same time.')
+        parser.add_argument('--fork', action='store_true',
+            help='Grade in processes forked from the daemon, instead of '
+                 'starting grading_attempt_safe for each attempt.')
+        parser.add_argument('--batch-size', type=int, default=1,
+            help='Number of submissions with the same grader scored '
+                 'together, by a single run of the scoring runner.')
+        parser.add_argument('--metrics-file',
+            help='Write metrics in the Prometheus text format to this file.')
+        parser.add_argument('--metrics-port', type=int,
+            help='Serve metrics in the Prometheus text format on this '
+                 'port of localhost.')
+
     def handle(self, *args, **options):
-        signal.signal(signal.SIGINT, exit_on_signal)
-        signal.signal(signal.SIGTERM, exit_on_signal)
-        while True:
-            submission, attempt = choose_for_grading()
-            if submission is None:
-                time.sleep(settings.GRADING_POLL_FOR_JOB_INTERVAL_SECONDS)
-            else:
-                logger.info('Grading submission %s, attempt %s', submission.id,
-                    attempt.id)
-                call_command('grading_attempt_safe', str(attempt.id))
+        launch = launch_safe_attempt
+        if options['fork']:
+            launch = launch_forked_attempt
+        metrics = GradingMetrics()
+        exporter = None
+        if options['metrics_file'] or options['metrics_port'] is not None:
+            exporter = MetricsExporter(metrics, path=options['metrics_file'],
+                port=options['metrics_port'])
+        pool = WorkerPool(options['workers'], launch=launch,
+            batch_size=options['batch_size'], metrics=metrics,
+            exporter=exporter)
+
+        def stop_on_signal(signum, frame):
+            logger.info('Grading terminated by signal %s', signum)
+            pool.stop()
+
+        signal.signal(signal.SIGINT, stop_on_signal)
+        signal.signal(signal.SIGTERM, stop_on_signal)
+        try:
+            pool.run()
+        finally:
+            if exporter is not None:
+                exporter.close()
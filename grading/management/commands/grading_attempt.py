@@ -5,7 +5,8 @@ import os
 
 from django.core.management.base import BaseCommand, CommandError
 
-from grading.models import GradingAttempt, attempt_grading
+from grading.models import GradingAttempt, attempt_grading, \
+    attempt_batch_grading
 
 prctl_enabled = False
 if os.getenv('prctl_disabled', None) != "1":
@@ -22,19 +23,25 @@ def exit_on_signal(signum, frame):
 
 
 class Command(BaseCommand):
-    help = 'Grades single attempt (internal)'
+    help = 'Grades single attempt, or a batch of attempts with the same ' \
+        'grader (internal)'
 
     def add_arguments(self, parser):
-        parser.add_argument('attempt_id', type=int)
+        parser.add_argument('attempt_ids', type=int, nargs='+')
 
     def handle(self, *args, **options):
         signal.signal(signal.SIGINT, exit_on_signal)
         signal.signal(signal.SIGTERM, exit_on_signal)
-        attempt_id = options['attempt_id']
-        logger.debug('grading_attempt command with attempt %s', attempt_id)
-        try:
-            attempt = GradingAttempt.objects.get(id=attempt_id)
-        except GradingAttempt.DoesNotExist:
-            raise CommandError("GradingAttempt %s does not exist" %
+        attempts = []
+        for attempt_id in options['attempt_ids']:
+            logger.debug('grading_attempt command with attempt %s',
                 attempt_id)
-        attempt_grading(attempt)
+            try:
+                attempts.append(GradingAttempt.objects.get(id=attempt_id))
+            except GradingAttempt.DoesNotExist:
+                raise CommandError("GradingAttempt %s does not exist" %
+                    attempt_id)
+        if len(attempts) == 1:
+            attempt_grading(attempts[0])
+        else:
+            attempt_batch_grading(attempts)
@@ -0,0 +1,65 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from grading.benchmark import run_benchmark, save_results, QueueNotEmpty, \
+    BenchmarkTimeout
+from grading.scorers import SCORERS
+from grading.workers import launch_safe_attempt, launch_forked_attempt
+
+
+class Command(BaseCommand):
+    help = 'Measures the throughput of grading with synthetic submissions ' \
+        '(needs an empty queue, see grading/benchmark.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=100)
+        parser.add_argument('--graders', type=int, default=1)
+        parser.add_argument('--answer-rows', type=int, default=1000,
+            help='Lines of the answer and of each output.')
+        parser.add_argument('--scorer-cost-ms', type=int, default=0,
+            help='CPU time the scoring script burns for each submission.')
+        parser.add_argument('--builtin-scorer', choices=sorted(SCORERS),
+            default='')
+        parser.add_argument('--persistent', action='store_true',
+            help='Use a persistent scoring script.')
+        parser.add_argument('--queues', type=int, default=1,
+            help='Number of synthetic contests.')
+        parser.add_argument('--teams', type=int, default=10)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=1)
+        parser.add_argument('--fork', action='store_true')
+        parser.add_argument('--timeout', type=int, default=3600,
+            help='Seconds to wait for the grading.')
+        parser.add_argument('--keep', action='store_true',
+            help="Don't delete the created graders and submissions.")
+        parser.add_argument('--output',
+            help='Save the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        launch = launch_safe_attempt
+        if options['fork']:
+            launch = launch_forked_attempt
+        try:
+            results = run_benchmark(
+                submissions=options['submissions'],
+                graders=options['graders'],
+                answer_rows=options['answer_rows'],
+                scorer_cost_ms=options['scorer_cost_ms'],
+                builtin_scorer=options['builtin_scorer'],
+                persistent=options['persistent'],
+                queues=options['queues'],
+                teams=options['teams'],
+                workers=options['workers'],
+                batch_size=options['batch_size'],
+                launch=launch,
+                timeout_seconds=options['timeout'],
+                keep=options['keep'])
+        except QueueNotEmpty:
+            raise CommandError('Other submissions are waiting for grading.')
+        except BenchmarkTimeout:
+            raise CommandError('Grading did not finish in %s seconds.' %
+                options['timeout'])
+        if options['output']:
+            save_results(results, options['output'])
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
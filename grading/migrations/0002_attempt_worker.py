@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
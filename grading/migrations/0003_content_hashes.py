@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0002_attempt_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datagrader',
+            name='answer_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='scoringscript',
+            name='source_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0003_content_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scoringscript',
+            name='persistent',
+            field=models.BooleanField(default=False),
+        ),
+    ]
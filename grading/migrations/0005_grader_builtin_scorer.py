@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0004_scoring_script_persistent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datagrader',
+            name='builtin_scorer',
+            field=models.CharField(blank=True, choices=[('rmse', 'Root mean squared error'), ('mae', 'Mean absolute error'), ('logloss', 'Log loss (binary)'), ('accuracy', 'Accuracy'), ('roc_auc', 'ROC AUC (binary)'), ('f1', 'F1 score (binary)')], default='', max_length=20),
+        ),
+    ]
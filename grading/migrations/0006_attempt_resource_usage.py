@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0005_grader_builtin_scorer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='cpu_system_ms',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='cpu_user_ms',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='io_read_blocks',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='io_write_blocks',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='max_rss_bytes',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='wall_time_ms',
+            field=models.IntegerField(null=True),
+        ),
+    ]
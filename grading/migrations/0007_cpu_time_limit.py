@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0006_attempt_resource_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datagrader',
+            name='cpu_time_limit_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='limit_exceeded',
+            field=models.CharField(blank=True, choices=[('time', 'Time limit'), ('cpu_time', 'CPU time limit'), ('memory', 'Memory limit')], default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0007_cpu_time_limit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FairShare',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('weight', models.FloatField(default=1)),
+                ('last_tag', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='fair_share_key',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='fair_share_tag',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='grading_priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='submission',
+            index_together=set([('needs_grading', 'grading_priority', 'fair_share_tag', 'needs_grading_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0008_fair_share_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='cache_hit_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='grading.GradingAttempt'),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='output_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0009_result_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='grader_version',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
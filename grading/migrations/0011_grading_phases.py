@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0010_attempt_grader_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='finish_ms',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='parse_ms',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='prepare_ms',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='queued_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='gradingattempt',
+            name='run_ms',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 17:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import grading.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0012_uploads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datagrader',
+            name='format_columns',
+            field=models.CharField(blank=True, default='', max_length=200, validators=[grading.models.validate_format_columns]),
+        ),
+        migrations.AddField(
+            model_name='datagrader',
+            name='format_delimiter',
+            field=models.CharField(choices=[(',', 'Comma'), (';', 'Semicolon'), ('\t', 'Tab'), (' ', 'Space')], default=',', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='datagrader',
+            name='format_header',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='datagrader',
+            name='format_id_column',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datagrader',
+            name='format_rows',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
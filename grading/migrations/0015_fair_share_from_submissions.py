@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 18:21
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0014_grading_agents'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='fairshare',
+            name='last_tag',
+        ),
+        migrations.AlterIndexTogether(
+            name='submission',
+            index_together=set([('fair_share_key', 'grading_priority', 'fair_share_tag'), ('needs_grading', 'grading_priority', 'fair_share_tag', 'needs_grading_at', 'id')]),
+        ),
+    ]
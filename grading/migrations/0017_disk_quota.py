@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 18:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grading', '0016_upload_owner'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='gradingattempt',
+            name='limit_exceeded',
+            field=models.CharField(blank=True, choices=[('time', 'Time limit'), ('cpu_time', 'CPU time limit'), ('memory', 'Memory limit'), ('disk', 'Disk quota')], default='', max_length=20),
+        ),
+    ]
@@ -1,23 +1,67 @@
 import shutil
+import hashlib
 import os
-import tempfile
+import fcntl
 import json
 import subprocess
 import logging
 import itertools
+import resource
+import time
+import uuid
+from datetime import timedelta
 from decimal import Decimal, InvalidOperation
 
-from django.db import models, transaction
+from django.db import models, transaction, connection
+from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
+from django.db.models import Case, When, Value, Max
 from django.db.models.functions import Now
 from django.conf import settings
 from django.utils import timezone
 
+from .wakeup import notify_grading_requested, notify_grading_finished
+from .storage import content_hash, content_hasher, InputCache, \
+    create_workspace, remove_workspace, sweep_workspaces, compress, \
+    is_compressed, open_content, write_content, content_size, \
+    stored_content_hash, append_chunk, combined_hash, IncompleteChunk, \
+    byte_chunks, content_chunks, COMPRESSED_SUFFIX, HASH_BLOCK_SIZE
+from . import scorers
+from . import validation
+
 logger = logging.getLogger(__name__)
 
 
+def validate_format_columns(value):
+    if value:
+        try:
+            validation.parse_columns(value)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+
+def save_content(field_file, name, content, save=True):
+    """
+    Like field_file.save, but compressed unless GRADING_COMPRESS_FILES is
+    off. Returns a ContentHasher of the content.
+    """
+    if not settings.GRADING_COMPRESS_FILES:
+        field_file.save(name, content, save=save)
+        return content_hasher(content)
+    compressed, hasher = compress(content,
+        settings.GRADING_COMPRESSION_LEVEL)
+    try:
+        field_file.save(name + COMPRESSED_SUFFIX, compressed, save=save)
+    finally:
+        compressed.close()
+    return hasher
+
+
 class ScoringScript(models.Model):
     source = models.FileField(null=True, blank=True)
+    source_hash = models.CharField(max_length=64, blank=True, default="")
+    # defines load(answer_path) and score(output_path), see run_scoring.py
+    persistent = models.BooleanField(default=False)
 
     @classmethod
     def create(cls, source):
@@ -27,8 +71,10 @@ class ScoringScript(models.Model):
 
     def save_source(self, source):
         if source:
+            self.source_hash = content_hash(source)
             self.source.save('script.py', source)
         elif source is False:
+            self.source_hash = ""
             self.source.delete()
 
     def __str__(self):
@@ -43,23 +89,57 @@ class DataGrader(models.Model):
     scoring_script = models.ForeignKey('ScoringScript',
         on_delete=models.PROTECT)
     answer = models.FileField(null=True, blank=True)
+    answer_hash = models.CharField(max_length=64, blank=True, default="")
     time_limit_ms = models.IntegerField(default=DEFAULT_TIME_LIMIT)
+    # if not set, the same as time_limit_ms
+    cpu_time_limit_ms = models.IntegerField(null=True, blank=True)
     memory_limit_bytes = models.IntegerField(default=DEFAULT_MEMORY_LIMIT)
+    # if set, used instead of the scoring script
+    builtin_scorer = models.CharField(max_length=20, blank=True, default="",
+        choices=scorers.BUILTIN_SCORER_CHOICES)
+    # Format of outputs, checked before scoring, see validation.py.
+    # Types of the columns, e.g. "str, float", or empty for no checks.
+    format_columns = models.CharField(max_length=200, blank=True,
+        default="", validators=[validate_format_columns])
+    format_delimiter = models.CharField(max_length=1, default=",",
+        choices=validation.DELIMITER_CHOICES)
+    format_header = models.BooleanField(default=False)
+    format_id_column = models.PositiveSmallIntegerField(null=True,
+        blank=True)
+    # if not set, the same as in the answer
+    format_rows = models.PositiveIntegerField(null=True, blank=True)
 
     @classmethod
     def create(cls, scoring_script, answer, time_limit_ms=DEFAULT_TIME_LIMIT,
-               memory_limit_bytes=DEFAULT_MEMORY_LIMIT):
+               memory_limit_bytes=DEFAULT_MEMORY_LIMIT,
+               cpu_time_limit_ms=None):
         grader = cls()
         grader.scoring_script = scoring_script
         grader.time_limit_ms = time_limit_ms
+        grader.cpu_time_limit_ms = cpu_time_limit_ms
         grader.memory_limit_bytes = memory_limit_bytes
         grader.save_answer(answer)
         return grader
 
+    def clean(self):
+        if not self.format_columns:
+            return
+        try:
+            columns = validation.parse_columns(self.format_columns)
+        except ValueError:
+            return  # reported by validate_format_columns
+        try:
+            validation.check_id_column(self.format_id_column, len(columns))
+        except ValueError as e:
+            raise ValidationError({'format_id_column': str(e)})
+
     def save_answer(self, answer):
         if answer:
-            self.answer.save('grader_answer', answer)
+            self.answer_hash = save_content(self.answer, 'grader_answer',
+                answer, save=False).hexdigest()
+            self.save()
         elif answer is False:
+            self.answer_hash = ""
             self.answer.delete()
 
     def __str__(self):
@@ -81,6 +161,14 @@ def score_field():
     return models.DecimalField(max_digits=30, decimal_places=6, null=True)
 
 
+LIMIT_EXCEEDED_CHOICES = (
+    ('time', 'Time limit'),
+    ('cpu_time', 'CPU time limit'),
+    ('memory', 'Memory limit'),
+    ('disk', 'Disk quota'),
+)
+
+
 SCORING_STATUS_CHOICES = (
     ('waiting', 'Waiting for score'),
     ('error', 'Grading Error'),
@@ -89,24 +177,59 @@ SCORING_STATUS_CHOICES = (
 )
 
 
+# Lower priorities are graded first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# The order in which waiting submissions are graded
+QUEUE_ORDER = ['grading_priority', 'fair_share_tag', 'needs_grading_at',
+               'id']
+
+
 class Submission(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     grader = models.ForeignKey('DataGrader')
     output = models.FileField(null=True)
+    output_hash = models.CharField(max_length=64, blank=True, default="")
+    # of the original content, unknown for outputs stored before
+    output_size = models.BigIntegerField(null=True, blank=True)
     current_attempt = models.ForeignKey('GradingAttempt',
         on_delete=models.PROTECT, blank=True, null=True, related_name='+')
     needs_grading = models.BooleanField(default=False)
     needs_grading_at = models.DateTimeField(null=True)
+    grading_priority = models.SmallIntegerField(default=PRIORITY_INTERACTIVE)
+    # Who the submission is graded for, see FairShare
+    fair_share_key = models.CharField(max_length=100, blank=True, default="")
+    fair_share_tag = models.FloatField(default=0)
     score = score_field()
     scoring_status = models.CharField(max_length=20, default='waiting',
         choices=SCORING_STATUS_CHOICES)
     scoring_msg = models.TextField(blank=True, default="")
 
+    class Meta:
+        index_together = [
+            # the queue, see _lock_for_grading
+            ['needs_grading'] + QUEUE_ORDER,
+            # the last tags of keys, see _fair_share_tags
+            ['fair_share_key', 'grading_priority', 'fair_share_tag'],
+        ]
+
     @classmethod
-    def create(cls, grader, output):
-        submission = cls(grader=grader)
+    def create(cls, grader, output, fair_share_key=""):
+        submission = cls(grader=grader, fair_share_key=fair_share_key)
         if output:
-            submission.output.save('output', output)
+            hasher = save_content(submission.output, 'output', output,
+                save=False)
+            submission.output_hash = hasher.hexdigest()
+            submission.output_size = hasher.size
+        submission.save()
+        return submission
+
+    @classmethod
+    def create_from_upload(cls, grader, upload, fair_share_key=""):
+        submission = cls(grader=grader, fair_share_key=fair_share_key)
+        submission.output_hash, submission.output_size = \
+            take_upload(upload, submission.output)
         submission.save()
         return submission
 
@@ -114,6 +237,131 @@ class Submission(models.Model):
         return '<Submission %s>' % self.id
 
 
+class Upload(models.Model):
+    """
+    A file uploaded in chunks (see append_upload), written straight to
+    its place in storage, to be taken over by a file field of another
+    model (see take_upload).
+    """
+    key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    # Only the owner can continue and take the upload, and only in its
+    # scope (e.g. a contest), as knowing the key is not enough.
+    owner = models.ForeignKey('auth.User', null=True, related_name='+')
+    scope = models.CharField(max_length=100, blank=True, default="")
+    file = models.FileField()
+    # of the original content
+    size = models.BigIntegerField(default=0)
+    # of the file, which may be compressed
+    stored_size = models.BigIntegerField(default=0)
+    # sha256 digests of the HASH_BLOCK_SIZE blocks of the content so far,
+    # the content hash is built from them, see ContentHasher
+    block_digests = models.BinaryField(default=b'')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def create(cls, name, owner=None, scope=""):
+        upload = cls(owner=owner, scope=scope)
+        if settings.GRADING_COMPRESS_FILES:
+            name += COMPRESSED_SUFFIX
+        upload.file.save(name, ContentFile(b''))
+        return upload
+
+    def is_sealed(self):
+        # ended with a partial block, so nothing can be appended
+        return self.size % HASH_BLOCK_SIZE != 0
+
+    def content_hash(self):
+        digests = bytes(self.block_digests)
+        return combined_hash([digests[i:i + 32]
+                              for i in range(0, len(digests), 32)])
+
+    def __str__(self):
+        return '<Upload %s>' % self.key
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadOffsetMismatch(UploadError):
+    def __init__(self, offset):
+        super().__init__('the upload continues at offset %s' % offset)
+        self.offset = offset
+
+
+@transaction.atomic
+def append_upload(key, offset, stream, length, owner=None, scope=""):
+    """
+    Appends a chunk of `length` bytes, read from stream, to the upload with
+    the given key, owner and scope, at offset, which must be the current
+    size of the upload (resuming an interrupted upload, the client asks for
+    it). All chunks but the last one must be multiples of HASH_BLOCK_SIZE.
+
+    Raises Upload.DoesNotExist, or UploadError if the chunk is not
+    accepted.
+    """
+    upload = Upload.objects.select_for_update().get(key=key, owner=owner,
+        scope=scope)
+    if offset != upload.size:
+        raise UploadOffsetMismatch(upload.size)
+    if upload.is_sealed():
+        raise UploadError('the upload ended with a chunk which is not '
+            'a multiple of %s bytes' % HASH_BLOCK_SIZE)
+    if not 0 < length <= settings.GRADING_UPLOAD_CHUNK_BYTES:
+        raise UploadError('chunks must have between 1 and %s bytes' %
+            settings.GRADING_UPLOAD_CHUNK_BYTES)
+    if upload.size + length > settings.GRADING_UPLOAD_MAX_BYTES:
+        raise UploadError('uploads must not exceed %s bytes' %
+            settings.GRADING_UPLOAD_MAX_BYTES)
+    compression_level = None
+    if is_compressed(upload.file):
+        compression_level = settings.GRADING_COMPRESSION_LEVEL
+    try:
+        hasher, upload.stored_size = append_chunk(_file_path(upload.file),
+            upload.stored_size, stream, length, compression_level)
+    except IncompleteChunk:
+        raise UploadError('the chunk is shorter than declared')
+    upload.size += length
+    upload.block_digests = bytes(upload.block_digests) + \
+        b''.join(hasher.block_digests())
+    upload.save()
+    return upload
+
+
+def take_upload(upload, field_file):
+    """
+    Makes the uploaded file the file of field_file, without copying it.
+    The upload is deleted. Returns the content hash and size.
+    The field_file's instance must be saved in the same transaction.
+    """
+    upload = Upload.objects.select_for_update().get(id=upload.id)
+    field_file.name = upload.file.name
+    upload.delete()
+    return upload.content_hash(), upload.size
+
+
+def delete_abandoned_uploads():
+    """
+    Deletes the uploads (with their files) which weren't taken and
+    weren't continued for GRADING_UPLOAD_EXPIRY_SECONDS. Returns
+    the number of them.
+    """
+    deleted = 0
+    expired = Upload.objects.filter(updated_at__lt=timezone.now() -
+        timedelta(seconds=settings.GRADING_UPLOAD_EXPIRY_SECONDS))
+    for upload in expired:
+        with transaction.atomic():
+            try:
+                upload = Upload.objects.select_for_update().get(id=upload.id)
+            except Upload.DoesNotExist:
+                continue  # taken meanwhile
+            upload.file.delete(save=False)
+            upload.delete()
+            deleted += 1
+    return deleted
+
+
 class GradingAttempt(models.Model):
     submission = models.ForeignKey('Submission', on_delete=models.PROTECT)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -123,6 +371,40 @@ class GradingAttempt(models.Model):
     succeeded = models.BooleanField(default=False)
     aborted = models.BooleanField(default=False)
     log = models.FileField()
+    worker = models.CharField(max_length=100, blank=True, default="")
+    # needs_grading_at of the submission when the attempt was created
+    queued_at = models.DateTimeField(null=True)
+    started_at = models.DateTimeField(null=True)
+
+    # Durations of the grading phases. For a batch, an even share of it.
+    prepare_ms = models.IntegerField(null=True)
+    run_ms = models.IntegerField(null=True)
+    parse_ms = models.IntegerField(null=True)
+    finish_ms = models.IntegerField(null=True)
+
+    # Resources used by the scoring script, as reported by run_scoring.py
+    wall_time_ms = models.IntegerField(null=True)
+    cpu_user_ms = models.IntegerField(null=True)
+    cpu_system_ms = models.IntegerField(null=True)
+    max_rss_bytes = models.BigIntegerField(null=True)
+    io_read_blocks = models.BigIntegerField(null=True)
+    io_write_blocks = models.BigIntegerField(null=True)
+    limit_exceeded = models.CharField(max_length=20, blank=True, default="",
+        choices=LIMIT_EXCEEDED_CHOICES)
+
+    # Same for all attempts which must give the same result,
+    # see result_cache_key
+    cache_key = models.CharField(max_length=64, blank=True, default="",
+        db_index=True)
+    # grader_version of the grader when the attempt started
+    grader_version = models.CharField(max_length=64, blank=True, default="")
+    # The attempt the result was copied from, instead of scoring
+    cache_hit_of = models.ForeignKey('self', on_delete=models.SET_NULL,
+        null=True, blank=True, related_name='+')
+    # Extended by heartbeats of the worker grading the attempt. Unfinished
+    # attempts are requeued after it, see requeue_expired_leases.
+    lease_expires_at = models.DateTimeField(null=True, blank=True,
+        db_index=True)
 
     score = score_field()
     scoring_status = models.CharField(max_length=20, default='waiting',
@@ -133,28 +415,258 @@ class GradingAttempt(models.Model):
         return '<GradingAttempt %s>' % self.id
 
 
-def request_submission_grading(submission):
+class GradingAgent(models.Model):
+    """
+    A machine grading remotely, over HTTP (see agents.py).
+    """
+    name = models.CharField(max_length=50, unique=True)
+    # sha256 of the token, which is shown only when the agent is created
+    token_hash = models.CharField(max_length=64, unique=True)
+    enabled = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_seen_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+def stale_submissions(submissions):
+    """
+    The submissions whose result doesn't come from the current version of
+    their grader (or is an error), not counting the ones waiting for grading.
+    """
+    up_to_date = models.Q(pk__in=[])
+    graders = DataGrader.objects.filter(
+        id__in=submissions.values('grader_id'))
+    for grader in graders:
+        up_to_date |= models.Q(grader=grader,
+            current_attempt__grader_version=grader_version(grader))
+    return submissions.filter(needs_grading=False). \
+        filter(~up_to_date | models.Q(scoring_status='error'))
+
+
+class FairShare(models.Model):
+    """
+    Share of the grading queue of the submissions with the same
+    fair_share_key (e.g. of a team). Within a priority the queue is served
+    by start-time fair queueing: every submission gets a tag, the virtual
+    time it should start at, and the lowest tags are graded first. Each
+    submission of a key gets the tag after the key's last one at its
+    priority, 1 / weight later, so when many keys have submissions waiting,
+    they are graded in turns, proportionally to the weights.
+
+    The clock of a priority is the highest tag taken from its queue. Keys
+    which weren't waiting start from it, so being idle doesn't let them
+    jump ahead of everyone later. Submissions without a key start from it
+    too. The tags are read from the submissions, so taking jobs from
+    the queue doesn't write anything shared by all the daemons.
+
+    Keys without a FairShare have weight 1.
+    """
+    key = models.CharField(max_length=100, unique=True)
+    weight = models.FloatField(default=1)
+
+    def __str__(self):
+        return '<FairShare %s>' % self.key
+
+
+def _fair_share_tags(key, priority, count):
+    """
+    Returns tags for `count` new submissions of the key with the priority.
+    """
+    queued = Submission.objects.filter(grading_priority=priority,
+        needs_grading_at__isnull=False)
+    clock = queued.filter(needs_grading=False). \
+        aggregate(tag=Max('fair_share_tag'))['tag'] or 0
+    if not key:
+        return [clock] * count
+    weight = FairShare.objects.filter(key=key). \
+        values_list('weight', flat=True).first() or 1
+    last_tag = queued.filter(fair_share_key=key). \
+        aggregate(tag=Max('fair_share_tag'))['tag']
+    start = clock
+    if last_tag is not None:
+        start = max(clock, last_tag + 1 / weight)
+    return [start + i / weight for i in range(count)]
+
+
+@transaction.atomic
+def request_submission_grading(submission, priority=PRIORITY_INTERACTIVE):
+    """
+    Puts the submission in the queue. It still has to be saved, in the same
+    transaction - daemons are woken up when it commits.
+    """
     submission.needs_grading = True
     submission.needs_grading_at = Now()
+    submission.grading_priority = priority
+    submission.fair_share_tag = \
+        _fair_share_tags(submission.fair_share_key, priority, 1)[0]
+    notify_grading_requested()
+
+
+TAG_UPDATE_CHUNK_SIZE = 500
+
+
+@transaction.atomic
+def request_qs_grading(submissions, priority=None):
+    """
+    Puts the submissions in the queue, with the given priority or,
+    if it is None, the one they had before.
+    """
+    ids_by_share = {}
+    for submission_id, key, current_priority in submissions.order_by('id'). \
+            values_list('id', 'fair_share_key', 'grading_priority'):
+        share = key, current_priority if priority is None else priority
+        ids_by_share.setdefault(share, []).append(submission_id)
+    tags = []
+    for (key, share_priority), ids in ids_by_share.items():
+        tags += zip(ids, _fair_share_tags(key, share_priority, len(ids)))
+    for start in range(0, len(tags), TAG_UPDATE_CHUNK_SIZE):
+        chunk = tags[start:start + TAG_UPDATE_CHUNK_SIZE]
+        Submission.objects.filter(id__in=[pk for pk, _ in chunk]).update(
+            fair_share_tag=Case(
+                *[When(id=pk, then=Value(tag)) for pk, tag in chunk],
+                output_field=models.FloatField()))
+    fields = {'needs_grading': True, 'needs_grading_at': Now()}
+    if priority is not None:
+        fields['grading_priority'] = priority
+    submissions.update(**fields)
+    notify_grading_requested()
+
+
+def _lock_for_grading(count, grader_id=None, scripts_only=False):
+    """
+    Takes up to `count` first submissions in the queue (optionally only
+    the ones with the given grader, or with graders using scoring scripts
+    rather than builtin scorers), so that no other daemon can take them.
+    Returns their ids.
+    Must be called in a transaction.
+    """
+    table = Submission._meta.db_table
+    if connection.vendor == 'postgresql':
+        # Rows locked by other daemons are skipped rather than waited for,
+        # so many daemons can take jobs from the same queue at once.
+        grader_condition = ''
+        params = [count]
+        if grader_id is not None:
+            grader_condition = 'AND grader_id = %s '
+            params = [grader_id, count]
+        if scripts_only:
+            grader_condition += "AND grader_id IN (SELECT id FROM {} " \
+                "WHERE builtin_scorer = '') ".format(
+                    DataGrader._meta.db_table)
+        # The CTE is evaluated exactly once. With "id IN (subquery)" the
+        # planner may run the subquery again and lock more than `count`.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'WITH chosen AS ('
+                'SELECT id FROM {0} WHERE needs_grading {1}'
+                'ORDER BY {2} LIMIT %s '
+                'FOR UPDATE SKIP LOCKED) '
+                'UPDATE {0} SET needs_grading = false FROM chosen '
+                'WHERE {0}.id = chosen.id RETURNING {0}.id'.format(
+                    table, grader_condition, ', '.join(QUEUE_ORDER)),
+                params)
+            return [row[0] for row in cursor.fetchall()]
+    # Other dbs (i.e. sqlite) don't have row locks, but they allow only one
+    # writer at a time. A conditional update tells us if we were first.
+    candidates = Submission.objects.filter(needs_grading=True)
+    if grader_id is not None:
+        candidates = candidates.filter(grader_id=grader_id)
+    if scripts_only:
+        candidates = candidates.filter(grader__builtin_scorer='')
+    candidates = candidates.order_by(*QUEUE_ORDER). \
+        values_list('id', flat=True)[:count]
+    return [submission_id for submission_id in candidates
+            if Submission.objects.filter(id=submission_id,
+                needs_grading=True).update(needs_grading=False)]
 
 
-def request_qs_grading(submissions):
-    submissions.update(needs_grading=True, needs_grading_at=Now())
+def lease_expiry():
+    return timezone.now() + \
+        timedelta(seconds=settings.GRADING_LEASE_SECONDS)
+
+
+def renew_leases(attempt_ids):
+    """
+    Extends the leases of the unfinished attempts - the heartbeat of
+    the worker grading them.
+    """
+    return GradingAttempt.objects.filter(id__in=attempt_ids,
+        finished=False).update(lease_expires_at=lease_expiry())
+
+
+def requeue_expired_leases():
+    """
+    Requeues the submissions whose attempts weren't finished before
+    their lease expired, i.e. whose worker died or lost contact.
+    Returns the number of them.
+    """
+    expired = GradingAttempt.objects.filter(finished=False,
+        lease_expires_at__lt=timezone.now()).values_list('id', flat=True)
+    count = 0
+    for attempt_id in expired:
+        with transaction.atomic():
+            attempt = GradingAttempt.objects.select_for_update(). \
+                filter(id=attempt_id, finished=False).first()
+            if attempt is None:
+                continue
+            logger.warning('Lease of attempt %s by %s expired',
+                attempt.id, attempt.worker)
+            requeue_grading(attempt, "Grading lease expired.")
+            count += 1
+    return count
+
+
+def _create_attempts(ids, workers):
+    submissions = Submission.objects.filter(id__in=ids). \
+        order_by(*QUEUE_ORDER)
+    chosen = []
+    for submission, worker in zip(submissions, workers):
+        attempt = GradingAttempt(submission=submission, worker=worker,
+            queued_at=submission.needs_grading_at,
+            lease_expires_at=lease_expiry())
+        attempt.save()
+        submission.current_attempt = attempt
+        submission.needs_grading = False
+        submission.save(update_fields=['current_attempt', 'needs_grading'])
+        chosen.append((submission, attempt))
+    return chosen
 
 
 @transaction.atomic
-def choose_for_grading():
-    submissions = Submission.objects.filter(needs_grading=True). \
-        order_by('needs_grading_at')[:1]
-    if not submissions.exists():
+def choose_batch_for_grading(workers, scripts_only=False):
+    """
+    Takes a waiting submission for each of the `workers` (names stored in
+    the attempts) and creates attempts for them.
+    Returns a list of (submission, attempt) pairs, shorter than `workers`
+    if there is not enough submissions waiting.
+    """
+    return _create_attempts(_lock_for_grading(len(workers),
+        scripts_only=scripts_only), workers)
+
+
+@transaction.atomic
+def choose_grader_batch_for_grading(worker, size):
+    """
+    Takes the first submission in the queue and up to `size` - 1 more
+    waiting ones with the same grader, to be scored together by `worker`.
+    Returns a list of (submission, attempt) pairs, empty if nothing waits.
+    """
+    ids = _lock_for_grading(1)
+    if not ids:
+        return []
+    grader_id = Submission.objects.filter(id=ids[0]). \
+        values_list('grader_id', flat=True).get()
+    ids += _lock_for_grading(size - 1, grader_id=grader_id)
+    return _create_attempts(ids, [worker] * len(ids))
+
+
+def choose_for_grading(worker=""):
+    chosen = choose_batch_for_grading([worker])
+    if not chosen:
         return (None, None)
-    submission = submissions[0]
-    attempt = GradingAttempt(submission=submission)
-    attempt.save()
-    submission.current_attempt = attempt
-    submission.needs_grading = False
-    submission.save()
-    return (submission, attempt)
+    return chosen[0]
 
 
 def dummy_grade(attempt):
@@ -165,47 +677,462 @@ def dummy_grade(attempt):
     attempt.save()
 
 
-def _mkdir_scoring():
-    os.makedirs(settings.SCORING_TMP, exist_ok=True)
-    return tempfile.mkdtemp(prefix='scoring_', dir=settings.SCORING_TMP)
+def _mkdir_scoring(input_bytes=None):
+    """
+    Creates a workspace for scoring inputs of the given total size,
+    on tmpfs if they are small enough and it is configured.
+    """
+    parent = settings.SCORING_TMP
+    if settings.SCORING_TMPFS_DIR and input_bytes is not None and \
+            input_bytes <= settings.SCORING_TMPFS_MAX_INPUT_BYTES:
+        parent = settings.SCORING_TMPFS_DIR
+    return create_workspace(parent)
+
+
+def _remove_scoring_dir(scoring_dir):
+    remove_workspace(scoring_dir, keep=settings.SCORING_KEEP_WORKSPACES)
+
+
+def sweep_scoring_dirs():
+    """
+    Removes the workspaces left by crashed grading processes.
+    """
+    removed = 0
+    for parent in [settings.SCORING_TMP, settings.SCORING_TMPFS_DIR]:
+        if parent:
+            removed += sweep_workspaces(parent)
+    return removed
+
+
+def _output_bytes(submission):
+    if submission.output_size is not None:
+        return submission.output_size
+    return content_size(submission.output)
+
+
+def _input_bytes(grader, submissions):
+    return content_size(grader.answer) + \
+        content_size(grader.scoring_script.source) + \
+        sum(_output_bytes(submission) for submission in submissions)
 
 
 def _file_path(field_file):
     return field_file.path
 
 
-def _prepare_scoring_dir(attempt):
-    scoring_dir = _mkdir_scoring()
-    output_path = os.path.join(scoring_dir, 'user_output')
-    shutil.copyfile(_file_path(attempt.submission.output), output_path)
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+def _try_reflink(source, destination):
+    try:
+        with open(source, 'rb') as source_file, \
+                open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE,
+                source_file.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.unlink(destination)
+        return False
+
+
+def _copy_input(source, destination):
+    """
+    Puts a scoring input at destination, read-only. It is a reflink (copy
+    on write) if the filesystem allows it, which doesn't copy the data,
+    or a plain copy otherwise.
+
+    Either way it is independent of the source - never a hardlink. Scoring
+    scripts run as the same user, so they could make any shared file
+    writable again and corrupt the media file or the cached input for
+    every later attempt. _input_fingerprints then only tells whether
+    the attempt's own copies were modified.
+    """
+    if not _try_reflink(source, destination):
+        shutil.copyfile(source, destination)
+    os.chmod(destination, 0o444)
+
+
+SCORING_INPUTS = ['user_output', 'answer', 'scoring_script.py']
+
+
+def _input_fingerprints(scoring_dir, names=SCORING_INPUTS):
+    fingerprints = []
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(scoring_dir, name))
+        except FileNotFoundError:
+            fingerprints.append(None)
+        else:
+            fingerprints.append((stat.st_size, stat.st_mtime_ns,
+                stat.st_mode))
+    return fingerprints
+
+
+def script_source_hash(script):
+    # Scripts saved before hashes were introduced get them on first use.
+    if not script.source_hash:
+        script.source_hash = stored_content_hash(script.source)
+        script.save(update_fields=['source_hash'])
+    return script.source_hash
+
+
+def grader_answer_hash(grader):
+    if not grader.answer_hash:
+        grader.answer_hash = stored_content_hash(grader.answer)
+        grader.save(update_fields=['answer_hash'])
+    return grader.answer_hash
+
+
+def _hash_json(value):
+    return hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()
+
+
+def grader_version(grader):
+    """
+    Hash of everything about the grader that results depend on. It changes
+    with the content of the answer or the script, not with saving them.
+    """
+    if grader.builtin_scorer:
+        scorer = 'builtin:' + grader.builtin_scorer
+    elif grader.scoring_script.source:
+        scorer = script_source_hash(grader.scoring_script)
+    else:
+        scorer = ""
+    answer = grader_answer_hash(grader) if grader.answer else ""
+    version = [answer, scorer, grader.time_limit_ms,
+        grader.cpu_time_limit_ms, grader.memory_limit_bytes]
+    output_format = grader_output_format(grader)
+    if output_format is not None:
+        version.append(vars(output_format))
+    return _hash_json(version)
+
+
+def grader_output_format(grader):
+    if not grader.format_columns:
+        return None
+    return validation.OutputFormat(
+        validation.parse_columns(grader.format_columns),
+        delimiter=grader.format_delimiter, header=grader.format_header,
+        id_column=grader.format_id_column, rows=grader.format_rows)
+
+
+def _answer_chunks(grader):
+    return content_chunks(grader.answer) if grader.answer else None
+
+
+def check_output_format(grader, output):
+    """
+    Checks the output (a File or an Upload) against the format of
+    the grader, if it is small enough to do it right away
+    (GRADING_VALIDATE_ON_SUBMIT_MAX_BYTES). The other ones are checked
+    before scoring. Raises validation.InvalidOutput.
+    """
+    output_format = grader_output_format(grader)
+    if output_format is None:
+        return
+    if isinstance(output, Upload):
+        size = output.size
+        chunks = content_chunks(output.file)
+    else:
+        size = output.size
+        chunks = byte_chunks(output)
+    if size > settings.GRADING_VALIDATE_ON_SUBMIT_MAX_BYTES:
+        return
+    try:
+        validation.validate(output_format, chunks, _answer_chunks(grader))
+    except validation.BadAnswer as e:
+        # not the submitter's problem, it will fail in grading
+        logger.warning('Answer of grader %s does not match its format: %s',
+            grader.id, e)
+
+
+def _reject_invalid_outputs(attempts):
+    """
+    Finishes the attempts whose outputs don't match the format of
+    the grader, without scoring them. Returns the other ones.
+    """
+    grader = attempts[0].submission.grader
+    output_format = grader_output_format(grader)
+    if output_format is None:
+        return attempts
+    remaining = []
+    for attempt in attempts:
+        phase_start = time.monotonic()
+        try:
+            validation.validate(output_format,
+                content_chunks(attempt.submission.output),
+                _answer_chunks(grader))
+        except validation.InvalidOutput as e:
+            attempt.succeeded = True
+            attempt.scoring_status = 'rejected'
+            attempt.scoring_msg = str(e)
+        except validation.BadAnswer as e:
+            attempt.succeeded = False
+            attempt.scoring_status = 'error'
+            attempt.scoring_msg = 'Answer does not match the output ' \
+                'format: %s' % e
+        else:
+            remaining.append(attempt)
+            continue
+        _set_phase([attempt], 'prepare_ms', phase_start)
+        _finish_grading_timed(attempt)
+    return remaining
+
+
+def result_cache_key(submission):
+    """
+    Hash of everything the result of grading the submission depends on,
+    or "" if the output wasn't hashed (i.e. submitted before hashing).
+    """
+    if not submission.output_hash:
+        return ""
+    return _hash_json([submission.output_hash,
+        grader_version(submission.grader)])
+
+
+def _cached_result(attempt):
+    # Errors and exceeded limits may be different next time. Hits point
+    # to the attempt which was really scored.
+    return GradingAttempt.objects.filter(cache_key=attempt.cache_key,
+        finished=True, succeeded=True, limit_exceeded="",
+        scoring_status__in=['accepted', 'rejected'],
+        cache_hit_of__isnull=True). \
+        exclude(id=attempt.id).order_by('-id').first()
+
+
+def grade_from_cache(attempts):
+    """
+    Finishes the attempts whose result is known from earlier attempts,
+    copying it. Returns the other ones, which have to be graded.
+    """
+    remaining = []
+    for attempt in attempts:
+        attempt.cache_key = result_cache_key(attempt.submission)
+        attempt.save(update_fields=['cache_key'])
+        cached = None
+        if attempt.cache_key and settings.GRADING_RESULT_CACHE_ENABLED:
+            cached = _cached_result(attempt)
+        if cached is None:
+            remaining.append(attempt)
+            continue
+        logger.debug('Attempt %s has the result of attempt %s',
+            attempt.id, cached.id)
+        mark_started(attempt)
+        attempt.cache_hit_of = cached
+        attempt.succeeded = True
+        attempt.score = cached.score
+        attempt.scoring_status = cached.scoring_status
+        attempt.scoring_msg = cached.scoring_msg
+        finish_grading(attempt)
+    return remaining
+
+
+def input_cache():
+    directory = settings.GRADING_INPUT_CACHE_DIR or \
+        os.path.join(settings.SCORING_TMP, 'input_cache')
+    return InputCache(directory, settings.GRADING_INPUT_CACHE_MAX_BYTES)
+
+
+def _cached_input_path(field_file, key):
+    if settings.GRADING_INPUT_CACHE_ENABLED:
+        return input_cache().get(key, field_file)
+
+
+def _put_input(field_file, destination, key=None):
+    """
+    Puts the content of a stored file at destination, read-only. Grader
+    inputs, with content hash `key`, come from the input cache.
+    Compressed files which aren't there are decompressed.
+    """
+    source = _cached_input_path(field_file, key) if key else None
+    if source is not None:
+        try:
+            _copy_input(source, destination)
+            return
+        except FileNotFoundError:
+            # evicted by another worker in the meantime
+            source = _cached_input_path(field_file, key)
+    if source is None and not is_compressed(field_file):
+        source = _file_path(field_file)
+    if source is not None:
+        _copy_input(source, destination)
+    else:
+        write_content(field_file, destination)
+        os.chmod(destination, 0o444)
+
+
+def _open_input(field_file, key=None):
+    # for reading the content in this process
+    source = _cached_input_path(field_file, key) if key else None
+    if source is not None:
+        try:
+            return open(source, 'rb')
+        except FileNotFoundError:
+            # evicted by another worker in the meantime
+            source = _cached_input_path(field_file, key)
+    if source is not None:
+        return open(source, 'rb')
+    return open_content(field_file)
+
+
+def warm_server_name(grader):
+    # One warm server per script, answer and limits. The name is short,
+    # because unix socket paths are limited to about 100 characters.
+    key = '%s %s %s %s' % (script_source_hash(grader.scoring_script),
+        grader_answer_hash(grader), grader.time_limit_ms,
+        grader.memory_limit_bytes)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+
+
+def _warm_socket_path(grader):
+    warm_dir = settings.SCORING_WARM_DIR or \
+        os.path.join(settings.SCORING_TMP, 'warm')
+    return os.path.join(warm_dir, warm_server_name(grader) + '.sock')
+
+
+def scoring_limits(grader):
+    """
+    The part of run_scoring.py config which doesn't depend on where and
+    how scoring is set up.
+    """
+    cpu_time_limit_ms = grader.cpu_time_limit_ms or grader.time_limit_ms
+    return {
+        'max_output_bytes': MAX_SCORING_SCRIPT_OUTPUT_SIZE,
+        'time_limit_ms': grader.time_limit_ms,
+        'cpu_time_limit_ms': cpu_time_limit_ms,
+        'memory_limit_bytes': grader.memory_limit_bytes,
+        'max_file_bytes': settings.SCORING_MAX_FILE_BYTES,
+        'max_workspace_bytes': settings.SCORING_MAX_WORKSPACE_BYTES,
+    }
+
+
+def _grader_config(grader, scoring_dir):
+    """
+    Puts the grader's answer and script into scoring_dir. Returns
+    the part of run_scoring.py config common to all its submissions.
+    """
     answer_path = os.path.join(scoring_dir, 'answer')
-    shutil.copyfile(_file_path(attempt.submission.grader.answer), answer_path)
+    _put_input(grader.answer, answer_path, grader_answer_hash(grader))
     script_path = os.path.join(scoring_dir, 'scoring_script.py')
-    shutil.copyfile(
-        _file_path(attempt.submission.grader.scoring_script.source),
-        script_path)
-    attempt.log.save('scoring_log', ContentFile(''))
-    log_file_path = _file_path(attempt.log)
-    working_path = os.path.join(scoring_dir, 'working')
-    config = {
-        'working_directory': working_path,
-        'scoring_script': script_path,
-        'user_output': output_path,
-        'answer': answer_path,
-        'scoring_log': log_file_path,
-        'time_limit_ms': attempt.submission.grader.time_limit_ms,
-        'memory_limit_bytes': attempt.submission.grader.memory_limit_bytes
-    }
+    script = grader.scoring_script
+    _put_input(script.source, script_path, script_source_hash(script))
+    config = dict(scoring_limits(grader),
+        working_directory=os.path.join(scoring_dir, 'working'),
+        scoring_script=script_path,
+        answer=answer_path)
+    if settings.SCORING_CGROUP_ROOT:
+        config['cgroup'] = {
+            'root': settings.SCORING_CGROUP_ROOT,
+            'cpu_max': settings.SCORING_CGROUP_CPU_MAX,
+            'pids_max': settings.SCORING_CGROUP_PIDS_MAX,
+        }
+    if script.persistent:
+        config['persistent'] = True
+        config['warm_socket'] = _warm_socket_path(grader)
+        config['warm_max_jobs'] = settings.SCORING_WARM_MAX_JOBS
+        config['warm_idle_seconds'] = settings.SCORING_WARM_IDLE_SECONDS
+    return config
+
+
+def _write_config(scoring_dir, config):
     config_path = os.path.join(scoring_dir, 'config.json')
     with open(config_path, 'w') as config_file:
         json.dump(config, config_file)
+
+
+def _prepare_scoring_dir(attempt):
+    grader = attempt.submission.grader
+    scoring_dir = _mkdir_scoring(
+        _input_bytes(grader, [attempt.submission]))
+    config = _grader_config(grader, scoring_dir)
+    output_path = os.path.join(scoring_dir, 'user_output')
+    _put_input(attempt.submission.output, output_path)
+    attempt.log.save('scoring_log', ContentFile(''))
+    config['user_output'] = output_path
+    config['scoring_log'] = _file_path(attempt.log)
+    _write_config(scoring_dir, config)
     return scoring_dir
 
 
-def _run_scoring_popen(attempt, scoring_dir):
+def _batch_output_name(attempt):
+    return 'user_output_%s' % attempt.id
+
+
+def _batch_result_path(scoring_dir, attempt):
+    return os.path.join(scoring_dir, 'result_%s.json' % attempt.id)
+
+
+def _prepare_batch_scoring_dir(attempts):
+    """
+    Like _prepare_scoring_dir, but for many submissions with the same
+    grader, scored one after another by a single run of run_scoring.py.
+    """
+    grader = attempts[0].submission.grader
+    scoring_dir = _mkdir_scoring(_input_bytes(grader,
+        [attempt.submission for attempt in attempts]))
+    config = _grader_config(grader, scoring_dir)
+    config['batch'] = []
+    for attempt in attempts:
+        output_path = os.path.join(scoring_dir, _batch_output_name(attempt))
+        _put_input(attempt.submission.output, output_path)
+        attempt.log.save('scoring_log', ContentFile(''))
+        config['batch'].append({
+            'user_output': output_path,
+            'scoring_log': _file_path(attempt.log),
+            'result': _batch_result_path(scoring_dir, attempt),
+        })
+    _write_config(scoring_dir, config)
+    return scoring_dir
+
+
+RUN_SCORING_OUTPUT = 'run_scoring_output'
+
+
+def _run_scoring_popen(scoring_dir):
     args = [settings.RUNNER_PATH, scoring_dir]
-    return subprocess.Popen(args, stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
+    # A file rather than a pipe, which would block the runner once full,
+    # as we only read it after the runner exits.
+    output_path = os.path.join(scoring_dir, RUN_SCORING_OUTPUT)
+    with open(output_path, 'wb') as output_file:
+        return subprocess.Popen(args, stdout=output_file,
+            stderr=subprocess.STDOUT)
+
+
+PHASE_FIELDS = ['prepare_ms', 'run_ms', 'parse_ms']
+
+
+def _elapsed_ms(since):
+    return int((time.monotonic() - since) * 1000)
+
+
+def _set_phase(attempts, field, since):
+    share = _elapsed_ms(since) // len(attempts)
+    for attempt in attempts:
+        setattr(attempt, field, share)
+
+
+USAGE_FIELDS = ['wall_time_ms', 'cpu_user_ms', 'cpu_system_ms',
+    'max_rss_bytes', 'io_read_blocks', 'io_write_blocks']
+
+
+def set_usage(attempt, usage, limit_exceeded=None):
+    """
+    Sets the resource usage fields from usage dict as in run_scoring.py.
+    """
+    if usage is None:
+        return
+    for field in USAGE_FIELDS:
+        setattr(attempt, field, usage.get(field))
+    attempt.limit_exceeded = limit_exceeded or ""
+
+
+def _read_usage(scoring_dir):
+    try:
+        with open(os.path.join(scoring_dir, 'usage.json')) as usage_file:
+            return json.load(usage_file)
+    except (OSError, ValueError):
+        return None
 
 
 @transaction.atomic
@@ -215,7 +1142,8 @@ def finish_grading(attempt):
     attempt.finished = True
     attempt.finished_at = timezone.now()
     attempt.save(update_fields=['succeeded', 'score', 'scoring_msg',
-        'scoring_status', 'finished', 'finished_at'])
+        'scoring_status', 'finished', 'finished_at', 'limit_exceeded',
+        'cache_hit_of'] + USAGE_FIELDS + PHASE_FIELDS)
     submission = Submission.objects. \
         filter(current_attempt=attempt).select_for_update()
     if submission.exists():
@@ -225,9 +1153,55 @@ def finish_grading(attempt):
         submission.scoring_msg = attempt.scoring_msg
         submission.save(update_fields=['score', 'scoring_msg',
             'scoring_status'])
+        notify_grading_finished(submission.id)
+
+
+def _finish_grading_timed(attempt):
+    started_at = time.monotonic()
+    finish_grading(attempt)
+    attempt.finish_ms = _elapsed_ms(started_at)
+    GradingAttempt.objects.filter(id=attempt.id). \
+        update(finish_ms=attempt.finish_ms)
+
+
+def finish_dirty_grading(attempt):
+    """
+    Finishes the attempt with an error, unless it is already finished.
+    Used when the process grading it died without cleaning up.
+    """
+    attempt.refresh_from_db()
+    if not attempt.finished:
+        attempt.succeeded = False
+        attempt.score = None
+        attempt.scoring_status = 'error'
+        attempt.scoring_msg = "Dirty grading failure."
+        finish_grading(attempt)
+
+
+@transaction.atomic
+def requeue_grading(attempt, reason):
+    """
+    Gives up on an unfinished attempt without touching the submission's
+    result and marks the submission for grading again.
+    """
+    attempt.refresh_from_db()
+    if attempt.finished:
+        return
+    attempt.succeeded = False
+    attempt.score = None
+    attempt.scoring_status = 'error'
+    attempt.scoring_msg = reason
+    attempt.finished = True
+    attempt.finished_at = timezone.now()
+    attempt.save(update_fields=['succeeded', 'score', 'scoring_msg',
+        'scoring_status', 'finished', 'finished_at'])
+    request_qs_grading(Submission.objects.filter(current_attempt=attempt))
 
 
 MAX_RUN_SCORING_OUTPUT_SIZE = 1000000
+# run_scoring.py truncates the script's output itself, leaving some room
+# for its own messages.
+MAX_SCORING_SCRIPT_OUTPUT_SIZE = MAX_RUN_SCORING_OUTPUT_SIZE - 1000
 
 
 def join_with_terminator(terminator, iterable):
@@ -275,44 +1249,224 @@ def handle_run_scoring_output(output, attempt):
         attempt.scoring_msg = 'Bad scoring output (%s):\n' % e.reason + output
 
 
-def attempt_grading(attempt):
-    logger.debug('attempt_grading called with attempt %s', attempt.id)
-    scoring_dir = _prepare_scoring_dir(attempt)
-    process = _run_scoring_popen(attempt, scoring_dir)
-    finished = False
-    while not finished:
-        attempt.refresh_from_db()
+def mark_started(attempt):
+    attempt.started = True
+    attempt.started_at = timezone.now()
+    attempt.grader_version = grader_version(attempt.submission.grader)
+    attempt.save(update_fields=['started', 'started_at', 'grader_version'])
+
+
+def _finish_aborted(attempts):
+    """
+    Finishes the attempts aborted in the meantime. Returns the other ones.
+    """
+    remaining = []
+    for attempt in attempts:
+        attempt.refresh_from_db(fields=['aborted'])
         if attempt.aborted:
             attempt.scoring_status = "error"
             attempt.scoring_msg = "aborted"
             attempt.succeeded = False
             finish_grading(attempt)
-            return
+        else:
+            remaining.append(attempt)
+    return remaining
+
+
+def _wait_for_scoring(process, attempts):
+    """
+    Waits for run_scoring.py, unless all the attempts get aborted.
+    Returns the attempts which were not aborted.
+    """
+    while True:
+        attempts = _finish_aborted(attempts)
+        if not attempts:
+            return attempts
         try:
-            # in theory this can deadlock if process generates ton of output
-            # TODO: change to passing data through files
-            # I am not sure if communicate is the right solution either
             process.wait(
                 timeout=settings.GRADING_CHECK_STATUS_INTERVAL_SECONDS)
-            finished = True
+            return attempts
         except subprocess.TimeoutExpired:
             pass
-    output = process.stdout.read(MAX_RUN_SCORING_OUTPUT_SIZE). \
-        decode('utf-8', errors='replace')
-    logger.debug('run_scoring.py finished')
-    if process.returncode == 0:
+
+
+def _fail_modified_inputs(attempt, scoring_dir):
+    logger.error('Attempt %s: scoring script modified its input files '
+        'in %s', attempt.id, scoring_dir)
+    attempt.scoring_status = 'error'
+    attempt.scoring_msg = 'Scoring script modified its input files.'
+    attempt.succeeded = False
+
+
+def _apply_scoring_result(attempt, returncode, output):
+    if returncode == 0:
         logger.debug('run_scoring finished successfully (code 0)')
         attempt.succeeded = True
         handle_run_scoring_output(output, attempt)
     else:
-        logger.info("run_scoring.py failed with code %s", process.returncode)
-        output_prefix = "run_scoring.py failed with code %s" % \
-            process.returncode
-        if process.returncode == 1:
+        logger.info("run_scoring.py failed with code %s", returncode)
+        output_prefix = "run_scoring.py failed with code %s" % returncode
+        if returncode == 1:
             logger.info('Probably scoring script crashed.')
             output_prefix += '\nProbably scoring script crashed.'
         attempt.scoring_status = 'error'
         attempt.scoring_msg = '\n'.join([output_prefix, output])
         attempt.succeeded = False
-    # We don't want to overwrite aborted etc.
-    finish_grading(attempt)
+
+
+def _read_run_scoring_output(scoring_dir):
+    output_path = os.path.join(scoring_dir, RUN_SCORING_OUTPUT)
+    with open(output_path, 'rb') as output_file:
+        output = output_file.read(MAX_RUN_SCORING_OUTPUT_SIZE + 1)
+    text = output[:MAX_RUN_SCORING_OUTPUT_SIZE].decode('utf-8',
+        errors='replace')
+    if len(output) > MAX_RUN_SCORING_OUTPUT_SIZE:
+        if not text.endswith('\n'):
+            text += '\n'
+        text += 'run_scoring.py output truncated to %s bytes\n' % \
+            MAX_RUN_SCORING_OUTPUT_SIZE
+    return text
+
+
+def _builtin_usage(before, after, started_at):
+    # Max RSS can't be split between attempts, so it is of the whole
+    # grading process.
+    return {
+        'wall_time_ms': int((time.monotonic() - started_at) * 1000),
+        'cpu_user_ms': int((after.ru_utime - before.ru_utime) * 1000),
+        'cpu_system_ms': int((after.ru_stime - before.ru_stime) * 1000),
+        'max_rss_bytes': after.ru_maxrss * 1024,
+        'io_read_blocks': after.ru_inblock - before.ru_inblock,
+        'io_write_blocks': after.ru_oublock - before.ru_oublock,
+    }
+
+
+def builtin_grading(attempts):
+    """
+    Grades attempts of submissions with the same grader using its built-in
+    scorer, in this process. The answer is read once for all of them.
+    """
+    grader = attempts[0].submission.grader
+    answer_error = None
+    phase_start = time.monotonic()
+    try:
+        with _open_input(grader.answer, grader_answer_hash(grader)) as \
+                answer_file:
+            answer = scorers.read_answer(grader.builtin_scorer, answer_file)
+    except scorers.BadColumn as e:
+        answer_error = str(e)
+    _set_phase(attempts, 'prepare_ms', phase_start)
+    for attempt in _finish_aborted(attempts):
+        if answer_error is None:
+            started_at = time.monotonic()
+            rusage_before = resource.getrusage(resource.RUSAGE_SELF)
+            try:
+                with open_content(attempt.submission.output) as \
+                        output_file:
+                    output = scorers.score(grader.builtin_scorer, answer,
+                        output_file)
+            except scorers.BadColumn as e:
+                answer_error = str(e)
+            set_usage(attempt, _builtin_usage(rusage_before,
+                resource.getrusage(resource.RUSAGE_SELF), started_at))
+            _set_phase([attempt], 'run_ms', started_at)
+        if answer_error is not None:
+            attempt.scoring_status = 'error'
+            attempt.scoring_msg = 'Bad answer for built-in scorer %s: %s' % \
+                (grader.builtin_scorer, answer_error)
+            attempt.succeeded = False
+        else:
+            attempt.succeeded = True
+            handle_run_scoring_output(output, attempt)
+        _finish_grading_timed(attempt)
+
+
+def attempt_grading(attempt):
+    logger.debug('attempt_grading called with attempt %s', attempt.id)
+    mark_started(attempt)
+    if not _reject_invalid_outputs([attempt]):
+        return
+    if attempt.submission.grader.builtin_scorer:
+        builtin_grading([attempt])
+        return
+    phase_start = time.monotonic()
+    scoring_dir = _prepare_scoring_dir(attempt)
+    try:
+        inputs = _input_fingerprints(scoring_dir)
+        _set_phase([attempt], 'prepare_ms', phase_start)
+        phase_start = time.monotonic()
+        process = _run_scoring_popen(scoring_dir)
+        if not _wait_for_scoring(process, [attempt]):
+            return
+        _set_phase([attempt], 'run_ms', phase_start)
+        phase_start = time.monotonic()
+        output = _read_run_scoring_output(scoring_dir)
+        logger.debug('run_scoring.py finished')
+        usage = _read_usage(scoring_dir)
+        if usage is not None:
+            set_usage(attempt, usage, usage.get('limit_exceeded'))
+        if _input_fingerprints(scoring_dir) != inputs:
+            _fail_modified_inputs(attempt, scoring_dir)
+        else:
+            _apply_scoring_result(attempt, process.returncode, output)
+        _set_phase([attempt], 'parse_ms', phase_start)
+        # We don't want to overwrite aborted etc.
+        _finish_grading_timed(attempt)
+    finally:
+        _remove_scoring_dir(scoring_dir)
+
+
+def attempt_batch_grading(attempts):
+    """
+    Grades attempts of submissions with the same grader with a single run
+    of run_scoring.py. The answer and the script are prepared once and
+    a persistent script is loaded once for the whole batch.
+    """
+    logger.debug('attempt_batch_grading called with attempts %s',
+        [attempt.id for attempt in attempts])
+    for attempt in attempts:
+        mark_started(attempt)
+    attempts = _reject_invalid_outputs(attempts)
+    if not attempts:
+        return
+    if attempts[0].submission.grader.builtin_scorer:
+        builtin_grading(attempts)
+        return
+    phase_start = time.monotonic()
+    scoring_dir = _prepare_batch_scoring_dir(attempts)
+    try:
+        input_names = ['answer', 'scoring_script.py'] + \
+            [_batch_output_name(attempt) for attempt in attempts]
+        inputs = _input_fingerprints(scoring_dir, input_names)
+        _set_phase(attempts, 'prepare_ms', phase_start)
+        phase_start = time.monotonic()
+        process = _run_scoring_popen(scoring_dir)
+        attempts = _wait_for_scoring(process, attempts)
+        if not attempts:
+            return
+        _set_phase(attempts, 'run_ms', phase_start)
+        output = _read_run_scoring_output(scoring_dir)
+        logger.debug('run_scoring.py finished batch')
+        # we don't know which of them did it
+        modified = _input_fingerprints(scoring_dir, input_names) != inputs
+        for attempt in attempts:
+            phase_start = time.monotonic()
+            if modified:
+                _fail_modified_inputs(attempt, scoring_dir)
+            else:
+                try:
+                    with open(_batch_result_path(scoring_dir, attempt)) as \
+                            result_file:
+                        result = json.load(result_file)
+                    _apply_scoring_result(attempt, result['exit_code'],
+                        result['output'])
+                    set_usage(attempt, result.get('usage'),
+                        result.get('limit_exceeded'))
+                except (OSError, ValueError):
+                    # run_scoring.py failed before getting to this one
+                    _apply_scoring_result(attempt, process.returncode or 1,
+                        output)
+            _set_phase([attempt], 'parse_ms', phase_start)
+            _finish_grading_timed(attempt)
+    finally:
+        _remove_scoring_dir(scoring_dir)
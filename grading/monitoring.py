@@ -0,0 +1,217 @@
+"""
+Metrics of the grading daemon in the Prometheus text format.
+
+Counters and histograms are of the attempts this daemon has taken since it
+started (a restart resets them, which Prometheus handles). The queue depth
+is read from the db, so every daemon reports the same one.
+
+The queue is split by the part of fair_share_key before the first "/"
+(e.g. "contest-3" for "contest-3/team-7").
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from django.db.models import Count
+
+from .models import Submission
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+PHASE_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+PHASES = ['prepare', 'run', 'parse', 'finish']
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').
+            replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels=None):
+        labels = labels or {}
+        for bound, count in zip(self.buckets, self.counts):
+            yield '%s_bucket%s %s' % (name,
+                _labels(dict(labels, le=bound)), count)
+        yield '%s_bucket%s %s' % (name, _labels(dict(labels, le='+Inf')),
+            self.count)
+        yield '%s_sum%s %s' % (name, _labels(labels), self.sum)
+        yield '%s_count%s %s' % (name, _labels(labels), self.count)
+
+
+def queue_depth():
+    """
+    Returns {(priority, queue): number of waiting submissions}.
+    """
+    depth = {}
+    rows = Submission.objects.filter(needs_grading=True). \
+        values_list('grading_priority', 'fair_share_key'). \
+        annotate(count=Count('id')).order_by()
+    for priority, key, count in rows:
+        queue = key.split('/', 1)[0]
+        depth[priority, queue] = depth.get((priority, queue), 0) + count
+    return depth
+
+
+class GradingMetrics(object):
+    def __init__(self):
+        self.attempts = {}  # (status, cache hit) -> count
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.phases = {phase: Histogram(PHASE_BUCKETS) for phase in PHASES}
+        self.workers = 0
+        self.busy_workers = 0
+        self.busy_seconds = 0
+        self.last_pool_update = None
+
+    def observe_attempt(self, attempt):
+        """
+        Counts a finished attempt.
+        """
+        key = (attempt.scoring_status, attempt.cache_hit_of_id is not None)
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        if attempt.queued_at and attempt.started_at:
+            self.latency.observe(
+                (attempt.started_at - attempt.queued_at).total_seconds())
+        for phase in PHASES:
+            ms = getattr(attempt, phase + '_ms')
+            if ms is not None:
+                self.phases[phase].observe(ms / 1000)
+
+    def observe_pool(self, workers, busy_workers):
+        now = time.monotonic()
+        if self.last_pool_update is not None:
+            self.busy_seconds += \
+                self.busy_workers * (now - self.last_pool_update)
+        self.last_pool_update = now
+        self.workers = workers
+        self.busy_workers = busy_workers
+
+    def render(self):
+        lines = [
+            '# HELP grading_queue_depth Submissions waiting for grading.',
+            '# TYPE grading_queue_depth gauge',
+        ]
+        for (priority, queue), count in sorted(queue_depth().items()):
+            lines.append('grading_queue_depth%s %s' % (
+                _labels({'priority': priority, 'queue': queue}), count))
+        lines += [
+            '# HELP grading_attempts_total Finished grading attempts.',
+            '# TYPE grading_attempts_total counter',
+        ]
+        for (status, cache_hit), count in sorted(self.attempts.items()):
+            lines.append('grading_attempts_total%s %s' % (_labels({
+                'status': status,
+                'cache_hit': 'true' if cache_hit else 'false'}), count))
+        lines += [
+            '# HELP grading_dequeue_latency_seconds From requesting '
+            'grading to the start of the attempt.',
+            '# TYPE grading_dequeue_latency_seconds histogram',
+        ]
+        lines += self.latency.lines('grading_dequeue_latency_seconds')
+        lines += [
+            '# HELP grading_phase_duration_seconds Durations of the '
+            'grading phases.',
+            '# TYPE grading_phase_duration_seconds histogram',
+        ]
+        for phase in PHASES:
+            lines += self.phases[phase].lines(
+                'grading_phase_duration_seconds', {'phase': phase})
+        lines += [
+            '# HELP grading_workers Worker slots of the daemon.',
+            '# TYPE grading_workers gauge',
+            'grading_workers %s' % self.workers,
+            '# HELP grading_workers_busy Worker slots running attempts.',
+            '# TYPE grading_workers_busy gauge',
+            'grading_workers_busy %s' % self.busy_workers,
+            '# HELP grading_worker_busy_seconds_total Time worker slots '
+            'spent running attempts.',
+            '# TYPE grading_worker_busy_seconds_total counter',
+            'grading_worker_busy_seconds_total %s' % self.busy_seconds,
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file(path, text):
+    # atomic, so a reader never sees half of it
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: ' + format, *args)
+
+
+class MetricsExporter(object):
+    """
+    Writes the metrics to a file (e.g. for node_exporter's textfile
+    collector) and/or serves them over HTTP on a local port.
+
+    The text is rendered by the daemon's loop, calling export(), so the
+    server thread never touches the db or the pool.
+    """
+
+    def __init__(self, metrics, path=None, port=None, host='127.0.0.1'):
+        self.metrics = metrics
+        self.path = path
+        self.server = None
+        if port is not None:
+            self.server = HTTPServer((host, port), _MetricsHandler)
+            self.server.text = ''
+            thread = threading.Thread(target=self.server.serve_forever,
+                daemon=True)
+            thread.start()
+            logger.info('Serving metrics on %s:%s', host,
+                self.server.server_port)
+
+    def export(self):
+        text = self.metrics.render()
+        if self.path:
+            write_metrics_file(self.path, text)
+        if self.server is not None:
+            self.server.text = text
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
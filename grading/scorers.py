@@ -0,0 +1,326 @@
+"""
+Built-in scorers for the common metrics. They run in the grading process,
+instead of a scoring script in a separate one.
+
+Both the answer and the submitted output have one number per line, or
+an ID and a number separated by a comma, optionally preceded by a header
+line. With IDs, the output is matched with the answer by them, in any
+order. The result is the same text
+a scoring script would print (ACCEPTED and the score or REJECTED and
+the reason), so it is handled by handle_run_scoring_output as usual.
+"""
+import warnings
+
+import numpy as np
+
+READ_BLOCK_SIZE = 16 * 2**20
+MAX_ID_BYTES = 100
+
+BUILTIN_SCORER_CHOICES = (
+    ('rmse', 'Root mean squared error'),
+    ('mae', 'Mean absolute error'),
+    ('logloss', 'Log loss (binary)'),
+    ('accuracy', 'Accuracy'),
+    ('roc_auc', 'ROC AUC (binary)'),
+    ('f1', 'F1 score (binary)'),
+)
+
+LOGLOSS_EPSILON = 1e-15
+
+_NEWLINE = ord('\n')
+_COMMA = ord(',')
+_SPACE = ord(' ')
+_IS_SPACE = np.zeros(256, dtype=bool)
+_IS_SPACE[list(b' \t\r\n\v\f')] = True
+
+
+class BadColumn(Exception):
+    pass
+
+
+class Rejected(Exception):
+    pass
+
+
+def _parse_numbers(data):
+    # fromstring stops at the first thing that isn't a number (warning
+    # about it in newer numpy), so it is checked by counting the lines.
+    # It returns -1 for a non-number after leading whitespace at the very
+    # start, hence the number in front.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            return np.fromstring(b'0 ' + data, sep=' ')[1:]
+        except ValueError:
+            return np.array([])
+
+
+def _is_number(line):
+    try:
+        float(line)
+        return True
+    except ValueError:
+        return False
+
+
+def _first_bad_line(data):
+    for index, line in enumerate(data.split(b'\n')):
+        if not _is_number(line):
+            return index
+
+
+def _tokens_per_line(chars, line_ends):
+    # whitespace separated tokens on each line
+    is_space = _IS_SPACE[chars]
+    starts = ~is_space
+    starts[1:] &= is_space[:-1]
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+    return np.add.reduceat(starts.view(np.uint8), line_starts,
+        dtype=np.int64)
+
+
+def _split_ids(chars, line_ends, line_number):
+    """
+    Returns the IDs before the comma on each line, as a bytes array, and
+    the characters with the IDs and commas replaced by spaces.
+    """
+    commas = np.flatnonzero(chars == _COMMA)
+    per_line = np.bincount(np.searchsorted(line_ends, commas),
+        minlength=len(line_ends))
+    if np.any(per_line != 1):
+        raise BadColumn('line %s: expected an ID and a number separated '
+            'by a comma' % (line_number + np.argmax(per_line != 1) + 1))
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+    lengths = commas - line_starts
+    if np.any(lengths == 0):
+        raise BadColumn('line %s: empty ID' %
+            (line_number + np.argmax(lengths == 0) + 1))
+    if np.any(lengths > MAX_ID_BYTES):
+        raise BadColumn('line %s: ID longer than %s bytes' %
+            (line_number + np.argmax(lengths > MAX_ID_BYTES) + 1,
+             MAX_ID_BYTES))
+    width = max(1, int(lengths.max()))
+    # positions of the IDs and commas, padded with those of the commas
+    positions = np.minimum(line_starts[:, None] + np.arange(width + 1),
+        commas[:, None])
+    id_chars = chars[positions[:, :width]]
+    id_chars[id_chars == _COMMA] = 0
+    ids = id_chars.view('S%s' % width).ravel()
+    chars = chars.copy()
+    chars[positions] = _SPACE
+    return ids, chars
+
+
+def _parse_lines(data, line_number, with_ids):
+    """
+    Parses complete lines, each of them ending with a newline.
+    """
+    if not data:
+        return (np.array([], dtype='S1') if with_ids else None), \
+            np.array([])
+    chars = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(chars == _NEWLINE)
+    ids = None
+    if with_ids:
+        ids, chars = _split_ids(chars, line_ends, line_number)
+        data = chars.tobytes()
+    tokens = _tokens_per_line(chars, line_ends)
+    if np.any(tokens != 1):
+        raise BadColumn('line %s: expected a single number' %
+            (line_number + np.argmax(tokens != 1) + 1))
+    values = _parse_numbers(data)
+    if len(values) != len(line_ends):
+        # the slow way, only to tell where the problem is
+        raise BadColumn('line %s: expected a single number' %
+            (line_number + _first_bad_line(data) + 1))
+    if not np.all(np.isfinite(values)):
+        raise BadColumn('line %s: number is not finite' %
+            (line_number + np.argmin(np.isfinite(values)) + 1))
+    return ids, values
+
+
+def read_column(path):
+    with open(path, 'rb') as column_file:
+        return read_column_file(column_file)
+
+
+def read_column_file(column_file):
+    """
+    Reads a binary file with one number, or an ID and a number, per line,
+    in blocks, without building a python object for every line. Whether
+    lines have IDs is told by the first one. Returns the IDs (a bytes
+    array, or None if there are none) and the numbers. Raises BadColumn
+    if the file isn't like that.
+    """
+    id_parts = []
+    parts = []
+    line_number = 0
+    rest = b''
+    with_ids = None
+    while True:
+        block = column_file.read(READ_BLOCK_SIZE)
+        if block:
+            data = rest + block
+            # trailing whitespace stays in rest, in case it is
+            # the end of the file
+            end = data.rstrip().rfind(b'\n') + 1
+            data, rest = data[:end], data[end:]
+        else:
+            data, rest = rest.rstrip(), b''
+            if data:
+                data += b'\n'
+        if with_ids is None and data:
+            first_line, _, remaining = data.partition(b'\n')
+            with_ids = b',' in first_line
+            value = first_line.rpartition(b',')[2] if with_ids else \
+                first_line
+            if value.strip() and not _is_number(value):
+                # header
+                line_number += 1
+                data = remaining
+        ids, values = _parse_lines(data, line_number, with_ids)
+        if ids is not None:
+            id_parts.append(ids)
+        parts.append(values)
+        line_number += len(values)
+        if not block:
+            break
+    if not with_ids:
+        return None, np.concatenate(parts)
+    return np.concatenate(id_parts), np.concatenate(parts)
+
+
+def _align(answer_ids, answer_order, ids, values):
+    """
+    Returns the values in the order of the answer, given its IDs sorted
+    and the order sorting them. Raises Rejected unless the IDs are
+    the same.
+    """
+    if len(ids) != len(answer_ids):
+        raise Rejected('expected %s values, got %s' %
+            (len(answer_ids), len(ids)))
+    order = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    if np.any(sorted_ids != answer_ids):
+        duplicate = sorted_ids[1:] == sorted_ids[:-1]
+        if np.any(duplicate):
+            raise Rejected('duplicate ID %r' % sorted_ids[
+                np.argmax(duplicate)].decode('utf-8', 'replace'))
+        unknown = ~np.in1d(ids, answer_ids)
+        raise Rejected('unknown ID %r' %
+            ids[np.argmax(unknown)].decode('utf-8', 'replace'))
+    aligned = np.empty_like(values)
+    aligned[answer_order] = values[order]
+    return aligned
+
+
+def _check_binary(values, what):
+    if not np.all((values == 0) | (values == 1)):
+        raise Rejected('%s must be 0 or 1' % what)
+
+
+def rmse(answer, output):
+    return np.sqrt(np.mean((output - answer) ** 2))
+
+
+def mae(answer, output):
+    return np.mean(np.abs(output - answer))
+
+
+def logloss(answer, output):
+    if not np.all((output >= 0) & (output <= 1)):
+        raise Rejected('predicted probabilities must be between 0 and 1')
+    output = np.clip(output, LOGLOSS_EPSILON, 1 - LOGLOSS_EPSILON)
+    return -np.mean(answer * np.log(output) +
+                    (1 - answer) * np.log(1 - output))
+
+
+def accuracy(answer, output):
+    return np.mean(answer == output)
+
+
+def roc_auc(answer, output):
+    positive = answer == 1
+    positives = np.count_nonzero(positive)
+    negatives = len(answer) - positives
+    if not positives or not negatives:
+        raise BadColumn('both classes must be present in the answer')
+    # Mann-Whitney U, with tied predictions getting their average rank
+    _, inverse, counts = np.unique(output, return_inverse=True,
+        return_counts=True)
+    ends = np.cumsum(counts)
+    average_ranks = ends - (counts - 1) / 2
+    positive_rank_sum = np.sum(average_ranks[inverse[positive]])
+    return (positive_rank_sum - positives * (positives + 1) / 2) / \
+        (positives * negatives)
+
+
+def f1(answer, output):
+    _check_binary(output, 'predicted labels')
+    true_positives = np.count_nonzero((answer == 1) & (output == 1))
+    wrong = np.count_nonzero(answer != output)
+    if not true_positives:
+        return 0.0
+    return 2 * true_positives / (2 * true_positives + wrong)
+
+
+SCORERS = {
+    'rmse': rmse,
+    'mae': mae,
+    'logloss': logloss,
+    'accuracy': accuracy,
+    'roc_auc': roc_auc,
+    'f1': f1,
+}
+
+# Scorers which need the answer to contain only 0 and 1
+BINARY_ANSWER_SCORERS = {'logloss', 'roc_auc', 'f1'}
+
+
+def read_answer(scorer, answer_file):
+    """
+    Reads and checks the answer (a binary file) for the scorer. Raises
+    BadColumn if the answer is wrong, which is a problem of the grader,
+    not submissions.
+    """
+    ids, answer = read_column_file(answer_file)
+    if not len(answer):
+        raise BadColumn('answer is empty')
+    order = None
+    if ids is not None:
+        order = np.argsort(ids, kind='mergesort')
+        ids = ids[order]
+        if np.any(ids[1:] == ids[:-1]):
+            raise BadColumn('answer has duplicate IDs')
+    if scorer in BINARY_ANSWER_SCORERS and \
+            not np.all((answer == 0) | (answer == 1)):
+        raise BadColumn('answer must contain only 0 and 1')
+    # sorted once for matching all the outputs
+    return ids, order, answer
+
+
+def score(scorer, answer, output_file):
+    """
+    Scores the output (a binary file) with the scorer, given the answer
+    from read_answer. Returns the output in the scoring script format.
+    Raises BadColumn if the answer turns out not to be suitable.
+    """
+    answer_ids, answer_order, answer = answer
+    try:
+        try:
+            ids, output = read_column_file(output_file)
+        except BadColumn as e:
+            raise Rejected(str(e))
+        if (ids is None) != (answer_ids is None):
+            raise Rejected('expected lines with %s' % (
+                'a single number' if answer_ids is None
+                else 'an ID and a number'))
+        if ids is not None:
+            output = _align(answer_ids, answer_order, ids, output)
+        elif len(output) != len(answer):
+            raise Rejected('expected %s values, got %s' %
+                (len(answer), len(output)))
+        value = SCORERS[scorer](answer, output)
+    except Rejected as e:
+        return 'REJECTED\n%s\n' % e
+    return 'ACCEPTED\n%r\n' % float(value)
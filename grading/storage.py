@@ -0,0 +1,378 @@
+"""
+Handling of grading input files and scoring workspaces, independent of
+the models.
+
+Stored files may be gzip-compressed, which is told by the name ending with
+COMPRESSED_SUFFIX. Their content hash is the hash of the original content,
+so it doesn't depend on how they are stored.
+"""
+import fcntl
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from django.core.files.base import File
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 4 * 2**20
+COPY_BLOCK_SIZE = 2**20
+
+COMPRESSED_SUFFIX = '.gz'
+# Compressed files smaller than this are kept in memory until saved
+COMPRESS_SPOOL_BYTES = 4 * 2**20
+
+
+class ContentHasher(object):
+    """
+    Content hash used for grading files: sha256 of the concatenated sha256
+    digests of consecutive HASH_BLOCK_SIZE blocks.
+
+    Unlike plain sha256, the work is split into independent blocks, so the
+    hash of a big file can be built from digests of its parts computed
+    at different times.
+    """
+
+    def __init__(self):
+        self.digests = []
+        self.block = hashlib.sha256()
+        self.block_size = 0
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            part = view[:HASH_BLOCK_SIZE - self.block_size]
+            self.block.update(part)
+            self.block_size += len(part)
+            view = view[len(part):]
+            if self.block_size == HASH_BLOCK_SIZE:
+                self._end_block()
+
+    def _end_block(self):
+        self.digests.append(self.block.digest())
+        self.block = hashlib.sha256()
+        self.block_size = 0
+
+    def block_digests(self):
+        digests = list(self.digests)
+        if self.block_size:
+            digests.append(self.block.digest())
+        return digests
+
+    def hexdigest(self):
+        return combined_hash(self.block_digests())
+
+
+def combined_hash(digests):
+    """
+    Content hash of a file from the sha256 digests of its blocks.
+    """
+    if not digests:
+        digests = [hashlib.sha256().digest()]
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+def byte_chunks(django_file):
+    for chunk in django_file.chunks():
+        if isinstance(chunk, str):
+            # as with ContentFile('text'), storage writes it encoded
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
+
+def content_hasher(django_file):
+    hasher = ContentHasher()
+    for chunk in byte_chunks(django_file):
+        hasher.update(chunk)
+    return hasher
+
+
+def content_hash(django_file):
+    return content_hasher(django_file).hexdigest()
+
+
+def compress(django_file, level):
+    """
+    Returns a gzip-compressed copy of django_file, as a File to be saved
+    to storage (and closed), and a ContentHasher of the original.
+    """
+    hasher = ContentHasher()
+    compressed = tempfile.SpooledTemporaryFile(max_size=COMPRESS_SPOOL_BYTES)
+    # mtime=0, so that the same content is compressed the same way
+    with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=level,
+                       mtime=0) as gzip_file:
+        for chunk in byte_chunks(django_file):
+            hasher.update(chunk)
+            gzip_file.write(chunk)
+    compressed.seek(0)
+    return File(compressed), hasher
+
+
+def is_compressed(field_file):
+    return field_file.name.endswith(COMPRESSED_SUFFIX)
+
+
+def content_name(field_file):
+    """
+    Name of the stored file without the compression suffix.
+    """
+    name = os.path.basename(field_file.name)
+    if is_compressed(field_file):
+        return name[:-len(COMPRESSED_SUFFIX)]
+    return name
+
+
+class _ContentFile(gzip.GzipFile):
+    # closes the stored file along with itself
+    def __init__(self, stored):
+        super().__init__(fileobj=stored, mode='rb')
+        self.stored = stored
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.stored.close()
+
+
+def open_content(field_file):
+    """
+    Opens the stored file for reading its original content, which is
+    decompressed on the fly.
+    """
+    stored = field_file.storage.open(field_file.name, 'rb')
+    if is_compressed(field_file):
+        return _ContentFile(stored)
+    return stored
+
+
+def content_chunks(field_file):
+    with open_content(field_file) as content:
+        while True:
+            chunk = content.read(COPY_BLOCK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def stored_content_hash(field_file):
+    hasher = ContentHasher()
+    for chunk in content_chunks(field_file):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def write_content(field_file, path):
+    """
+    Writes the original content of the stored file to path.
+    """
+    with open(path, 'wb') as destination:
+        for chunk in content_chunks(field_file):
+            destination.write(chunk)
+
+
+class IncompleteChunk(Exception):
+    pass
+
+
+def append_chunk(path, stored_size, stream, length, compression_level=None):
+    """
+    Appends `length` bytes read from stream to the file at path, which
+    is first cut to stored_size (dropping what a failed append may have
+    left). With compression_level, the chunk is appended as a gzip member,
+    and the file as a whole stays a valid gzip file. Returns a ContentHasher
+    of the chunk and the new size of the file.
+
+    Raises IncompleteChunk if the stream ends early.
+    """
+    hasher = ContentHasher()
+    with open(path, 'r+b') as stored:
+        stored.truncate(stored_size)
+        stored.seek(stored_size)
+        destination = stored
+        if compression_level is not None:
+            destination = gzip.GzipFile(fileobj=stored, mode='wb',
+                compresslevel=compression_level, mtime=0)
+        remaining = length
+        while remaining:
+            chunk = stream.read(min(remaining, COPY_BLOCK_SIZE))
+            if not chunk:
+                raise IncompleteChunk()
+            hasher.update(chunk)
+            destination.write(chunk)
+            remaining -= len(chunk)
+        if destination is not stored:
+            destination.close()
+        stored.flush()
+        os.fsync(stored.fileno())
+        return hasher, stored.tell()
+
+
+def content_size(field_file):
+    """
+    Size of the original content of the stored file. Compressed files
+    have it in the gzip trailer, only modulo 4 GiB, so for them it is
+    an estimate (never less than the compressed size).
+
+    The trailer has just the size of the last gzip member, so this is
+    valid only for files compressed at once (see compress). Uploads have
+    a member per chunk (see append_chunk), their size is kept in
+    Upload.size instead, and in Submission.output_size once submitted.
+    """
+    size = field_file.size
+    if not is_compressed(field_file) or size < 4:
+        return size
+    with field_file.storage.open(field_file.name, 'rb') as stored:
+        stored.seek(-4, os.SEEK_END)
+        original_size, = struct.unpack('<I', stored.read(4))
+    return max(size, original_size)
+
+
+class InputCache(object):
+    """
+    Node-local cache of grading inputs (answers, scoring scripts), keyed by
+    content hash, so that they are read from (possibly slow or shared)
+    media storage once per node, rather than once per attempt.
+
+    Entries are read-only files named by the hash. When the total size
+    exceeds `max_bytes`, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, field_file):
+        """
+        Returns a path to the local copy of the (decompressed) content of
+        field_file, which has content hash `key`. Returns None if
+        the content doesn't match the key.
+        """
+        path = self._entry_path(key)
+        try:
+            self._mark_used(path)
+            return path
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.directory, exist_ok=True)
+        hasher = ContentHasher()
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in content_chunks(field_file):
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+            if hasher.hexdigest() != key:
+                logger.error('Content of %s does not match its hash %s',
+                    field_file.name, key)
+                return None
+            os.chmod(tmp_path, 0o444)
+            # atomic, concurrent workers may be adding the same entry
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.evict(keep=key)
+        return path
+
+    def _mark_used(self, path):
+        # atime marks the last use, mtime stays the time of the content
+        mtime_ns = os.stat(path).st_mtime_ns
+        os.utime(path, ns=(int(time.time() * 10**9), mtime_ns))
+
+    def evict(self, keep=None):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or entry.name == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            total += os.stat(self._entry_path(keep)).st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug('Evicting %s from input cache', path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+WORKSPACE_PREFIX = 'scoring_'
+# A workspace is locked right after it is created. Younger ones are left
+# alone by the sweep, so that it doesn't get between the two.
+WORKSPACE_SWEEP_MIN_AGE_SECONDS = 60
+
+_workspace_locks = {}  # path -> fd of the locked workspace
+
+
+def create_workspace(parent):
+    """
+    Creates a scoring workspace (directory) in parent. It stays locked
+    by this process until remove_workspace, or until the process dies,
+    which is how sweep_workspaces tells the abandoned ones.
+    """
+    os.makedirs(parent, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=parent)
+    fd = os.open(path, os.O_RDONLY)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _workspace_locks[path] = fd
+    return path
+
+
+def remove_workspace(path, keep=False):
+    if not keep:
+        shutil.rmtree(path, ignore_errors=True)
+    fd = _workspace_locks.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def sweep_workspaces(parent):
+    """
+    Removes the workspaces in parent left by dead grading processes.
+    Returns the number of them.
+    """
+    removed = 0
+    try:
+        entries = list(os.scandir(parent))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.name.startswith(WORKSPACE_PREFIX) or \
+                not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            if time.time() - entry.stat().st_ctime < \
+                    WORKSPACE_SWEEP_MIN_AGE_SECONDS:
+                continue
+            fd = os.open(entry.path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            continue
+        else:
+            logger.info('Removing abandoned workspace %s', entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+        finally:
+            os.close(fd)
+    return removed
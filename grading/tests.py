@@ -1,13 +1,44 @@
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+from unittest import mock, skipIf
+from datetime import timedelta
 from pathlib import Path
 
-from django.test import TestCase
+import numpy as np
+
+from django.test import TestCase, TransactionTestCase, \
+    LiveServerTestCase, Client
+from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.management import call_command
+from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.db import connection
+from django.contrib.auth.models import User
+from django.utils import timezone
 
 from .models import *
+from .workers import WorkerPool, launch_forked_attempt
+from .wakeup import WakeupListener, _send_wakeup, wait_for_results
+from .monitoring import GradingMetrics, MetricsExporter, Histogram
+from .benchmark import run_benchmark, QueueNotEmpty
+from .agents import create_agent
+from . import scorers
+from . import validation
+from .storage import InputCache, ContentHasher, content_hash, \
+    HASH_BLOCK_SIZE, create_workspace, remove_workspace, is_compressed, \
+    content_chunks, content_size
+from . import storage
 from .models import _mkdir_scoring, _prepare_scoring_dir, \
-    _run_scoring_popen
+    _run_scoring_popen, _put_input, _open_input, _output_bytes
+import grading_agent
 
 
 script_always_42 = """
@@ -18,10 +49,80 @@ script_crash = """
 0/0
 """
 
+script_modify_answer = """
+import json
+import os
+import sys
+os.chmod(sys.argv[2], 0o644)
+with open(sys.argv[2], 'a') as answer:
+    answer.write('modified')
+print("ACCEPTED\\n42")
+"""
+
+script_compare = """
+import sys
+with open(sys.argv[1]) as output, open(sys.argv[2]) as answer:
+    same = output.read() == answer.read()
+print("ACCEPTED\\n%s" % int(same))
+"""
+
+script_chatty = """
+print("ACCEPTED\\n42")
+for i in range(100000):
+    print("blah blah blah")
+"""
+
+script_persistent_chatty = """
+def load(answer_path):
+    pass
+
+def score(output_path):
+    print("ACCEPTED\\n42")
+    for i in range(100000):
+        print("blah blah blah")
+"""
+
 script_bad_format = """
 print("blah blah blah ")
 """
 
+script_persistent = """
+import json
+import os
+
+def load(answer_path):
+    global answer, loaded_in
+    with open(answer_path) as f:
+        answer = f.read().split()
+    loaded_in = os.getpid()
+
+def score(output_path):
+    with open(output_path) as f:
+        output = f.read().split()
+    answer.append('spoiled')  # must not be seen by the next submission
+    print("ACCEPTED")
+    print(sum(a == b for a, b in zip(answer, output)))
+    print(loaded_in)
+"""
+
+script_persistent_crash = """
+def load(answer_path):
+    pass
+
+def score(output_path):
+    0/0
+"""
+
+script_persistent_slow = """
+import time
+
+def load(answer_path):
+    pass
+
+def score(output_path):
+    time.sleep(10)
+"""
+
 data_2_and_2 = "2\n2\n"
 data_3_and_3 = "3\n3\n"
 data_3x3 = "3\n3\n3\n"
@@ -65,6 +166,48 @@ class SubmissionTest(TestCase):
         self.assertIsNone(none2)
         dummy_grade(attempt)
 
+    def test_choose_batch(self):
+        submissions = []
+        for i in range(3):
+            submission = Submission.create(self.grader,
+                ContentFile(data_2_and_2))
+            request_submission_grading(submission)
+            submission.save()
+            submissions.append(submission)
+        chosen = choose_batch_for_grading(['a', 'b'])
+        self.assertEqual([sub.id for sub, _ in chosen],
+            [sub.id for sub in submissions[:2]])
+        self.assertEqual([attempt.worker for _, attempt in chosen],
+            ['a', 'b'])
+        chosen = choose_batch_for_grading(['a', 'b'])
+        self.assertEqual(len(chosen), 1)
+        sub, attempt = chosen[0]
+        self.assertEqual(sub.id, submissions[2].id)
+        sub.refresh_from_db()
+        self.assertFalse(sub.needs_grading)
+        self.assertEqual(sub.current_attempt, attempt)
+        self.assertEqual(choose_batch_for_grading(['a']), [])
+
+    def test_choose_grader_batch(self):
+        other_grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+        submissions = []
+        for grader in [self.grader, other_grader, self.grader, self.grader]:
+            submission = Submission.create(grader, ContentFile(data_2_and_2))
+            request_submission_grading(submission)
+            submission.save()
+            submissions.append(submission)
+        chosen = choose_grader_batch_for_grading('a', 2)
+        self.assertEqual([sub.id for sub, _ in chosen],
+            [submissions[0].id, submissions[2].id])
+        chosen = choose_grader_batch_for_grading('a', 5)
+        self.assertEqual([sub.id for sub, _ in chosen],
+            [submissions[1].id])
+        chosen = choose_grader_batch_for_grading('a', 5)
+        self.assertEqual([sub.id for sub, _ in chosen],
+            [submissions[3].id])
+        self.assertEqual(choose_grader_batch_for_grading('a', 5), [])
+
     def test_single_grade(self):
         submission = Submission.create(self.grader, ContentFile(data_2_and_2))
         request_submission_grading(submission)
@@ -77,6 +220,81 @@ class SubmissionTest(TestCase):
         self.assertTrue(attempt.succeeded)
         self.assertEqual(attempt.score, 42)
 
+
+class QueueOrderTest(TestCase):
+    def setUp(self):
+        self.grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+
+    def submit(self, key="", priority=PRIORITY_INTERACTIVE):
+        submission = Submission.create(self.grader, ContentFile(data_2_and_2),
+            fair_share_key=key)
+        request_submission_grading(submission, priority=priority)
+        submission.save()
+        return submission
+
+    def choose_all(self):
+        chosen = []
+        while True:
+            submission, _ = choose_for_grading()
+            if submission is None:
+                return chosen
+            chosen.append(submission.id)
+
+    def test_priority(self):
+        bulk = [self.submit(priority=PRIORITY_BULK) for i in range(3)]
+        interactive = self.submit()
+        self.assertEqual(self.choose_all(),
+            [interactive.id] + [sub.id for sub in bulk])
+
+    def test_fair_share(self):
+        a = [self.submit('a') for i in range(3)]
+        b = [self.submit('b') for i in range(2)]
+        self.assertEqual(self.choose_all(),
+            [a[0].id, b[0].id, a[1].id, b[1].id, a[2].id])
+
+    def test_weights(self):
+        FairShare.objects.create(key='a', weight=2)
+        a = [self.submit('a') for i in range(4)]
+        b = [self.submit('b') for i in range(2)]
+        self.assertEqual(self.choose_all(),
+            [a[0].id, b[0].id, a[1].id, a[2].id, b[1].id, a[3].id])
+
+    def test_idle_key_starts_from_clock(self):
+        self.submit('b')
+        for i in range(10):
+            self.submit('a')
+        self.choose_all()
+        # b was idle, which doesn't let it take the queue for itself now
+        a = [self.submit('a') for i in range(3)]
+        b = [self.submit('b') for i in range(3)]
+        self.assertEqual(self.choose_all(),
+            [b[0].id, a[0].id, b[1].id, a[1].id, b[2].id, a[2].id])
+
+    def test_qs_grading(self):
+        interactive = [self.submit('a'), self.submit('b')]
+        self.choose_all()
+        request_qs_grading(Submission.objects.all(), priority=PRIORITY_BULK)
+        late = self.submit('c')
+        self.assertEqual(self.choose_all(),
+            [late.id] + [sub.id for sub in interactive])
+        # requeueing keeps the priority
+        request_qs_grading(Submission.objects.filter(id=late.id))
+        self.assertEqual(Submission.objects.get(id=late.id).grading_priority,
+            PRIORITY_INTERACTIVE)
+
+    def test_rejudge_doesnt_take_interactive_share(self):
+        for i in range(10):
+            self.submit('a')
+        self.choose_all()
+        request_qs_grading(Submission.objects.filter(fair_share_key='a'),
+            priority=PRIORITY_BULK)
+        b = [self.submit('b') for i in range(3)]
+        a = self.submit('a')
+        self.assertEqual(self.choose_all()[:4],
+            [b[0].id, a.id, b[1].id, b[2].id])
+
+
 output_accepted_42 = \
 """\
 ACCEPTED
@@ -183,11 +401,29 @@ class ScoringTest(TestCase):
     def test_prepare_scoring_dir(self):
         scoring_dir = _prepare_scoring_dir(self.attempt)
         self.assertIsNotNone(scoring_dir)
+        for name in ['user_output', 'answer', 'scoring_script.py']:
+            path = os.path.join(scoring_dir, name)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o444)
+        with open(os.path.join(scoring_dir, 'answer')) as answer:
+            self.assertEqual(answer.read(), data_2_and_2)
         # TODO more checks
 
+    def test_prepare_scoring_dir_copy(self):
+        scoring_dir = _prepare_scoring_dir(self.attempt)
+        for name in ['user_output', 'answer', 'scoring_script.py']:
+            path = os.path.join(scoring_dir, name)
+            self.assertEqual(os.stat(path).st_nlink, 1)
+        # what a scoring script could do, the original stays intact
+        answer_path = os.path.join(scoring_dir, 'answer')
+        os.chmod(answer_path, 0o644)
+        with open(answer_path, 'w') as answer:
+            answer.write('corrupted')
+        self.assertEqual(b''.join(content_chunks(self.grader.answer)),
+            data_2_and_2.encode('utf-8'))
+
     def test_run_scoring(self):
         scoring_dir = _prepare_scoring_dir(self.attempt)
-        process = _run_scoring_popen(self.attempt, scoring_dir)
+        process = _run_scoring_popen(scoring_dir)
         process.wait()
 
     def test_attempt_grading(self):
@@ -199,6 +435,27 @@ class ScoringTest(TestCase):
         self.assertEqual(self.attempt.succeeded, True)
         self.assertEqual(self.attempt.aborted, False)
 
+    def test_resource_usage(self):
+        attempt_grading(self.attempt)
+        self.attempt.refresh_from_db()
+        self.assertTrue(self.attempt.wall_time_ms > 0)
+        self.assertTrue(self.attempt.cpu_user_ms +
+            self.attempt.cpu_system_ms > 0)
+        self.assertTrue(self.attempt.max_rss_bytes > 2**20)
+        self.assertIsNotNone(self.attempt.io_read_blocks)
+        self.assertIsNotNone(self.attempt.io_write_blocks)
+
+    def test_grader_admin(self):
+        attempt_grading(self.attempt)
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        response = self.client.get('/admin/grading/datagrader/')
+        self.assertEqual(response.status_code, 200)
+        grader = response.context['cl'].result_list.get()
+        self.assertEqual(grader.attempts, 1)
+        self.assertEqual(grader.max_wall_time_ms,
+            GradingAttempt.objects.get().wall_time_ms)
+
     def test_attempt_aborted(self):
         self.attempt.aborted = True
         self.attempt.save()
@@ -225,6 +482,173 @@ def test_grading(test, script, answer, output):
     return attempt
 
 
+script_allocate_200_mib = """
+memory = bytearray(200 * 2**20)
+print("ACCEPTED\\n42")
+"""
+
+
+script_persistent_allocate = """
+def load(answer_path):
+    global memory
+    memory = bytearray(100 * 2**20)
+
+def score(output_path):
+    with open(output_path) as f:
+        more = bytearray(int(f.read()) * 2**20)
+    print("ACCEPTED\\n42")
+"""
+
+
+script_sleep = """
+import time
+time.sleep(100)
+"""
+
+script_busy = """
+while True:
+    pass
+"""
+
+script_sleep_in_child = """
+import json
+import os
+import sys
+import time
+pid = os.fork()
+if pid == 0:
+    time.sleep(100)
+print(pid, file=sys.stderr)
+time.sleep(100)
+"""
+
+
+def process_running(pid):
+    try:
+        with open('/proc/%s/stat' % pid) as stat:
+            return stat.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+class LimitsTest(TestCase):
+    def test_time_limit(self):
+        grader = create_simple_grader_str(script_sleep, data_2_and_2)
+        grader.time_limit_ms = 300
+        grader.save()
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertTrue("timed out" in attempt.scoring_msg)
+        self.assertEqual(attempt.limit_exceeded, 'time')
+        self.assertTrue(300 <= attempt.wall_time_ms < 5000)
+
+    def test_cpu_time_limit(self):
+        grader = create_simple_grader_str(script_busy, data_2_and_2)
+        grader.time_limit_ms = 20000
+        grader.cpu_time_limit_ms = 500
+        grader.save()
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertTrue("CPU time limit" in attempt.scoring_msg)
+        self.assertEqual(attempt.limit_exceeded, 'cpu_time')
+        self.assertTrue(attempt.wall_time_ms < 20000)
+
+    def test_group_killed(self):
+        grader = create_simple_grader_str(script_sleep_in_child,
+            data_2_and_2)
+        grader.time_limit_ms = 500
+        grader.save()
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.limit_exceeded, 'time')
+        with attempt.log.file as log:
+            child_pid = int(log.read())
+        self.assertFalse(process_running(child_pid))
+
+    def test_persistent_time_limit(self):
+        grader = create_simple_grader_str(script_persistent_slow,
+            data_2_and_2)
+        grader.scoring_script.persistent = True
+        grader.scoring_script.save()
+        grader.time_limit_ms = 300
+        grader.save()
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.limit_exceeded, 'time')
+
+
+class CgroupTest(TestCase):
+    # Real cgroups need a delegated cgroup v2 hierarchy, so this uses
+    # a plain directory, which lets us check what run_scoring.py sets up.
+
+    def setUp(self):
+        self.root = os.path.join(settings.SCORING_TMP, 'cgroup')
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'cgroup.subtree_control'),
+                'w') as control_file:
+            control_file.write('cpu')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read(self, path):
+        with open(path) as control_file:
+            return control_file.read()
+
+    def test_cgroup_limits(self):
+        with self.settings(SCORING_CGROUP_ROOT=self.root,
+                SCORING_CGROUP_PIDS_MAX=10):
+            attempt = test_grading(self, script_allocate_200_mib,
+                data_2_and_2, data_2_and_2)
+        # no RLIMIT_AS, the memory is limited by the cgroup
+        self.assertEqual(attempt.scoring_status, 'accepted')
+        self.assertEqual(self.read(os.path.join(self.root,
+            'cgroup.subtree_control')), '+memory +pids')
+        cgroups = [name for name in os.listdir(self.root)
+                   if name.startswith('scoring_')]
+        self.assertEqual(len(cgroups), 1)
+        cgroup = os.path.join(self.root, cgroups[0])
+        self.assertEqual(self.read(os.path.join(cgroup, 'memory.max')),
+            str(DEFAULT_MEMORY_LIMIT))
+        self.assertEqual(self.read(os.path.join(cgroup, 'cpu.max')),
+            settings.SCORING_CGROUP_CPU_MAX)
+        self.assertEqual(self.read(os.path.join(cgroup, 'pids.max')), '10')
+        self.assertEqual(self.read(os.path.join(cgroup, 'cgroup.procs')),
+            '0')
+
+    def test_persistent_cgroup(self):
+        # not to reuse a warm server started by other tests
+        grader = create_simple_grader_str(script_persistent + "# cgroup\n",
+            data_2_and_2)
+        grader.scoring_script.persistent = True
+        grader.scoring_script.save()
+        with self.settings(SCORING_CGROUP_ROOT=self.root):
+            attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'accepted')
+        # the parent with the shared memory limit, with one for the server
+        # and one for the score call in it
+        cgroups = [name for name in os.listdir(self.root)
+                   if name.startswith('scoring_')]
+        self.assertEqual(len(cgroups), 1)
+        parent = os.path.join(self.root, cgroups[0])
+        self.assertEqual(self.read(os.path.join(parent, 'memory.max')),
+            str(DEFAULT_MEMORY_LIMIT))
+        self.assertFalse(os.path.exists(os.path.join(parent, 'cpu.max')))
+        self.assertEqual(self.read(os.path.join(parent,
+            'cgroup.subtree_control')), '+memory +cpu +pids')
+        cgroups = [name for name in os.listdir(parent)
+                   if name.startswith('scoring_')]
+        self.assertEqual(len(cgroups), 2)
+        for name in cgroups:
+            self.assertEqual(self.read(os.path.join(parent, name,
+                'pids.max')), str(settings.SCORING_CGROUP_PIDS_MAX))
+
+    def test_fallback_to_rlimits(self):
+        with self.settings(SCORING_CGROUP_ROOT=os.path.join(self.root, 'no')):
+            attempt = test_grading(self, script_allocate_200_mib,
+                data_2_and_2, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertTrue("script exited with code" in attempt.scoring_msg)
+
+
 class ScoringFailureTest(TestCase):
 
     def test_crash(self):
@@ -236,6 +660,36 @@ class ScoringFailureTest(TestCase):
         self.assertEqual(attempt.succeeded, False)
         self.assertTrue("script exited with code" in attempt.scoring_msg)
 
+    def test_modified_input(self):
+        attempt = test_grading(self, script_modify_answer, data_2_and_2,
+            data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertIsNone(attempt.score)
+        self.assertEqual(attempt.succeeded, False)
+        self.assertEqual(attempt.scoring_msg,
+            'Scoring script modified its input files.')
+
+    def check_truncated(self, attempt):
+        self.assertEqual(attempt.scoring_status, 'accepted')
+        self.assertEqual(attempt.score, 42)
+        self.assertTrue(attempt.scoring_msg.endswith(
+            "Scoring script output truncated to %s bytes\n" %
+            MAX_SCORING_SCRIPT_OUTPUT_SIZE))
+        self.assertTrue(len(attempt.scoring_msg) < MAX_RUN_SCORING_OUTPUT_SIZE)
+
+    def test_chatty(self):
+        attempt = test_grading(self, script_chatty, data_2_and_2,
+            data_2_and_2)
+        self.check_truncated(attempt)
+
+    def test_chatty_persistent(self):
+        grader = create_simple_grader_str(script_persistent_chatty,
+            data_2_and_2)
+        grader.scoring_script.persistent = True
+        grader.scoring_script.save()
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.check_truncated(attempt)
+
     def test_bad_format(self):
         attempt = test_grading(self, script_bad_format, data_2_and_2,
             data_2_and_2)
@@ -245,3 +699,1430 @@ class ScoringFailureTest(TestCase):
         self.assertEqual(attempt.aborted, False)
         self.assertEqual(attempt.succeeded, True)
         self.assertTrue("blah blah blah" in attempt.scoring_msg)
+
+
+def grade_output(test, grader, output):
+    submission = Submission.create(grader, ContentFile(output))
+    request_submission_grading(submission)
+    submission.save()
+    _, attempt = choose_for_grading()
+    with test.settings(SCORING_WARM_IDLE_SECONDS=1):
+        attempt_grading(attempt)
+    attempt.refresh_from_db()
+    return attempt
+
+
+class PersistentScoringTest(TestCase):
+    def create_grader(self, script):
+        grader = create_simple_grader_str(script, data_2_and_2)
+        grader.scoring_script.persistent = True
+        grader.scoring_script.save()
+        grader.save()
+        return grader
+
+    def test_memory_shared(self):
+        # Without cgroups the forked score call has the address space of
+        # the server, so what it allocates counts along with the loaded
+        # data too.
+        grader = self.create_grader(script_persistent_allocate)
+        grader.memory_limit_bytes = 192 * 2**20
+        grader.save()
+        attempt = grade_output(self, grader, "1\n")
+        self.assertEqual(attempt.scoring_status, 'accepted')
+        attempt = grade_output(self, grader, "100\n")
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertIn("script exited with code", attempt.scoring_msg)
+
+    def test_warm_server_reused(self):
+        grader = self.create_grader(script_persistent)
+        first = grade_output(self, grader, data_2_and_2)
+        second = grade_output(self, grader, "2\n3\n")
+        self.assertEqual(first.scoring_status, 'accepted')
+        self.assertEqual(first.score, 2)
+        self.assertEqual(second.scoring_status, 'accepted')
+        self.assertEqual(second.score, 1)
+        # both scored with the answer loaded by the same server
+        self.assertEqual(first.scoring_msg, second.scoring_msg)
+        self.assertIsNotNone(first.max_rss_bytes)
+
+    def test_crash(self):
+        grader = self.create_grader(script_persistent_crash)
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertTrue("script exited with code" in attempt.scoring_msg)
+        with attempt.log.file as log:
+            self.assertTrue(b'ZeroDivisionError' in log.read())
+
+    def test_timeout(self):
+        grader = self.create_grader(script_persistent_slow)
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertTrue("timed out" in attempt.scoring_msg)
+
+    def test_not_persistent_script(self):
+        grader = self.create_grader(script_always_42)
+        attempt = grade_output(self, grader, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertTrue("failed to load" in attempt.scoring_msg)
+
+
+script_check_first_line = """
+import sys
+with open(sys.argv[1]) as output:
+    if output.readline() == "2\\n":
+        print("ACCEPTED\\n1")
+    else:
+        print("REJECTED\\nwrong")
+"""
+
+script_persistent_check_first_line = """
+def load(answer_path):
+    pass
+
+def score(output_path):
+    with open(output_path) as output:
+        if output.readline() == "2\\n":
+            print("ACCEPTED\\n1")
+        else:
+            print("REJECTED\\nwrong")
+"""
+
+
+class BatchScoringTest(TestCase):
+    def grade_batch(self, script, outputs, persistent=False):
+        grader = create_simple_grader_str(script, data_2_and_2)
+        grader.scoring_script.persistent = persistent
+        grader.scoring_script.save()
+        for output in outputs:
+            submission = Submission.create(grader, ContentFile(output))
+            request_submission_grading(submission)
+            submission.save()
+        attempts = [attempt for _, attempt in
+                    choose_grader_batch_for_grading('a', len(outputs))]
+        with self.settings(SCORING_WARM_IDLE_SECONDS=1):
+            attempt_batch_grading(attempts)
+        for attempt in attempts:
+            attempt.refresh_from_db()
+            attempt.submission.refresh_from_db()
+        return attempts
+
+    def check_results(self, attempts):
+        self.assertEqual([a.scoring_status for a in attempts],
+            ['accepted', 'rejected', 'accepted'])
+        self.assertEqual([a.submission.scoring_status for a in attempts],
+            ['accepted', 'rejected', 'accepted'])
+        self.assertEqual(attempts[0].score, 1)
+        self.assertEqual(attempts[1].scoring_msg, 'wrong\n')
+        for attempt in attempts:
+            self.assertTrue(attempt.finished)
+            self.assertIsNotNone(attempt.wall_time_ms)
+
+    def test_batch(self):
+        attempts = self.grade_batch(script_check_first_line,
+            [data_2_and_2, data_3_and_3, data_2_and_2])
+        self.check_results(attempts)
+
+    def test_persistent_batch(self):
+        attempts = self.grade_batch(script_persistent_check_first_line,
+            [data_2_and_2, data_3_and_3, data_2_and_2], persistent=True)
+        self.check_results(attempts)
+
+    def test_batch_crash(self):
+        attempts = self.grade_batch(script_crash,
+            [data_2_and_2, data_3_and_3])
+        for attempt in attempts:
+            self.assertEqual(attempt.scoring_status, 'error')
+            self.assertTrue("script exited with code" in attempt.scoring_msg)
+
+    def test_batch_modified_input(self):
+        attempts = self.grade_batch(script_modify_answer,
+            [data_2_and_2, data_3_and_3])
+        for attempt in attempts:
+            self.assertEqual(attempt.scoring_msg,
+                'Scoring script modified its input files.')
+
+
+class BuiltinScorerTest(TestCase):
+    def setUp(self):
+        self.path = os.path.join(settings.SCORING_TMP, 'column')
+        os.makedirs(settings.SCORING_TMP, exist_ok=True)
+
+    def read(self, data):
+        with open(self.path, 'w') as column_file:
+            column_file.write(data)
+        ids, values = scorers.read_column(self.path)
+        self.assertIsNone(ids)
+        return list(values)
+
+    def read_with_ids(self, data):
+        with open(self.path, 'w') as column_file:
+            column_file.write(data)
+        ids, values = scorers.read_column(self.path)
+        return list(ids), list(values)
+
+    def test_read_column(self):
+        self.assertEqual(self.read("1\n2.5\n-3e2\n"), [1, 2.5, -300])
+        self.assertEqual(self.read("value\n1\n2  \n\n\n"), [1, 2])
+        self.assertEqual(self.read("1\n2"), [1, 2])
+        self.assertEqual(self.read(""), [])
+
+    def test_read_column_blocks(self):
+        data = ''.join('%s\n' % i for i in range(1000))
+        old_size = scorers.READ_BLOCK_SIZE
+        scorers.READ_BLOCK_SIZE = 7
+        try:
+            self.assertEqual(self.read(data), list(range(1000)))
+        finally:
+            scorers.READ_BLOCK_SIZE = old_size
+
+    def test_read_column_errors(self):
+        with self.assertRaisesRegex(scorers.BadColumn, 'line 3'):
+            self.read("1\n2\nx\n4\n")
+        with self.assertRaisesRegex(scorers.BadColumn, 'line 2'):
+            self.read("1\n\n2\n")
+        with self.assertRaisesRegex(scorers.BadColumn, 'line 2'):
+            self.read("1\n1 2\n")
+        with self.assertRaisesRegex(scorers.BadColumn, 'not finite'):
+            self.read("1\nnan\n")
+        # as many numbers as lines, but misaligned
+        with self.assertRaisesRegex(scorers.BadColumn, 'line 2'):
+            self.read("1\n2 3\n\n4\n")
+        with self.assertRaisesRegex(scorers.BadColumn, 'line 2'):
+            self.read("1\n x")
+
+    def test_read_ids(self):
+        self.assertEqual(self.read_with_ids("id,value\na,1\nbb, 2\r\nc,3"),
+            ([b'a', b'bb', b'c'], [1, 2, 3]))
+        data = ''.join('x%s,%s\n' % (i, i) for i in range(1000))
+        old_size = scorers.READ_BLOCK_SIZE
+        scorers.READ_BLOCK_SIZE = 7
+        try:
+            ids, values = self.read_with_ids(data)
+        finally:
+            scorers.READ_BLOCK_SIZE = old_size
+        self.assertEqual(ids[999], b'x999')
+        self.assertEqual(values, list(range(1000)))
+        for data, line in [("a,1\n2\n", 2), ("a,1,2\n", 1), ("a,1\n,2\n", 2),
+                           ("a,1\nb,x\n", 2), ("a,1\n\nb,2\n", 2)]:
+            with self.assertRaisesRegex(scorers.BadColumn, 'line %s' % line):
+                self.read_with_ids(data)
+
+    def test_metrics(self):
+        answer = np.array([0., 0, 1, 1])
+        self.assertAlmostEqual(scorers.rmse(answer,
+            np.array([0., 0, 1, 3])), 1)
+        self.assertAlmostEqual(scorers.mae(answer,
+            np.array([1., 0, 1, 3])), 0.75)
+        self.assertAlmostEqual(scorers.logloss(answer,
+            np.array([0.5, 0.5, 0.5, 0.5])), np.log(2))
+        self.assertAlmostEqual(scorers.accuracy(answer,
+            np.array([0., 1, 1, 1])), 0.75)
+        self.assertAlmostEqual(scorers.roc_auc(answer,
+            np.array([0.1, 0.4, 0.35, 0.8])), 0.75)
+        # ties count as half
+        self.assertAlmostEqual(scorers.roc_auc(answer,
+            np.array([0.1, 0.5, 0.5, 0.8])), 0.875)
+        self.assertAlmostEqual(scorers.f1(np.array([0., 1, 1, 1]),
+            np.array([0., 1, 0, 1])), 0.8)
+
+    def test_builtin_grading(self):
+        grader = create_simple_grader_str("", "label\n0\n0\n1\n1\n")
+        grader.builtin_scorer = 'accuracy'
+        grader.save()
+        for output, status, score in [("0\n1\n1\n1\n", 'accepted', 0.75),
+                                      ("0\n1\n", 'rejected', None),
+                                      ("0\n1\nyes\n1\n", 'rejected', None)]:
+            attempt = grade_output(self, grader, output)
+            self.assertEqual(attempt.scoring_status, status)
+            self.assertEqual(attempt.score, score)
+            self.assertTrue(attempt.succeeded)
+
+    def test_builtin_grading_ids(self):
+        grader = create_simple_grader_str("", "id,label\na,0\nb,0\nc,1\n")
+        grader.builtin_scorer = 'accuracy'
+        grader.save()
+        for output, message in [("c,1\na,1\nb,0\n", None),
+                                ("0\n1\n1\n", 'an ID and a number'),
+                                ("a,1\nb,0\n", 'expected 3 values'),
+                                ("a,1\nb,0\nd,1\n", "unknown ID 'd'"),
+                                ("a,1\nb,0\na,1\n", "duplicate ID 'a'")]:
+            attempt = grade_output(self, grader, output)
+            if message is None:
+                self.assertEqual(attempt.scoring_status, 'accepted')
+                self.assertAlmostEqual(float(attempt.score), 2 / 3,
+                    places=5)
+            else:
+                self.assertEqual(attempt.scoring_status, 'rejected')
+                self.assertIn(message, attempt.scoring_msg)
+
+    def test_bad_answer(self):
+        grader = create_simple_grader_str("", "0\n2\n")
+        grader.builtin_scorer = 'f1'
+        grader.save()
+        attempt = grade_output(self, grader, "0\n1\n")
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertFalse(attempt.succeeded)
+        self.assertTrue('only 0 and 1' in attempt.scoring_msg)
+
+
+class ValidationTest(TestCase):
+    def validate(self, output, answer=None, columns='str, float', **kwargs):
+        output_format = validation.OutputFormat(columns.split(', '),
+            **kwargs)
+        answer_chunks = None if answer is None else [answer.encode()]
+        if isinstance(output, str):
+            output = output.encode()
+        # split to check lines spanning chunks
+        validation.validate(output_format,
+            [output[i:i + 3] for i in range(0, len(output), 3)],
+            answer_chunks)
+
+    def assertInvalid(self, message, *args, **kwargs):
+        with self.assertRaisesRegex(validation.InvalidOutput, message):
+            self.validate(*args, **kwargs)
+
+    def test_valid(self):
+        self.validate("a,1\nb,2.5\n", "a,0\nb,0\n", id_column=1)
+        self.validate("id;x\r\na;1\r\n", delimiter=';', header=True)
+        self.validate("1 -3e2\n2 4", columns='int, float', delimiter=' ',
+            rows=2)
+        self.validate("", "")
+
+    def test_columns(self):
+        self.assertInvalid('line 2: expected 2 columns, got 1', "a,1\nb\n")
+        self.assertInvalid('line 1: expected 2 columns, got 3', "a,1,2\n")
+        self.assertInvalid('line 2: expected 2 columns', "a,1\n\n")
+
+    def test_types(self):
+        self.assertInvalid("line 2, column 2: expected a number, got 'x'",
+            "a,1\nb,x\n")
+        self.assertInvalid('line 1, column 2: expected a number',
+            "a,nan\n")
+        self.assertInvalid('line 1, column 1: expected an integer',
+            "1.5,1\n", columns='int, float')
+        self.assertInvalid('line 2: not valid UTF-8', b"a,1\n\xff,2\n")
+
+    def test_answer(self):
+        self.assertInvalid('expected 3 rows, got 2', "a,1\nb,1\n",
+            "a,0\nb,0\nc,0\n")
+        self.assertInvalid('line 2: more rows than expected',
+            "a,1\nb,1\n", "a,0\n")
+        self.assertInvalid("line 2: expected ID 'b', got 'c'",
+            "a,1\nc,1\n", "a,0\nb,0\n", id_column=1)
+        self.assertInvalid('expected 1 rows, got 2', "a,1\nb,1\n",
+            "a,0\nb,0\n", rows=1)
+        with self.assertRaisesRegex(validation.BadAnswer, 'line 1'):
+            self.validate("a,1\n", "a\n")
+
+    def test_id_column(self):
+        for id_column in [0, 3]:
+            with self.assertRaisesRegex(validation.BadAnswer,
+                    'ID column %s is not one of the 2 columns' % id_column):
+                self.validate("a,1\n", "a,0\n", id_column=id_column)
+        grader = self.grader()
+        grader.full_clean()
+        grader.format_id_column = 3
+        with self.assertRaisesRegex(ValidationError, 'format_id_column'):
+            grader.full_clean()
+        grader.format_columns = 'str, double'
+        with self.assertRaisesRegex(ValidationError, 'double'):
+            grader.full_clean()
+        grader.format_columns = 'str, int'
+        grader.save()
+        # not a 500 on submit, an error of the grader in grading
+        check_output_format(grader, ContentFile(b"a,1\nb,1\n"))
+        attempt = grade_output(self, grader, "a,1\nb,1\n")
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertFalse(attempt.succeeded)
+        self.assertIn('ID column 3', attempt.scoring_msg)
+
+    def test_parse_columns(self):
+        self.assertEqual(validation.parse_columns('int,float, str'),
+            ['int', 'float', 'str'])
+        with self.assertRaisesRegex(ValueError, "'double'"):
+            validation.parse_columns('int, double')
+
+    def grader(self, answer="a,0\nb,0\n"):
+        grader = create_simple_grader_str(script_always_42, answer)
+        grader.format_columns = 'str, int'
+        grader.format_id_column = 1
+        grader.save()
+        return grader
+
+    def test_grading(self):
+        grader = self.grader()
+        attempt = grade_output(self, grader, "a,1\nb,1\n")
+        self.assertEqual(attempt.scoring_status, 'accepted')
+        self.assertEqual(attempt.score, 42)
+        attempt = grade_output(self, grader, "a,1\nb,x\n")
+        self.assertEqual(attempt.scoring_status, 'rejected')
+        self.assertTrue(attempt.succeeded)
+        self.assertIsNone(attempt.score)
+        self.assertEqual(attempt.scoring_msg,
+            "line 2, column 2: expected an integer, got 'x'")
+        attempt.submission.refresh_from_db()
+        self.assertEqual(attempt.submission.scoring_status, 'rejected')
+        self.assertIsNotNone(attempt.prepare_ms)
+
+    def test_bad_answer(self):
+        attempt = grade_output(self, self.grader("a\n"), "a,1\n")
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertFalse(attempt.succeeded)
+
+    def test_batch_grading(self):
+        grader = self.grader()
+        for output in ["a,1\nb,1\n", "b,1\na,1\n"]:
+            submission = Submission.create(grader, ContentFile(output))
+            request_submission_grading(submission)
+            submission.save()
+        attempts = [attempt for _, attempt in
+                    choose_grader_batch_for_grading('a', 2)]
+        with self.settings(SCORING_WARM_IDLE_SECONDS=1):
+            attempt_batch_grading(attempts)
+        for attempt in attempts:
+            attempt.refresh_from_db()
+        self.assertEqual(sorted(a.scoring_status for a in attempts),
+            ['accepted', 'rejected'])
+
+    def test_check_output_format(self):
+        grader = self.grader()
+        check_output_format(grader, ContentFile(b"a,1\nb,1\n"))
+        with self.assertRaisesRegex(validation.InvalidOutput, 'line 1'):
+            check_output_format(grader, ContentFile(b"b,1\na,1\n"))
+        with self.settings(GRADING_VALIDATE_ON_SUBMIT_MAX_BYTES=4):
+            check_output_format(grader, ContentFile(b"b,1\na,1\n"))
+        upload = Upload.create('output')
+        append_upload(upload.key, 0, io.BytesIO(b"a,1\nb"), 5)
+        with self.assertRaisesRegex(validation.InvalidOutput, 'line 2'):
+            check_output_format(grader, Upload.objects.get(id=upload.id))
+
+    def test_grader_version(self):
+        grader = create_simple_grader_str(script_always_42, "a,0\n")
+        version = grader_version(grader)
+        grader.format_delimiter = ';'
+        self.assertEqual(grader_version(grader), version)
+        grader.format_columns = 'str, int'
+        self.assertNotEqual(grader_version(grader), version)
+
+
+class FinishedProcess(object):
+    returncode = 0
+
+    def poll(self):
+        return self.returncode
+
+
+class HangingProcess(object):
+    returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+    def kill(self):
+        self.returncode = -9
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+
+class StubbornProcess(HangingProcess):
+    def terminate(self):
+        pass  # ignores SIGTERM
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            raise subprocess.TimeoutExpired('stubborn', timeout)
+        return self.returncode
+
+
+class WorkerPoolTest(TestCase):
+    def setUp(self):
+        self.grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+        self.submissions = []
+        for i in range(3):
+            # different, so that they aren't graded from the result cache
+            submission = Submission.create(self.grader,
+                ContentFile(data_2_and_2 + '\n' * i))
+            request_submission_grading(submission)
+            submission.save()
+            self.submissions.append(submission)
+
+    def grade_in_process(self, attempts):
+        if len(attempts) == 1:
+            attempt_grading(attempts[0])
+        else:
+            attempt_batch_grading(attempts)
+        return FinishedProcess()
+
+    def test_fill_and_reap(self):
+        pool = WorkerPool(2, launch=self.grade_in_process)
+        self.assertEqual(pool.fill(), 2)
+        self.assertEqual(pool.free_slots(), [])
+        workers = set(GradingAttempt.objects.values_list('worker', flat=True))
+        self.assertEqual(workers, {pool.worker_name(0), pool.worker_name(1)})
+        self.assertEqual(pool.reap(), 2)
+        self.assertEqual(pool.fill(), 1)
+        self.assertEqual(pool.reap(), 1)
+        self.assertEqual(pool.fill(), 0)
+        for submission in self.submissions:
+            submission.refresh_from_db()
+            self.assertEqual(submission.score, 42)
+            self.assertTrue(submission.current_attempt.started)
+
+    def test_dirty_failure(self):
+        pool = WorkerPool(1, launch=lambda attempts: FinishedProcess())
+        pool.fill()
+        pool.reap()
+        attempt = GradingAttempt.objects.get()
+        self.assertTrue(attempt.finished)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertEqual(attempt.scoring_msg, 'Dirty grading failure.')
+
+    def test_shutdown_requeues(self):
+        pool = WorkerPool(3, launch=lambda attempts: HangingProcess())
+        pool.fill()
+        with self.settings(GRADING_SHUTDOWN_GRACE_SECONDS=0):
+            pool.shutdown()
+        for attempt in GradingAttempt.objects.all():
+            self.assertTrue(attempt.finished)
+            self.assertEqual(attempt.scoring_status, 'error')
+        for submission in self.submissions:
+            submission.refresh_from_db()
+            self.assertTrue(submission.needs_grading)
+            self.assertEqual(submission.scoring_status, 'waiting')
+
+    def test_shutdown_kills(self):
+        processes = []
+
+        def launch(attempts):
+            processes.append(StubbornProcess())
+            return processes[-1]
+
+        pool = WorkerPool(1, launch=launch)
+        pool.fill()
+        with self.settings(GRADING_SHUTDOWN_GRACE_SECONDS=0,
+                GRADING_SHUTDOWN_KILL_SECONDS=0):
+            pool.shutdown()
+        self.assertEqual(processes[0].returncode, -9)
+        self.assertEqual(pool.running, {})
+        attempt = GradingAttempt.objects.get()
+        self.assertTrue(attempt.finished)
+        attempt.submission.refresh_from_db()
+        self.assertTrue(attempt.submission.needs_grading)
+
+    def test_batches(self):
+        pool = WorkerPool(2, launch=self.grade_in_process, batch_size=2)
+        self.assertEqual(pool.fill(), 3)
+        self.assertEqual(len(pool.running[0][0]), 2)
+        self.assertEqual(len(pool.running[1][0]), 1)
+        self.assertEqual(pool.reap(), 2)
+        for submission in self.submissions:
+            submission.refresh_from_db()
+            self.assertEqual(submission.score, 42)
+
+    def test_heartbeat(self):
+        pool = WorkerPool(1, launch=lambda attempts: HangingProcess())
+        pool.fill()
+        running = GradingAttempt.objects.get()
+        self.assertIsNotNone(running.lease_expires_at)
+        # a dead worker's attempt
+        dead = choose_for_grading('elsewhere')[1]
+        past = timezone.now() - timedelta(seconds=1)
+        GradingAttempt.objects.update(lease_expires_at=past)
+        pool.heartbeat()
+        running.refresh_from_db()
+        self.assertFalse(running.finished)
+        self.assertGreater(running.lease_expires_at, timezone.now())
+        dead.refresh_from_db()
+        self.assertTrue(dead.finished)
+        self.assertEqual(dead.scoring_msg, 'Grading lease expired.')
+        dead.submission.refresh_from_db()
+        self.assertTrue(dead.submission.needs_grading)
+        self.assertEqual(pool.fill(), 0)
+        pool.running[0][1].terminate()
+        pool.reap()
+        self.assertEqual(len(pool.free_slots()), 1)
+
+    def test_cached_results(self):
+        pool = WorkerPool(3, launch=self.grade_in_process)
+        pool.fill()
+        pool.reap()
+        first = self.submissions[0]
+        same = Submission.create(self.grader, ContentFile(data_2_and_2))
+        request_submission_grading(same)
+        same.save()
+        request_qs_grading(Submission.objects.filter(id=first.id))
+        launched = []
+
+        def launch(attempts):
+            launched.extend(attempts)
+            return FinishedProcess()
+
+        pool = WorkerPool(1, launch=launch)
+        # the cache hits don't take the slot
+        self.assertEqual(pool.fill(), 2)
+        self.assertEqual(launched, [])
+        self.assertEqual(pool.free_slots(), [0])
+        for submission in [first, same]:
+            submission.refresh_from_db()
+            self.assertEqual(submission.score, 42)
+            attempt = submission.current_attempt
+            self.assertEqual(attempt.cache_hit_of.submission_id, first.id)
+            self.assertTrue(attempt.finished)
+
+
+class MonitoringTest(TestCase):
+    def setUp(self):
+        self.grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+
+    def submit(self, key):
+        submission = Submission.create(self.grader, ContentFile(key),
+            fair_share_key=key)
+        request_submission_grading(submission)
+        submission.save()
+
+    def test_histogram(self):
+        histogram = Histogram([1, 10])
+        for value in [0.5, 5, 50]:
+            histogram.observe(value)
+        self.assertEqual(list(histogram.lines('x', {'a': 'b'})), [
+            'x_bucket{a="b",le="1"} 1',
+            'x_bucket{a="b",le="10"} 2',
+            'x_bucket{a="b",le="+Inf"} 3',
+            'x_sum{a="b"} 55.5',
+            'x_count{a="b"} 3',
+        ])
+
+    def test_phases(self):
+        self.submit('a')
+        _, attempt = choose_for_grading()
+        attempt_grading(attempt)
+        attempt.refresh_from_db()
+        for field in ['prepare_ms', 'run_ms', 'parse_ms', 'finish_ms']:
+            self.assertIsNotNone(getattr(attempt, field), field)
+        self.assertGreater(attempt.run_ms, 0)
+        self.assertIsNotNone(attempt.queued_at)
+
+    def test_pool_metrics(self):
+        for key in ['contest-1/team-1', 'contest-1/team-2',
+                    'contest-2/team-3']:
+            self.submit(key)
+        metrics = GradingMetrics()
+        pool = WorkerPool(1, launch=lambda attempts: (
+            attempt_grading(attempts[0]), FinishedProcess())[1],
+            metrics=metrics)
+        self.assertIn('grading_queue_depth{priority="0",queue="contest-1"} 2',
+            metrics.render())
+        pool.fill()
+        pool.export_metrics()
+        pool.reap()
+        pool.export_metrics()
+        text = metrics.render()
+        self.assertIn('grading_queue_depth{priority="0",queue="contest-1"} 1',
+            text)
+        self.assertIn(
+            'grading_attempts_total{cache_hit="false",status="accepted"} 1',
+            text)
+        self.assertIn('grading_dequeue_latency_seconds_count 1', text)
+        self.assertIn('grading_phase_duration_seconds_count{phase="run"} 1',
+            text)
+        self.assertIn('grading_workers 1', text)
+        self.assertIn('grading_workers_busy 0', text)
+        self.assertGreater(metrics.busy_seconds, 0)
+
+    def test_exporter(self):
+        self.submit('a')
+        path = os.path.join(settings.SCORING_TMP, 'metrics.prom')
+        exporter = MetricsExporter(GradingMetrics(), path=path, port=0)
+        try:
+            exporter.export()
+            with open(path) as metrics_file:
+                text = metrics_file.read()
+            self.assertIn('grading_queue_depth{priority="0",queue="a"} 1',
+                text)
+            response = urllib.request.urlopen('http://127.0.0.1:%s/metrics' %
+                exporter.server.server_port)
+            self.assertEqual(response.read().decode('utf-8'), text)
+        finally:
+            exporter.close()
+
+
+def launch_in_process(attempts):
+    if len(attempts) == 1:
+        attempt_grading(attempts[0])
+    else:
+        attempt_batch_grading(attempts)
+    return FinishedProcess()
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmark(self):
+        results = run_benchmark(submissions=6, graders=2, answer_rows=10,
+            queues=2, teams=3, workers=2, batch_size=2,
+            launch=launch_in_process)
+        self.assertEqual(results['submissions'], 6)
+        self.assertEqual(results['statuses'], {'accepted': 6})
+        self.assertGreater(results['throughput_per_minute'], 0)
+        self.assertIsNotNone(results['latency_seconds']['p90'])
+        self.assertIsNotNone(results['phases_ms']['run']['mean'])
+        self.assertEqual(results['params']['launch'], 'launch_in_process')
+        json.dumps(results)
+        # cleaned up
+        self.assertEqual(Submission.objects.count(), 0)
+        self.assertEqual(DataGrader.objects.count(), 0)
+
+    def test_builtin_scorer(self):
+        results = run_benchmark(submissions=2, answer_rows=10,
+            builtin_scorer='accuracy', launch=launch_in_process)
+        self.assertEqual(results['statuses'], {'accepted': 2})
+
+    def test_queue_not_empty(self):
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        submission = Submission.create(grader, ContentFile(data_2_and_2))
+        request_submission_grading(submission)
+        submission.save()
+        with self.assertRaises(QueueNotEmpty):
+            run_benchmark(launch=launch_in_process)
+
+
+class ResultCacheTest(TestCase):
+    def setUp(self):
+        self.grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+
+    def grade(self, submission):
+        attempt = GradingAttempt.objects.create(submission=submission)
+        submission.current_attempt = attempt
+        submission.save()
+        if grade_from_cache([attempt]):
+            attempt_grading(attempt)
+        attempt.refresh_from_db()
+        return attempt
+
+    def test_cache_key(self):
+        a = Submission.create(self.grader, ContentFile(data_2_and_2))
+        b = Submission.create(self.grader, ContentFile(data_2_and_2))
+        c = Submission.create(self.grader, ContentFile('other'))
+        self.assertEqual(a.output_hash,
+            content_hash(ContentFile(data_2_and_2)))
+        self.assertEqual(result_cache_key(a), result_cache_key(b))
+        self.assertNotEqual(result_cache_key(a), result_cache_key(c))
+        key = result_cache_key(a)
+        self.grader.time_limit_ms += 1
+        self.assertNotEqual(result_cache_key(a), key)
+        self.grader.scoring_script = ScoringScript.create(
+            ContentFile(script_crash))
+        self.grader.time_limit_ms -= 1
+        self.assertNotEqual(result_cache_key(a), key)
+        a.output_hash = ""
+        self.assertEqual(result_cache_key(a), "")
+
+    def test_hit(self):
+        submission = Submission.create(self.grader, ContentFile(data_2_and_2))
+        first = self.grade(submission)
+        self.assertIsNone(first.cache_hit_of)
+        second = self.grade(submission)
+        self.assertEqual(second.cache_hit_of, first)
+        self.assertEqual(second.score, 42)
+        self.assertEqual(second.scoring_status, 'accepted')
+        submission.refresh_from_db()
+        self.assertEqual(submission.score, 42)
+        with self.settings(GRADING_RESULT_CACHE_ENABLED=False):
+            self.assertIsNone(self.grade(submission).cache_hit_of)
+
+    def test_errors_not_cached(self):
+        grader = create_simple_grader_str(script_crash, data_2_and_2)
+        submission = Submission.create(grader, ContentFile(data_2_and_2))
+        self.assertEqual(self.grade(submission).scoring_status, 'error')
+        attempt = self.grade(submission)
+        self.assertIsNone(attempt.cache_hit_of)
+        self.assertEqual(attempt.scoring_status, 'error')
+
+
+class StaleSubmissionsTest(TestCase):
+    def setUp(self):
+        self.grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+
+    def graded(self, grader):
+        submission = Submission.create(grader, ContentFile(data_2_and_2))
+        request_submission_grading(submission)
+        submission.save()
+        submission, attempt = choose_for_grading()
+        attempt_grading(attempt)
+        submission.refresh_from_db()
+        return submission
+
+    def stale(self):
+        return set(stale_submissions(Submission.objects.all()))
+
+    def test_grader_version(self):
+        version = grader_version(self.grader)
+        self.grader.save_answer(ContentFile(data_2_and_2))
+        self.assertEqual(grader_version(self.grader), version)
+        self.grader.save_answer(ContentFile('other'))
+        self.assertNotEqual(grader_version(self.grader), version)
+
+    def test_stale(self):
+        other_grader = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+        submission = self.graded(self.grader)
+        other = self.graded(other_grader)
+        self.assertEqual(submission.current_attempt.grader_version,
+            grader_version(self.grader))
+        self.assertEqual(self.stale(), set())
+        self.grader.scoring_script.save_source(ContentFile(script_crash))
+        self.assertEqual(self.stale(), {submission})
+        other_grader.memory_limit_bytes *= 2
+        other_grader.save()
+        self.assertEqual(self.stale(), {submission, other})
+        # already waiting
+        request_qs_grading(Submission.objects.filter(id=other.id))
+        self.assertEqual(self.stale(), {submission})
+
+    def test_errors_are_stale(self):
+        grader = create_simple_grader_str(script_crash, data_2_and_2)
+        submission = self.graded(grader)
+        self.assertEqual(submission.scoring_status, 'error')
+        self.assertEqual(self.stale(), {submission})
+
+
+class ForkedAttemptTest(TransactionTestCase):
+    def test_fork(self):
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        submission = Submission.create(grader, ContentFile(data_2_and_2))
+        request_submission_grading(submission)
+        submission.save()
+        _, attempt = choose_for_grading()
+        process = launch_forked_attempt([attempt])
+        self.assertEqual(process.wait(), 0)
+        self.assertEqual(process.poll(), 0)
+
+    def test_fork_crash(self):
+        attempt = GradingAttempt(id=12345)
+        process = launch_forked_attempt([attempt])
+        self.assertNotEqual(process.wait(), 0)
+
+    def group_members(self, pgid):
+        members = []
+        for name in os.listdir('/proc'):
+            if not name.isdigit() or int(name) == pgid:
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as stat:
+                    fields = stat.read().split(')')[-1].split()
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            if int(fields[2]) == pgid:
+                members.append(int(name))
+        return members
+
+    def test_terminate_group(self):
+        grader = create_simple_grader_str(script_sleep, data_2_and_2)
+        grader.time_limit_ms = 20000
+        grader.save()
+        submission = Submission.create(grader, ContentFile(data_2_and_2))
+        request_submission_grading(submission)
+        submission.save()
+        _, attempt = choose_for_grading()
+        process = launch_forked_attempt([attempt])
+        deadline = time.monotonic() + 10
+        while not self.group_members(process.pid):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        # run_scoring.py, which must not outlive the attempt
+        members = self.group_members(process.pid)
+        process.terminate()
+        process.wait(5)
+        process.kill()
+        for pid in members:
+            self.assertFalse(process_running(pid))
+
+
+class WakeupTest(TransactionTestCase):
+    def setUp(self):
+        self.listener = WakeupListener()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_no_wakeup(self):
+        self.assertFalse(self.listener.wait(0.01))
+
+    def test_wakeup(self):
+        _send_wakeup()
+        self.assertTrue(self.listener.wait(1))
+        self.assertFalse(self.listener.wait(0.01))
+
+    def test_no_listener(self):
+        self.listener.close()
+        _send_wakeup()
+        self.listener = WakeupListener()
+
+    @skipIf(connection.vendor == 'postgresql', 'uses LISTEN/NOTIFY')
+    def test_two_listeners(self):
+        other = WakeupListener()
+        try:
+            _send_wakeup()
+            self.assertTrue(self.listener.wait(1))
+            self.assertTrue(other.wait(1))
+        finally:
+            other.close()
+        self.assertEqual(os.listdir(os.path.dirname(other.path)),
+            [os.path.basename(self.listener.path)])
+
+    @skipIf(connection.vendor == 'postgresql', 'uses LISTEN/NOTIFY')
+    def test_stale_socket(self):
+        # of a daemon which died
+        stale = WakeupListener()
+        stale.sock.close()
+        _send_wakeup()
+        self.assertFalse(os.path.exists(stale.path))
+        self.assertTrue(self.listener.wait(1))
+
+
+class WaitForResultsTest(TransactionTestCase):
+    def test_timeout(self):
+        checks = []
+        started = time.monotonic()
+        self.assertIsNone(wait_for_results([1], lambda: checks.append(1),
+            0.2))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertGreaterEqual(len(checks), 2)
+
+    def test_no_wait(self):
+        checks = []
+        # just the check, no LISTEN etc.
+        with self.assertNumQueries(1):
+            self.assertIsNone(wait_for_results([1],
+                lambda: checks.append(Submission.objects.count()), 0))
+        self.assertEqual(checks, [0])
+
+    def test_finished(self):
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        submission = Submission.create(grader, ContentFile(data_2_and_2))
+        request_submission_grading(submission)
+        submission.save()
+        _, attempt = choose_for_grading()
+
+        def check():
+            status = Submission.objects.get(id=submission.id).scoring_status
+            return None if status == 'waiting' else status
+
+        def grade():
+            try:
+                attempt_grading(attempt)
+            finally:
+                connection.close()
+        thread = threading.Thread(target=grade)
+        thread.start()
+        self.assertEqual(wait_for_results([submission.id], check, 30),
+            'accepted')
+        thread.join()
+
+
+script_write_big_file = """
+with open('big', 'wb') as big:
+    big.write(bytes(10000))
+print("ACCEPTED\\n42")
+"""
+
+script_write_many_files = """
+import time
+
+def score(output_path=None):
+    for i in range(50):
+        with open('file_%s' % i, 'wb') as f:
+            f.write(bytes(100000))
+    time.sleep(5)
+    print("ACCEPTED\\n42")
+
+def load(answer_path):
+    pass
+
+if __name__ == '__main__':
+    score()
+"""
+
+
+class WorkspaceTest(TestCase):
+    def scoring_dirs(self, parent=None):
+        parent = parent or settings.SCORING_TMP
+        return [name for name in os.listdir(parent)
+                if name.startswith('scoring_')]
+
+    def setUp(self):
+        os.makedirs(settings.SCORING_TMP, exist_ok=True)
+        for name in self.scoring_dirs():
+            shutil.rmtree(os.path.join(settings.SCORING_TMP, name))
+
+    def test_removed_after_grading(self):
+        attempt = test_grading(self, script_always_42, data_2_and_2,
+            data_2_and_2)
+        self.assertEqual(attempt.score, 42)
+        self.assertEqual(self.scoring_dirs(), [])
+        with self.settings(SCORING_KEEP_WORKSPACES=True):
+            test_grading(self, script_always_42, data_2_and_2, data_2_and_2)
+        self.assertEqual(len(self.scoring_dirs()), 1)
+
+    def test_sweep(self):
+        abandoned = os.path.join(settings.SCORING_TMP, 'scoring_abandoned')
+        os.makedirs(abandoned)
+        active = create_workspace(settings.SCORING_TMP)
+        min_age = storage.WORKSPACE_SWEEP_MIN_AGE_SECONDS
+        storage.WORKSPACE_SWEEP_MIN_AGE_SECONDS = -1
+        try:
+            self.assertEqual(sweep_scoring_dirs(), 1)
+        finally:
+            storage.WORKSPACE_SWEEP_MIN_AGE_SECONDS = min_age
+        self.assertFalse(os.path.exists(abandoned))
+        self.assertTrue(os.path.exists(active))
+        # too young
+        os.makedirs(abandoned)
+        self.assertEqual(sweep_scoring_dirs(), 0)
+        remove_workspace(active)
+        self.assertFalse(os.path.exists(active))
+
+    def test_tmpfs(self):
+        tmpfs = os.path.join(settings.SCORING_TMP, 'tmpfs')
+        try:
+            with self.settings(SCORING_TMPFS_DIR=tmpfs,
+                               SCORING_KEEP_WORKSPACES=True):
+                test_grading(self, script_always_42, data_2_and_2,
+                    data_2_and_2)
+                self.assertEqual(len(self.scoring_dirs(tmpfs)), 1)
+                with self.settings(SCORING_TMPFS_MAX_INPUT_BYTES=10):
+                    test_grading(self, script_always_42, data_2_and_2,
+                        data_2_and_2)
+                self.assertEqual(len(self.scoring_dirs(tmpfs)), 1)
+                self.assertEqual(len(self.scoring_dirs()), 1)
+        finally:
+            shutil.rmtree(tmpfs)
+
+    def test_file_size_limit(self):
+        with self.settings(SCORING_MAX_FILE_BYTES=1000):
+            attempt = test_grading(self, script_write_big_file,
+                data_2_and_2, data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertIn('File too large', attempt.log.read().decode())
+        attempt = test_grading(self, script_write_big_file, data_2_and_2,
+            data_2_and_2)
+        self.assertEqual(attempt.scoring_status, 'accepted')
+
+    def test_workspace_quota(self):
+        for persistent in [False, True]:
+            grader = create_simple_grader_str(script_write_many_files,
+                data_2_and_2)
+            grader.scoring_script.persistent = persistent
+            grader.scoring_script.save()
+            grader.time_limit_ms = 20000
+            grader.save()
+            # 50 files, each within SCORING_MAX_FILE_BYTES
+            with self.settings(SCORING_MAX_WORKSPACE_BYTES=10**6):
+                attempt = grade_output(self, grader, data_2_and_2)
+            self.assertEqual(attempt.scoring_status, 'error')
+            self.assertEqual(attempt.limit_exceeded, 'disk')
+            self.assertIn('disk quota', attempt.scoring_msg)
+            self.assertLess(attempt.wall_time_ms, 5000)
+
+
+class CompressedStorageTest(TestCase):
+    def test_compressed(self):
+        data = data_2_and_2 * 1000
+        submission = Submission.create(self.grader(), ContentFile(data))
+        self.assertTrue(is_compressed(submission.output))
+        self.assertLess(submission.output.size, len(data) / 10)
+        self.assertEqual(b''.join(content_chunks(submission.output)),
+            data.encode())
+        self.assertEqual(content_size(submission.output), len(data))
+        self.assertEqual(submission.output_hash,
+            content_hash(ContentFile(data)))
+
+    def test_not_compressed(self):
+        with self.settings(GRADING_COMPRESS_FILES=False):
+            submission = Submission.create(self.grader(),
+                ContentFile(data_2_and_2))
+        self.assertFalse(is_compressed(submission.output))
+        self.assertEqual(submission.output.read(), data_2_and_2.encode())
+        self.assertEqual(content_size(submission.output), len(data_2_and_2))
+
+    def grader(self):
+        return create_simple_grader_str(script_compare, data_2_and_2)
+
+    def grade(self, grader, output):
+        submission = Submission.create(grader, ContentFile(output))
+        request_submission_grading(submission)
+        submission.save()
+        _, attempt = choose_for_grading()
+        attempt_grading(attempt)
+        attempt.refresh_from_db()
+        return attempt
+
+    def test_grading(self):
+        # files stored before compression are graded along with new ones
+        with self.settings(GRADING_COMPRESS_FILES=False):
+            old_grader = self.grader()
+        new_grader = self.grader()
+        for cache in [True, False]:
+            with self.settings(GRADING_INPUT_CACHE_ENABLED=cache):
+                for grader in [old_grader, new_grader]:
+                    self.assertEqual(self.grade(grader, data_2_and_2).score,
+                        1)
+                    self.assertEqual(self.grade(grader, data_3_and_3).score,
+                        0)
+                with self.settings(GRADING_COMPRESS_FILES=False):
+                    attempt = self.grade(new_grader, data_2_and_2)
+                self.assertEqual(attempt.score, 1)
+
+    def test_builtin_scorer(self):
+        grader = create_simple_grader_str("", "0\n0\n1\n1\n")
+        grader.builtin_scorer = 'accuracy'
+        grader.save()
+        with self.settings(GRADING_INPUT_CACHE_ENABLED=False):
+            attempt = self.grade(grader, "0\n1\n1\n1\n")
+        self.assertEqual(attempt.score, 0.75)
+
+
+class UploadTest(TestCase):
+    data = b'0\n1\n' * (HASH_BLOCK_SIZE // 2) + b'1\n'
+
+    def upload(self, data, chunk_bytes=HASH_BLOCK_SIZE):
+        upload = Upload.create('output')
+        for offset in range(0, len(data), chunk_bytes):
+            chunk = data[offset:offset + chunk_bytes]
+            append_upload(upload.key, offset, io.BytesIO(chunk), len(chunk))
+        upload.refresh_from_db()
+        return upload
+
+    def test_upload(self):
+        for compress in [True, False]:
+            with self.settings(GRADING_COMPRESS_FILES=compress):
+                upload = self.upload(self.data)
+            self.assertEqual(is_compressed(upload.file), compress)
+            grader = create_simple_grader_str(script_compare, data_2_and_2)
+            submission = Submission.create_from_upload(grader, upload)
+            submission.refresh_from_db()
+            self.assertEqual(submission.output_hash,
+                content_hash(ContentFile(self.data)))
+            self.assertEqual(submission.output_size, len(self.data))
+            self.assertEqual(b''.join(content_chunks(submission.output)),
+                self.data)
+            self.assertFalse(Upload.objects.exists())
+
+    def test_size_of_chunks(self):
+        # a gzip member per chunk, the trailer has the size of the last one
+        upload = self.upload(self.data)
+        self.assertTrue(is_compressed(upload.file))
+        self.assertLess(content_size(upload.file), len(self.data))
+        grader = create_simple_grader_str(script_compare, data_2_and_2)
+        submission = Submission.create_from_upload(grader, upload)
+        self.assertEqual(_output_bytes(submission), len(self.data))
+
+    def test_empty(self):
+        upload = self.upload(b'')
+        self.assertEqual(upload.content_hash(), content_hash(ContentFile('')))
+
+    def test_bad_chunks(self):
+        upload = Upload.create('output')
+        chunk = self.data[:HASH_BLOCK_SIZE]
+        with self.assertRaises(UploadOffsetMismatch) as cm:
+            append_upload(upload.key, 1, io.BytesIO(chunk), len(chunk))
+        self.assertEqual(cm.exception.offset, 0)
+        # interrupted, leaving a part of the chunk in the file
+        with self.assertRaisesRegex(UploadError, 'shorter'):
+            append_upload(upload.key, 0, io.BytesIO(chunk[:-1]), len(chunk))
+        append_upload(upload.key, 0, io.BytesIO(b'1\n'), 2)
+        # only the last chunk may be shorter than a block
+        with self.assertRaisesRegex(UploadError, 'multiple'):
+            append_upload(upload.key, 2, io.BytesIO(b'1\n'), 2)
+        with self.settings(GRADING_UPLOAD_MAX_BYTES=3):
+            upload = Upload.create('output')
+            with self.assertRaisesRegex(UploadError, 'exceed'):
+                append_upload(upload.key, 0, io.BytesIO(b'1\n1\n'), 4)
+        upload.refresh_from_db()
+        self.assertEqual(upload.size, 0)
+
+    def test_resume(self):
+        upload = self.upload(self.data[:HASH_BLOCK_SIZE])
+        with self.assertRaises(UploadError):
+            append_upload(upload.key, upload.size,
+                io.BytesIO(self.data[HASH_BLOCK_SIZE:-1]),
+                len(self.data) - HASH_BLOCK_SIZE)
+        append_upload(upload.key, upload.size,
+            io.BytesIO(self.data[HASH_BLOCK_SIZE:]),
+            len(self.data) - HASH_BLOCK_SIZE)
+        upload.refresh_from_db()
+        self.assertEqual(upload.content_hash(),
+            content_hash(ContentFile(self.data)))
+        self.assertEqual(b''.join(content_chunks(upload.file)), self.data)
+
+    def test_delete_abandoned(self):
+        old = self.upload(b'1\n')
+        Upload.objects.filter(id=old.id).update(
+            updated_at=timezone.now() - timedelta(days=2))
+        new = self.upload(b'1\n')
+        self.assertEqual(delete_abandoned_uploads(), 1)
+        self.assertEqual(list(Upload.objects.all()), [new])
+        self.assertFalse(os.path.exists(old.file.path))
+
+
+class AgentTest(LiveServerTestCase):
+    def setUp(self):
+        self.agent, self.token = create_agent('box')
+        self.work_dir = tempfile.mkdtemp(dir=settings.SCORING_TMP)
+        self.remote = grading_agent.Agent(self.live_server_url, self.token,
+            self.work_dir, settings.RUNNER_PATH, warm_idle_seconds=1)
+        self.downloads = []
+        download = self.remote.download
+
+        def counted_download(job, content_hash, path):
+            self.downloads.append(content_hash)
+            download(job, content_hash, path)
+
+        self.remote.download = counted_download
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def submit(self, grader, output):
+        submission = Submission.create(grader, ContentFile(output))
+        request_submission_grading(submission)
+        submission.save()
+        return submission
+
+    def grade(self, submission):
+        self.assertTrue(self.remote.grade_one())
+        submission.refresh_from_db()
+        return submission.current_attempt
+
+    def test_grading(self):
+        grader = create_simple_grader_str(script_check_first_line,
+            data_2_and_2)
+        accepted = self.submit(grader, data_2_and_2)
+        rejected = self.submit(grader, data_3_and_3)
+        attempt = self.grade(accepted)
+        self.assertEqual(attempt.scoring_status, 'accepted')
+        self.assertEqual(attempt.score, 1)
+        self.assertEqual(attempt.worker, 'agent:box')
+        self.assertTrue(attempt.finished)
+        self.assertIsNotNone(attempt.wall_time_ms)
+        self.assertIsNotNone(attempt.run_ms)
+        self.assertTrue(attempt.log.name)
+        attempt = self.grade(rejected)
+        self.assertEqual(attempt.scoring_status, 'rejected')
+        self.assertEqual(attempt.scoring_msg, 'wrong\n')
+        rejected.refresh_from_db()
+        self.assertEqual(rejected.scoring_status, 'rejected')
+        self.assertFalse(self.remote.grade_one())
+        # the answer and the script only once
+        self.assertEqual(len(self.downloads), 4)
+
+    def test_persistent(self):
+        grader = create_simple_grader_str(
+            script_persistent_check_first_line, data_2_and_2)
+        grader.scoring_script.persistent = True
+        grader.scoring_script.save()
+        submission = self.submit(grader, data_2_and_2)
+        self.assertEqual(self.grade(submission).scoring_status, 'accepted')
+
+    def test_modified_inputs(self):
+        grader = create_simple_grader_str(script_modify_answer, data_2_and_2)
+        attempt = self.grade(self.submit(grader, data_2_and_2))
+        self.assertEqual(attempt.scoring_status, 'error')
+        self.assertEqual(attempt.scoring_msg,
+            'Scoring script modified its input files.')
+        # it modified only its copy of the cached answer
+        with open(os.path.join(self.remote.cache_dir,
+                grader_answer_hash(grader))) as answer:
+            self.assertEqual(answer.read(), data_2_and_2)
+
+    def test_not_leased(self):
+        grader = create_simple_grader_str("", "0\n1\n")
+        grader.builtin_scorer = 'accuracy'
+        grader.save()
+        builtin = self.submit(grader, "0\n1\n")
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        graded = self.submit(grader, data_2_and_2)
+        self.assertEqual(self.grade(graded).score, 42)
+        # graded from the result cache, without the agent
+        cached = self.submit(grader, data_2_and_2)
+        self.assertFalse(self.remote.grade_one())
+        cached.refresh_from_db()
+        self.assertEqual(cached.score, 42)
+        builtin.refresh_from_db()
+        self.assertTrue(builtin.needs_grading)
+
+    def test_lease_expiry(self):
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        submission = self.submit(grader, data_2_and_2)
+        job = self.remote.lease()
+        result = self.remote.score(job)
+        self.assertEqual(requeue_expired_leases(), 0)
+        GradingAttempt.objects.filter(id=job['attempt']).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(requeue_expired_leases(), 1)
+        submission.refresh_from_db()
+        self.assertTrue(submission.needs_grading)
+        attempt = GradingAttempt.objects.get(id=job['attempt'])
+        self.assertEqual(attempt.scoring_msg, 'Grading lease expired.')
+        with self.assertRaises(grading_agent.LeaseLost):
+            self.remote.report(job, result)
+        self.assertEqual(self.grade(submission).score, 42)
+
+    def test_heartbeat(self):
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        submission = self.submit(grader, data_2_and_2)
+        job = self.remote.lease()
+        self.assertEqual(job['heartbeat_seconds'],
+            settings.GRADING_HEARTBEAT_INTERVAL_SECONDS)
+        past = timezone.now() - timedelta(seconds=1)
+        GradingAttempt.objects.update(lease_expires_at=past)
+        self.remote.heartbeat(job)
+        self.assertEqual(requeue_expired_leases(), 0)
+        submission.refresh_from_db()
+        self.assertGreater(submission.current_attempt.lease_expires_at,
+            timezone.now())
+
+    def test_aborted(self):
+        grader = create_simple_grader_str(script_sleep, data_2_and_2)
+        grader.time_limit_ms = 30000
+        grader.save()
+        self.submit(grader, data_2_and_2)
+        job = self.remote.lease()
+        job['heartbeat_seconds'] = 0.1
+        GradingAttempt.objects.update(aborted=True)
+        heartbeat = grading_agent.Heartbeat(self.remote, job)
+        heartbeat.start()
+        started_at = time.monotonic()
+        with self.assertRaises(grading_agent.LeaseLost):
+            self.remote.score(job, heartbeat)
+        heartbeat.stop()
+        self.assertLess(time.monotonic() - started_at, 10)
+        attempt = GradingAttempt.objects.get()
+        self.assertTrue(attempt.finished)
+        self.assertEqual(attempt.scoring_msg, 'aborted')
+
+    def test_api_errors(self):
+        grader = create_simple_grader_str(script_always_42, data_2_and_2)
+        self.submit(grader, data_2_and_2)
+        client = Client()
+        lease_url = reverse('grading:lease')
+        self.assertEqual(client.post(lease_url).status_code, 401)
+        self.assertEqual(client.post(lease_url,
+            HTTP_AUTHORIZATION='Token wrong').status_code, 401)
+        auth = 'Token %s' % self.token
+        job = client.post(lease_url, HTTP_AUTHORIZATION=auth).json()
+        input_url = reverse('grading:input',
+            args=[job['attempt'], '0' * 64])
+        self.assertEqual(client.get(input_url,
+            HTTP_AUTHORIZATION=auth).status_code, 404)
+        result_url = reverse('grading:result', args=[job['attempt']])
+        self.assertEqual(client.post(result_url, '{}',
+            content_type='application/json',
+            HTTP_AUTHORIZATION=auth).status_code, 400)
+        other, other_token = create_agent('other')
+        self.assertEqual(client.post(result_url, '{}',
+            content_type='application/json',
+            HTTP_AUTHORIZATION='Token %s' % other_token).status_code, 409)
+        other.enabled = False
+        other.save()
+        self.assertEqual(client.post(lease_url,
+            HTTP_AUTHORIZATION='Token %s' % other_token).status_code, 401)
+
+
+class InputCacheTest(TestCase):
+    def setUp(self):
+        self.cache = InputCache(os.path.join(settings.SCORING_TMP,
+            'test_input_cache'), max_bytes=10)
+        self.grader_2 = create_simple_grader_str(script_always_42,
+            data_2_and_2)
+        self.grader_3 = create_simple_grader_str(script_always_42,
+            data_3x3)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.directory, ignore_errors=True)
+
+    def test_hash(self):
+        self.assertEqual(self.grader_2.answer_hash,
+            content_hash(ContentFile(data_2_and_2)))
+        self.assertNotEqual(self.grader_2.answer_hash,
+            self.grader_3.answer_hash)
+
+    def test_get(self):
+        path = self.cache.get(self.grader_2.answer_hash, self.grader_2.answer)
+        with open(path) as cached:
+            self.assertEqual(cached.read(), data_2_and_2)
+        self.assertEqual(
+            self.cache.get(self.grader_2.answer_hash, self.grader_2.answer),
+            path)
+
+    def test_bad_hash(self):
+        self.assertIsNone(
+            self.cache.get(self.grader_3.answer_hash, self.grader_2.answer))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_eviction(self):
+        path_2 = self.cache.get(self.grader_2.answer_hash,
+            self.grader_2.answer)
+        path_3 = self.cache.get(self.grader_3.answer_hash,
+            self.grader_3.answer)
+        # 4 + 6 bytes fit, the next one doesn't
+        self.assertTrue(os.path.exists(path_2))
+        grader = create_simple_grader_str(script_always_42, data_3_and_3)
+        self.cache.get(self.grader_2.answer_hash, self.grader_2.answer)
+        self.cache.get(grader.answer_hash, grader.answer)
+        self.assertTrue(os.path.exists(path_2))
+        self.assertFalse(os.path.exists(path_3))
+
+    def test_evicted_meanwhile(self):
+        grader = self.grader_2
+        key = grader.answer_hash
+        path = self.cache.get(key, grader.answer)
+        destination = os.path.join(self.cache.directory, 'copy')
+        calls = []
+
+        def cached_input_path(field_file, key):
+            calls.append(key)
+            if len(calls) == 1:
+                # evicted by another worker right after get
+                os.unlink(path)
+                return path
+            return self.cache.get(key, field_file)
+
+        for put in [lambda: _put_input(grader.answer, destination, key),
+                    lambda: _open_input(grader.answer, key).close()]:
+            del calls[:]
+            with mock.patch('grading.models._cached_input_path',
+                    cached_input_path):
+                put()
+            self.assertEqual(len(calls), 2)
+        with open(destination) as copy:
+            self.assertEqual(copy.read(), data_2_and_2)
+
+    def test_use_keeps_mtime(self):
+        path = self.cache.get(self.grader_2.answer_hash, self.grader_2.answer)
+        mtime_ns = os.stat(path).st_mtime_ns
+        os.utime(path, ns=(0, mtime_ns))
+        self.cache.get(self.grader_2.answer_hash, self.grader_2.answer)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime_ns)
+        self.assertGreater(os.stat(path).st_atime, 0)
+
+
+class ContentHasherTest(TestCase):
+    def test_blocks(self):
+        data = b'x' * (HASH_BLOCK_SIZE + 10)
+        whole = ContentHasher()
+        whole.update(data)
+        parts = ContentHasher()
+        parts.update(data[:7])
+        parts.update(data[7:HASH_BLOCK_SIZE + 3])
+        parts.update(data[HASH_BLOCK_SIZE + 3:])
+        self.assertEqual(whole.hexdigest(), parts.hexdigest())
+        other = ContentHasher()
+        other.update(data[:-1])
+        self.assertNotEqual(whole.hexdigest(), other.hexdigest())
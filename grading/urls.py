@@ -0,0 +1,15 @@
+from django.conf.urls import url
+
+from . import views
+
+app_name = 'grading'
+urlpatterns = [
+    url(r'^grading/agent/lease/$', views.Lease.as_view(), name='lease'),
+    url(r'^grading/agent/attempt/(?P<attempt_id>[0-9]+)/heartbeat/$',
+        views.Heartbeat.as_view(), name='heartbeat'),
+    url(r'^grading/agent/attempt/(?P<attempt_id>[0-9]+)/'
+        r'input/(?P<content_hash>[0-9a-f]{64})/$',
+        views.Input.as_view(), name='input'),
+    url(r'^grading/agent/attempt/(?P<attempt_id>[0-9]+)/result/$',
+        views.Result.as_view(), name='result'),
+]
@@ -0,0 +1,158 @@
+"""
+Checks of submitted outputs against the format declared by the grader,
+so that malformed outputs are rejected without running the scorer.
+
+Files are read line by line, in constant memory. The answer, which must
+be in the same format, is read along: unless the number of rows is given,
+outputs must have as many as the answer, and values in the ID column must
+be the same as in the answer, in the same order.
+"""
+import math
+
+COLUMN_TYPES = {
+    'int': 'an integer',
+    'float': 'a number',
+    'str': 'text',
+}
+
+DELIMITER_CHOICES = (
+    (',', 'Comma'),
+    (';', 'Semicolon'),
+    ('\t', 'Tab'),
+    (' ', 'Space'),
+)
+
+MAX_LINE_BYTES = 2**20
+
+
+class InvalidOutput(Exception):
+    pass
+
+
+class BadAnswer(Exception):
+    pass
+
+
+def parse_columns(text):
+    """
+    Parses column types given as e.g. "str, float". Raises ValueError
+    for unknown types.
+    """
+    columns = [column.strip() for column in text.split(',')]
+    unknown = [column for column in columns if column not in COLUMN_TYPES]
+    if unknown:
+        raise ValueError('unknown column types: %s (use %s)' % (
+            ', '.join(repr(column) for column in unknown),
+            ', '.join(sorted(COLUMN_TYPES))))
+    return columns
+
+
+def check_id_column(id_column, columns, error=ValueError):
+    """
+    Raises the error unless the ID column (1-based, or None) is one of
+    the columns.
+    """
+    if id_column is not None and not 1 <= id_column <= columns:
+        raise error('ID column %s is not one of the %s columns' %
+            (id_column, columns))
+
+
+class OutputFormat(object):
+    def __init__(self, columns, delimiter=',', header=False, id_column=None,
+                 rows=None):
+        self.columns = columns
+        self.delimiter = delimiter
+        self.header = header
+        self.id_column = id_column  # 1-based
+        self.rows = rows
+
+
+def _lines(chunks, error):
+    number = 0
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            number += 1
+            yield number, line
+        if len(rest) > MAX_LINE_BYTES:
+            raise error('line %s: longer than %s bytes' %
+                (number + 1, MAX_LINE_BYTES))
+    if rest:
+        yield number + 1, rest
+
+
+def _rows(output_format, chunks, error):
+    """
+    Yields (line number, values) of the data rows.
+    """
+    for number, line in _lines(chunks, error):
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise error('line %s: not valid UTF-8' % number)
+        if number == 1 and output_format.header:
+            continue
+        if line.endswith('\r'):
+            line = line[:-1]
+        values = line.split(output_format.delimiter)
+        if len(values) != len(output_format.columns):
+            raise error('line %s: expected %s columns, got %s' %
+                (number, len(output_format.columns), len(values)))
+        yield number, values
+
+
+def _check_value(column_type, value):
+    if column_type == 'int':
+        int(value)
+    elif column_type == 'float':
+        if not math.isfinite(float(value)):
+            raise ValueError()
+
+
+def validate(output_format, output_chunks, answer_chunks=None):
+    """
+    Checks the output, given as an iterable of byte chunks, as is
+    the answer. Raises InvalidOutput if it doesn't match the format
+    and BadAnswer if the answer doesn't (or the format itself is wrong).
+    """
+    check_id_column(output_format.id_column, len(output_format.columns),
+        BadAnswer)
+    answer_rows = None
+    if answer_chunks is not None:
+        answer_rows = _rows(output_format, answer_chunks, BadAnswer)
+    id_index = None
+    if output_format.id_column is not None:
+        id_index = output_format.id_column - 1
+    rows = 0
+    for number, values in _rows(output_format, output_chunks, InvalidOutput):
+        rows += 1
+        for index, (column_type, value) in enumerate(
+                zip(output_format.columns, values)):
+            try:
+                _check_value(column_type, value)
+            except ValueError:
+                raise InvalidOutput('line %s, column %s: expected %s, '
+                    'got %.20r' % (number, index + 1,
+                    COLUMN_TYPES[column_type], value))
+        if answer_rows is None:
+            continue
+        answer_values = next(answer_rows, None)
+        if answer_values is None:
+            if output_format.rows is None:
+                raise InvalidOutput('line %s: more rows than expected' %
+                    number)
+            answer_rows = None
+        elif id_index is not None and \
+                values[id_index] != answer_values[1][id_index]:
+            raise InvalidOutput('line %s: expected ID %.20r, got %.20r' %
+                (number, answer_values[1][id_index], values[id_index]))
+    if output_format.rows is not None:
+        expected = output_format.rows
+    elif answer_rows is not None:
+        expected = rows + sum(1 for _ in answer_rows)
+    else:
+        return
+    if rows != expected:
+        raise InvalidOutput('expected %s rows, got %s' % (expected, rows))
@@ -0,0 +1,66 @@
+import json
+
+from django.http import HttpResponse, JsonResponse, FileResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic.base import View
+
+from .agents import LeaseLost, authenticate_agent, lease_attempt, \
+    attempt_job, heartbeat, attempt_input, complete_attempt
+from .storage import open_content
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AgentView(View):
+    """
+    API of remote grading agents (see grading.agents), which authenticate
+    with an "Authorization: Token <token>" header.
+    """
+    agent = None
+
+    def dispatch(self, request, *args, **kwargs):
+        scheme, _, token = \
+            request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme == 'Token' and token:
+            self.agent = authenticate_agent(token.strip())
+        if self.agent is None:
+            return JsonResponse({'error': 'invalid token'}, status=401)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except LeaseLost:
+            return JsonResponse({'error': 'attempt is not leased by '
+                'the agent'}, status=409)
+
+
+class Lease(AgentView):
+    def post(self, request, *args, **kwargs):
+        attempt = lease_attempt(self.agent)
+        if attempt is None:
+            return HttpResponse(status=204)
+        return JsonResponse(attempt_job(attempt))
+
+
+class Heartbeat(AgentView):
+    def post(self, request, *args, **kwargs):
+        heartbeat(self.agent, kwargs['attempt_id'])
+        return JsonResponse({})
+
+
+class Input(AgentView):
+    def get(self, request, *args, **kwargs):
+        field_file = attempt_input(self.agent, kwargs['attempt_id'],
+            kwargs['content_hash'])
+        if field_file is None:
+            return JsonResponse({'error': 'unknown input'}, status=404)
+        return FileResponse(open_content(field_file),
+            content_type='application/octet-stream')
+
+
+class Result(AgentView):
+    def post(self, request, *args, **kwargs):
+        try:
+            result = json.loads(request.body.decode('utf-8'))
+            complete_attempt(self.agent, kwargs['attempt_id'], result)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({})
@@ -0,0 +1,181 @@
+"""
+Waking up idle grading daemons as soon as something needs grading.
+
+The db stays the source of truth. A wakeup only tells a daemon to look for
+jobs now, rather than after the poll interval, so a lost wakeup costs some
+latency and nothing more.
+
+On PostgreSQL it is LISTEN/NOTIFY. Elsewhere each daemon listens on its
+own unix datagram socket in a directory and wakeups are sent to all of
+them, which works only for daemons on the same host as the web app.
+
+The same way, finished grading wakes up web requests waiting for results
+of submissions (wait_for_results). Without PostgreSQL they poll the db.
+"""
+import logging
+import os
+import select
+import socket
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'evolution_grading'
+RESULTS_CHANNEL = 'evolution_results'
+
+
+def _socket_dir():
+    if settings.GRADING_WAKEUP_DIR:
+        return settings.GRADING_WAKEUP_DIR
+    return os.path.join(settings.SCORING_TMP, 'grading_wakeup')
+
+
+def _send_wakeup():
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('NOTIFY ' + CHANNEL)
+        return
+    directory = _socket_dir()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return  # nobody listening
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                sock.sendto(b'!', path)
+            except ConnectionRefusedError:
+                # left by a daemon which died
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                # The queue is full (or it is gone), the poll will do.
+                pass
+    finally:
+        sock.close()
+
+
+def notify_grading_requested():
+    # Waking up before the commit would only let the daemon find nothing.
+    transaction.on_commit(_send_wakeup)
+
+
+def notify_grading_finished(submission_id):
+    if connection.vendor != 'postgresql':
+        return
+
+    def send():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)',
+                [RESULTS_CHANNEL, str(submission_id)])
+    transaction.on_commit(send)
+
+
+def wait_for_results(submission_ids, check, timeout):
+    """
+    Calls check() until it returns something other than None, again
+    whenever grading of one of the submissions finishes, and returns
+    that. After timeout (in seconds) returns the last value of check().
+    """
+    if timeout <= 0:
+        # no point in listening
+        return check()
+    deadline = time.monotonic() + timeout
+    # LISTEN in a transaction would take effect only at its commit.
+    if connection.vendor != 'postgresql' or connection.in_atomic_block:
+        while True:
+            result = check()
+            remaining = deadline - time.monotonic()
+            if result is not None or remaining <= 0:
+                return result
+            time.sleep(min(remaining, settings.GRADING_RESULTS_POLL_SECONDS))
+    watched = {str(submission_id) for submission_id in submission_ids}
+    with connection.cursor() as cursor:
+        # Listening before the first check, so no result is missed.
+        cursor.execute('LISTEN ' + RESULTS_CHANNEL)
+    pg_connection = connection.connection
+    try:
+        while True:
+            del pg_connection.notifies[:]
+            result = check()
+            if result is not None:
+                return result
+            while not any(notify.payload in watched
+                          for notify in pg_connection.notifies):
+                del pg_connection.notifies[:]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return check()
+                readable, _, _ = select.select([pg_connection], [], [],
+                    remaining)
+                if readable:
+                    pg_connection.poll()
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('UNLISTEN ' + RESULTS_CHANNEL)
+
+
+class WakeupListener(object):
+    def __init__(self):
+        if connection.vendor == 'postgresql':
+            # Own connection, so that LISTEN survives Django closing and
+            # reopening its connections.
+            self.pg_connection = connection.get_new_connection(
+                connection.get_connection_params())
+            self.pg_connection.autocommit = True
+            with self.pg_connection.cursor() as cursor:
+                cursor.execute('LISTEN ' + CHANNEL)
+            self.fileno = self.pg_connection.fileno()
+            logger.info('Listening for wakeups on channel %s', CHANNEL)
+        else:
+            self.pg_connection = None
+            directory = _socket_dir()
+            os.makedirs(directory, exist_ok=True)
+            # own socket, so that daemons don't take each other's wakeups
+            self.path = os.path.join(directory, '%s_%s.sock' % (
+                os.getpid(), uuid.uuid4().hex[:8]))
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.path)
+            self.sock.setblocking(False)
+            self.fileno = self.sock.fileno()
+            logger.info('Listening for wakeups on socket %s', self.path)
+
+    def _drain(self):
+        if self.pg_connection is not None:
+            self.pg_connection.poll()
+            del self.pg_connection.notifies[:]
+            return
+        while True:
+            try:
+                self.sock.recv(16)
+            except BlockingIOError:
+                return
+
+    def wait(self, timeout):
+        """
+        Waits until woken up or timeout (in seconds) passes.
+        Returns True if woken up.
+        """
+        readable, _, _ = select.select([self.fileno], [], [], timeout)
+        if readable:
+            self._drain()
+        return bool(readable)
+
+    def close(self):
+        if self.pg_connection is not None:
+            self.pg_connection.close()
+        else:
+            self.sock.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,326 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from grading.models import GradingAttempt, choose_batch_for_grading, \
+    choose_grader_batch_for_grading, finish_dirty_grading, requeue_grading, \
+    attempt_grading, attempt_batch_grading, grade_from_cache, \
+    sweep_scoring_dirs, renew_leases, requeue_expired_leases
+from grading.wakeup import WakeupListener
+from grading.monitoring import GradingMetrics
+
+logger = logging.getLogger(__name__)
+
+GROUP_EXIT_TIMEOUT_SECONDS = 1
+
+
+def _signal_group(pid, signum):
+    try:
+        os.killpg(pid, signum)
+    except ProcessLookupError:
+        pass  # all gone
+
+
+def _wait_for_group(pid):
+    """
+    Waits a moment until the rest of the process group of the (reaped)
+    leader, e.g. run_scoring.py, is gone after SIGKILL.
+    """
+    deadline = time.monotonic() + GROUP_EXIT_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(pid, 0)
+        except ProcessLookupError:
+            return
+        time.sleep(0.01)
+    logger.warning('Process group %s still running after SIGKILL', pid)
+
+
+class SessionProcess(subprocess.Popen):
+    """
+    Popen of a command in its own session (so that signals sent to
+    the daemon's group don't reach it), which signals its whole process
+    group, so that run_scoring.py etc. stop along with it. kill also waits
+    until all of the group is gone.
+    """
+
+    def __init__(self, args):
+        super().__init__(args, start_new_session=True)
+
+    def send_signal(self, signum):
+        _signal_group(self.pid, signum)
+
+    def kill(self):
+        super().kill()
+        self.wait()
+        _wait_for_group(self.pid)
+
+
+def launch_safe_attempt(attempts):
+    # Shutting down the attempts is the pool's job.
+    return SessionProcess(settings.SAFE_ATTEMPT_GRADING_COMMAND +
+        [str(attempt.id) for attempt in attempts])
+
+
+def _grade_forked(attempt_ids):
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        attempts = [GradingAttempt.objects.get(id=attempt_id)
+                    for attempt_id in attempt_ids]
+        if len(attempts) == 1:
+            attempt_grading(attempts[0])
+        else:
+            attempt_batch_grading(attempts)
+    finally:
+        connections.close_all()
+
+
+class ForkedProcess(object):
+    """
+    Popen-like wrapper of multiprocessing.Process, so that the pool can
+    treat forked and spawned attempts the same way. Like SessionProcess, it
+    signals the whole process group of the child, which is a session
+    leader.
+    """
+
+    def __init__(self, process):
+        self.process = process
+
+    @property
+    def returncode(self):
+        return self.process.exitcode
+
+    def poll(self):
+        return self.process.exitcode
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def send_signal(self, signum):
+        if self.process.exitcode is None:
+            # in case it didn't call setsid yet
+            os.kill(self.pid, signum)
+        _signal_group(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+        self.wait()
+        _wait_for_group(self.pid)
+
+    def wait(self, timeout=None):
+        self.process.join(timeout)
+        if self.process.exitcode is None:
+            raise subprocess.TimeoutExpired(self.process.name, timeout)
+        return self.process.exitcode
+
+
+def launch_forked_attempt(attempts):
+    """
+    Grades the attempts in a child forked from the daemon. The child starts
+    with Django already set up, which saves the startup of
+    ./manage.py grading_attempt_safe and grading_attempt. The pool itself
+    does what grading_attempt_safe would - cleans up after crashed children.
+    """
+    # Children must not share the parent's db connections, they open their
+    # own. The parent reconnects on the next query.
+    connections.close_all()
+    process = multiprocessing.get_context('fork').Process(
+        target=_grade_forked,
+        args=([attempt.id for attempt in attempts],))
+    process.start()
+    return ForkedProcess(process)
+
+
+class WorkerPool(object):
+    """
+    Keeps up to `size` grading attempts running at the same time.
+
+    Every attempt is graded by a separate process started by `launch`
+    (by default ``./manage.py grading_attempt_safe``), so a slow or crashing
+    attempt doesn't affect the others. Each attempt records the worker slot
+    it runs in, so the db still tells exactly what the pool is doing.
+    The pool renews the leases of its attempts, so that they are requeued
+    if the whole host dies.
+
+    With `batch_size` > 1 a slot takes up to that many submissions with
+    the same grader at once and they are scored by a single process.
+
+    Finished attempts are counted in `metrics`, which `exporter`
+    (a monitoring.MetricsExporter) exports periodically.
+    """
+
+    def __init__(self, size, launch=launch_safe_attempt, batch_size=1,
+                 metrics=None, exporter=None):
+        self.size = size
+        self.launch = launch
+        self.batch_size = batch_size
+        self.metrics = metrics or GradingMetrics()
+        self.exporter = exporter
+        self.name = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.running = {}  # slot -> (attempts, process)
+        self.stopping = False
+
+    def worker_name(self, slot):
+        return '%s/%s' % (self.name, slot)
+
+    def free_slots(self):
+        return [slot for slot in range(self.size)
+                if slot not in self.running]
+
+    def _choose(self, slots):
+        if self.batch_size == 1:
+            chosen = choose_batch_for_grading(
+                [self.worker_name(slot) for slot in slots])
+            return [[pair] for pair in chosen]
+        batches = []
+        for slot in slots:
+            batch = choose_grader_batch_for_grading(
+                self.worker_name(slot), self.batch_size)
+            if not batch:
+                break
+            batches.append(batch)
+        return batches
+
+    def fill(self):
+        """
+        Starts grading in free slots. Returns the number of taken attempts,
+        including the ones finished right away with a cached result.
+        """
+        taken = 0
+        while True:
+            slots = self.free_slots()
+            if not slots:
+                return taken
+            batches = self._choose(slots)
+            if not batches:
+                return taken
+            for slot, batch in zip(slots, batches):
+                for submission, attempt in batch:
+                    logger.info('Grading submission %s, attempt %s in slot %s',
+                        submission.id, attempt.id, slot)
+                taken += len(batch)
+                attempts = grade_from_cache(
+                    [attempt for _, attempt in batch])
+                for _, attempt in batch:
+                    if attempt not in attempts:
+                        self.metrics.observe_attempt(attempt)
+                if attempts:
+                    self.running[slot] = (attempts, self.launch(attempts))
+
+    def reap(self):
+        """
+        Frees the slots of finished processes. Returns the number of them.
+        """
+        finished = [slot for slot, (_, process) in self.running.items()
+                    if process.poll() is not None]
+        for slot in finished:
+            attempts, process = self.running.pop(slot)
+            logger.info('Attempts %s finished in slot %s (status_code = %s)',
+                [attempt.id for attempt in attempts], slot,
+                process.returncode)
+            for attempt in attempts:
+                try:
+                    finish_dirty_grading(attempt)
+                    self.metrics.observe_attempt(attempt)
+                except Exception:
+                    logger.exception('Exception in grading attempt cleanup')
+        return len(finished)
+
+    def stop(self):
+        self.stopping = True
+
+    def heartbeat(self):
+        """
+        Renews the leases of the running attempts and requeues the ones
+        whose worker (e.g. on another host) stopped renewing them.
+        """
+        renew_leases([attempt.id for attempts, _ in self.running.values()
+                      for attempt in attempts])
+        requeued = requeue_expired_leases()
+        if requeued:
+            logger.info('Requeued %s attempts with expired leases', requeued)
+
+    def export_metrics(self):
+        self.metrics.observe_pool(self.size, len(self.running))
+        if self.exporter is not None:
+            try:
+                self.exporter.export()
+            except Exception:
+                logger.exception('Exception in exporting metrics')
+
+    def run(self):
+        removed = sweep_scoring_dirs()
+        if removed:
+            logger.info('Removed %s abandoned scoring directories', removed)
+        wakeup = WakeupListener()
+        next_poll = 0
+        next_export = 0
+        next_heartbeat = 0
+        try:
+            while not self.stopping:
+                if time.monotonic() >= next_heartbeat:
+                    self.heartbeat()
+                    next_heartbeat = time.monotonic() + \
+                        settings.GRADING_HEARTBEAT_INTERVAL_SECONDS
+                if self.reap() or time.monotonic() >= next_poll:
+                    self.fill()
+                    next_poll = time.monotonic() + \
+                        settings.GRADING_POLL_FOR_JOB_INTERVAL_SECONDS
+                if time.monotonic() >= next_export:
+                    self.export_metrics()
+                    next_export = time.monotonic() + \
+                        settings.GRADING_METRICS_INTERVAL_SECONDS
+                if self.running:
+                    # We have to notice finished attempts quickly.
+                    timeout = settings.GRADING_WORKER_CHECK_INTERVAL_SECONDS
+                else:
+                    timeout = max(0, next_poll - time.monotonic())
+                if not self.free_slots():
+                    time.sleep(timeout)
+                elif wakeup.wait(timeout):
+                    next_poll = 0
+        finally:
+            wakeup.close()
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Waits a moment for the running attempts, then terminates the rest
+        (and kills the ones which don't stop in time) and puts their
+        submissions back into the queue.
+        """
+        logger.info('Shutting down, %s attempts running', len(self.running))
+        deadline = time.monotonic() + settings.GRADING_SHUTDOWN_GRACE_SECONDS
+        while self.running and time.monotonic() < deadline:
+            if not self.reap():
+                time.sleep(settings.GRADING_WORKER_CHECK_INTERVAL_SECONDS)
+        for attempts, process in self.running.values():
+            logger.info('Terminating attempts %s',
+                [attempt.id for attempt in attempts])
+            process.terminate()
+        deadline = time.monotonic() + settings.GRADING_SHUTDOWN_KILL_SECONDS
+        for attempts, process in self.running.values():
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning('Killing attempts %s',
+                    [attempt.id for attempt in attempts])
+            # Also what is left in its process group, so that nothing
+            # writes results of the attempts once they are requeued.
+            process.kill()
+            for attempt in attempts:
+                requeue_grading(attempt, "Grading interrupted by shutdown.")
+        self.running = {}
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Remote grading agent. Takes grading attempts from the web app over HTTP
+(see grading/agents.py), downloads their inputs by content hash, scores
+them with run_scoring.py and sends the results back. It needs neither
+the db nor the media storage, only the URL of the site and a token from
+./manage.py create_grading_agent.
+
+Answers and scoring scripts are kept in a local cache, so they are
+downloaded once for many submissions. Like run_scoring.py, it doesn't
+depend on Django.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger('grading_agent')
+
+# as in grading/storage.py
+HASH_BLOCK_SIZE = 4 * 2**20
+DOWNLOAD_BLOCK_SIZE = 2**20
+# as in grading/models.py
+MAX_RUN_SCORING_OUTPUT_SIZE = 1000000
+SCORING_INPUTS = ['user_output', 'answer', 'scoring_script.py']
+# the same for many submissions
+CACHED_INPUTS = ['answer', 'scoring_script.py']
+RUN_SCORING_OUTPUT = 'run_scoring_output'
+# how often a lost lease is checked while run_scoring.py runs
+CHECK_INTERVAL_SECONDS = 0.1
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class BadDownload(Exception):
+    pass
+
+
+class ContentHasher(object):
+    """
+    The content hash of grading files, see grading/storage.py.
+    """
+
+    def __init__(self):
+        self.digests = []
+        self.block = hashlib.sha256()
+        self.block_size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            part = view[:HASH_BLOCK_SIZE - self.block_size]
+            self.block.update(part)
+            self.block_size += len(part)
+            view = view[len(part):]
+            if self.block_size == HASH_BLOCK_SIZE:
+                self.digests.append(self.block.digest())
+                self.block = hashlib.sha256()
+                self.block_size = 0
+
+    def hexdigest(self):
+        digests = list(self.digests)
+        if self.block_size or not digests:
+            digests.append(self.block.digest())
+        return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+def input_fingerprints(scoring_dir):
+    fingerprints = []
+    for name in SCORING_INPUTS:
+        try:
+            stat = os.stat(os.path.join(scoring_dir, name))
+        except FileNotFoundError:
+            fingerprints.append(None)
+        else:
+            fingerprints.append((stat.st_size, stat.st_mtime_ns,
+                stat.st_mode))
+    return fingerprints
+
+
+def copy_input(source, destination):
+    """
+    Copies a cached input into a scoring directory, read-only, as a reflink
+    if the filesystem allows it (as grading.models._copy_input does).
+    """
+    try:
+        with open(source, 'rb') as source_file, \
+                open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE,
+                source_file.fileno())
+    except OSError:
+        shutil.copyfile(source, destination)
+    os.chmod(destination, 0o444)
+
+
+def read_run_scoring_output(scoring_dir):
+    output_path = os.path.join(scoring_dir, RUN_SCORING_OUTPUT)
+    with open(output_path, 'rb') as output_file:
+        output = output_file.read(MAX_RUN_SCORING_OUTPUT_SIZE + 1)
+    text = output[:MAX_RUN_SCORING_OUTPUT_SIZE].decode('utf-8',
+        errors='replace')
+    if len(output) > MAX_RUN_SCORING_OUTPUT_SIZE:
+        if not text.endswith('\n'):
+            text += '\n'
+        text += 'run_scoring.py output truncated to %s bytes\n' % \
+            MAX_RUN_SCORING_OUTPUT_SIZE
+    return text
+
+
+def elapsed_ms(since):
+    return int((time.monotonic() - since) * 1000)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renews the lease of the job's attempt every heartbeat_seconds given by
+    the server, until stopped. Sets `lost` if the lease is lost or
+    the attempt aborted, so that grading it can stop.
+    """
+
+    def __init__(self, agent, job):
+        super().__init__(daemon=True)
+        self.agent = agent
+        self.job = job
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.job['heartbeat_seconds']):
+            try:
+                self.agent.heartbeat(self.job)
+            except LeaseLost:
+                self.lost = True
+                return
+            except OSError:
+                # maybe the next one gets through before the lease expires
+                logger.exception('Heartbeat of attempt %s failed',
+                    self.job['attempt'])
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Agent(object):
+    """
+    Grades attempts leased from the server at `url`, in `work_dir`
+    (scoring directories, the input cache and warm server sockets).
+    """
+
+    def __init__(self, url, token, work_dir, runner,
+                 cache_max_bytes=10 * 2**30, cgroup=None, warm_max_jobs=100,
+                 warm_idle_seconds=600):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.work_dir = work_dir
+        self.runner = runner
+        self.cache_dir = os.path.join(work_dir, 'input_cache')
+        self.cache_max_bytes = cache_max_bytes
+        self.cgroup = cgroup
+        self.warm_dir = os.path.join(work_dir, 'warm')
+        self.warm_max_jobs = warm_max_jobs
+        self.warm_idle_seconds = warm_idle_seconds
+        os.makedirs(self.cache_dir, exist_ok=True)
+        os.makedirs(self.warm_dir, exist_ok=True)
+
+    def request(self, method, path, data=None):
+        headers = {'Authorization': 'Token %s' % self.token}
+        if data is not None:
+            data = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.url + path, data=data,
+            headers=headers, method=method)
+        try:
+            return urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                raise LeaseLost()
+            raise
+
+    def lease(self):
+        """
+        Returns the job of a leased attempt, or None if nothing waits.
+        """
+        with self.request('POST', '/grading/agent/lease/') as response:
+            if response.status == 204:
+                return None
+            return json.loads(response.read().decode('utf-8'))
+
+    def heartbeat(self, job):
+        url = '/grading/agent/attempt/%s/heartbeat/' % job['attempt']
+        with self.request('POST', url):
+            pass
+
+    def download(self, job, content_hash, path):
+        url = '/grading/agent/attempt/%s/input/%s/' % (job['attempt'],
+            content_hash)
+        hasher = ContentHasher()
+        with self.request('GET', url) as response, \
+                open(path, 'wb') as input_file:
+            while True:
+                data = response.read(DOWNLOAD_BLOCK_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                input_file.write(data)
+        if hasher.hexdigest() != content_hash:
+            os.unlink(path)
+            raise BadDownload('content of %s does not match its hash' % url)
+        os.chmod(path, 0o444)
+
+    def cached_input(self, job, content_hash):
+        path = os.path.join(self.cache_dir, content_hash)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        fd, partial = tempfile.mkstemp(dir=self.cache_dir, prefix='.partial_')
+        os.close(fd)
+        self.download(job, content_hash, partial)
+        os.rename(partial, path)
+        self.trim_cache(keep=content_hash)
+        return path
+
+    def trim_cache(self, keep):
+        """
+        Removes the least recently used inputs over cache_max_bytes, except
+        the one named `keep`, which is about to be used.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.') or name == keep:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.cache_max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def put_input(self, job, name, scoring_dir):
+        path = os.path.join(scoring_dir, name)
+        content_hash = job['inputs'][name]
+        if name not in CACHED_INPUTS:
+            self.download(job, content_hash, path)
+            return
+        # never a hardlink, the script could corrupt the cached copy
+        copy_input(self.cached_input(job, content_hash), path)
+
+    def prepare(self, job, scoring_dir):
+        for name in SCORING_INPUTS:
+            self.put_input(job, name, scoring_dir)
+        config = dict(job['config'],
+            working_directory=os.path.join(scoring_dir, 'working'),
+            scoring_script=os.path.join(scoring_dir, 'scoring_script.py'),
+            answer=os.path.join(scoring_dir, 'answer'),
+            user_output=os.path.join(scoring_dir, 'user_output'),
+            scoring_log=os.path.join(scoring_dir, 'scoring_log'))
+        if self.cgroup is not None:
+            config['cgroup'] = self.cgroup
+        if job['persistent']:
+            config['persistent'] = True
+            config['warm_socket'] = os.path.join(self.warm_dir,
+                job['warm_server'] + '.sock')
+            config['warm_max_jobs'] = self.warm_max_jobs
+            config['warm_idle_seconds'] = self.warm_idle_seconds
+        with open(os.path.join(scoring_dir, 'config.json'), 'w') as \
+                config_file:
+            json.dump(config, config_file)
+
+    def run_scoring(self, scoring_dir, heartbeat=None):
+        """
+        Runs run_scoring.py, unless the heartbeat loses the lease in
+        the meantime - then it is terminated and LeaseLost raised.
+        Returns its exit code.
+        """
+        output_path = os.path.join(scoring_dir, RUN_SCORING_OUTPUT)
+        with open(output_path, 'wb') as output_file:
+            process = subprocess.Popen([self.runner, scoring_dir],
+                stdout=output_file, stderr=subprocess.STDOUT)
+        while True:
+            try:
+                return process.wait(timeout=CHECK_INTERVAL_SECONDS)
+            except subprocess.TimeoutExpired:
+                if heartbeat is not None and heartbeat.lost:
+                    # the scoring script dies with it (see prctl in
+                    # run_scoring.py)
+                    process.terminate()
+                    process.wait()
+                    raise LeaseLost()
+
+    def score(self, job, heartbeat=None):
+        """
+        Runs run_scoring.py for the job. Returns the result for the server.
+        """
+        phase_start = time.monotonic()
+        scoring_dir = tempfile.mkdtemp(prefix='scoring_', dir=self.work_dir)
+        try:
+            self.prepare(job, scoring_dir)
+            inputs = input_fingerprints(scoring_dir)
+            result = {'prepare_ms': elapsed_ms(phase_start)}
+            phase_start = time.monotonic()
+            exit_code = self.run_scoring(scoring_dir, heartbeat)
+            result['run_ms'] = elapsed_ms(phase_start)
+            result['exit_code'] = exit_code
+            result['output'] = read_run_scoring_output(scoring_dir)
+            try:
+                with open(os.path.join(scoring_dir, 'usage.json')) as \
+                        usage_file:
+                    result['usage'] = json.load(usage_file)
+            except (OSError, ValueError):
+                result['usage'] = None
+            try:
+                with open(os.path.join(scoring_dir, 'scoring_log'), 'rb') as \
+                        log_file:
+                    result['log'] = log_file.read().decode('utf-8',
+                        errors='replace')
+            except OSError:
+                result['log'] = ''
+            result['modified_inputs'] = \
+                input_fingerprints(scoring_dir) != inputs
+            if result['modified_inputs']:
+                logger.error('Attempt %s: scoring script modified its input '
+                    'files in %s', job['attempt'], scoring_dir)
+            return result
+        finally:
+            shutil.rmtree(scoring_dir, ignore_errors=True)
+
+    def report(self, job, result):
+        url = '/grading/agent/attempt/%s/result/' % job['attempt']
+        with self.request('POST', url, result):
+            pass
+
+    def grade_one(self):
+        """
+        Grades one attempt, if any waits. Returns whether it did.
+        """
+        job = self.lease()
+        if job is None:
+            return False
+        logger.info('Grading attempt %s', job['attempt'])
+        heartbeat = Heartbeat(self, job)
+        heartbeat.start()
+        try:
+            self.report(job, self.score(job, heartbeat))
+        except LeaseLost:
+            logger.warning('Lease of attempt %s lost', job['attempt'])
+        finally:
+            heartbeat.stop()
+        return True
+
+    def run(self, poll_seconds):
+        while True:
+            try:
+                if self.grade_one():
+                    continue
+            except (OSError, BadDownload, ValueError):
+                # the server is unreachable or failed, the lease of
+                # the attempt (if any) expires and it gets requeued
+                logger.exception('Grading failed')
+            time.sleep(poll_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url', help='URL of the site')
+    parser.add_argument('--token-file', required=True,
+        help='File with the token of the agent.')
+    parser.add_argument('--work-dir', default='/tmp/grading_agent',
+        help='Directory for scoring and the input cache. Keep the path '
+             'short, sockets of warm servers are created in it.')
+    parser.add_argument('--runner', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'run_scoring.py'))
+    parser.add_argument('--cache-max-bytes', type=int, default=10 * 2**30)
+    parser.add_argument('--poll-seconds', type=float, default=1)
+    parser.add_argument('--cgroup-root',
+        help='A delegated cgroup v2 directory, see SCORING_CGROUP_ROOT.')
+    parser.add_argument('--cgroup-cpu-max', default='100000 100000')
+    parser.add_argument('--cgroup-pids-max', type=int, default=64)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.token_file) as token_file:
+        token = token_file.read().strip()
+    cgroup = None
+    if args.cgroup_root:
+        cgroup = {
+            'root': args.cgroup_root,
+            'cpu_max': args.cgroup_cpu_max,
+            'pids_max': args.cgroup_pids_max,
+        }
+    agent = Agent(args.url, token, args.work_dir, args.runner,
+        cache_max_bytes=args.cache_max_bytes, cgroup=cgroup)
+    try:
+        agent.run(args.poll_seconds)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,13 @@ import subprocess
 import json
 import resource
 import signal
+import socket
+import time
+import traceback
+import importlib.util
+import copy
+import errno
+import uuid
 
 prctl_enabled = False
 if os.getenv('prctl_disabled', None) != "1":
@@ -15,6 +22,9 @@ if os.getenv('prctl_disabled', None) != "1":
     prctl.set_pdeathsig(signal.SIGKILL)
 
 
+RUNNER_PATH = os.path.abspath(__file__)
+
+
 def print_err(*objs):
     print(*objs, file=sys.stderr)
 
@@ -34,12 +44,25 @@ class RunParams(object):
     answer = None
     scoring_log = None
     time_limit_ms = 0
+    cpu_time_limit_ms = 0
     memory_limit_bytes = 0
+    max_file_bytes = None
+    max_workspace_bytes = None
+    persistent = False
+    warm_socket = None
+    warm_max_jobs = 0
+    warm_idle_seconds = 0
+    script_output = None
+    max_output_bytes = 0
+    cgroup = None
+    batch = None
 
 
 class Result(object):
     succeeded = None
     output = None
+    usage = None
+    limit_exceeded = None
 
 
 def read_params():
@@ -50,48 +73,718 @@ def read_params():
         # cwd == scoring_directory
         params.working_directory = os.path.abspath(config['working_directory'])
         params.scoring_script = os.path.abspath(config['scoring_script'])
-        params.user_output = os.path.abspath(config['user_output'])
         params.answer = os.path.abspath(config['answer'])
-        params.scoring_log = os.path.abspath(config['scoring_log'])
+        if 'batch' in config:
+            params.batch = config['batch']
+        else:
+            params.user_output = os.path.abspath(config['user_output'])
+            params.scoring_log = os.path.abspath(config['scoring_log'])
+            params.script_output = os.path.abspath('script_output')
         params.time_limit_ms = config['time_limit_ms']
+        params.cpu_time_limit_ms = config['cpu_time_limit_ms']
         params.memory_limit_bytes = config['memory_limit_bytes']
+        params.max_file_bytes = config.get('max_file_bytes')
+        params.max_workspace_bytes = config.get('max_workspace_bytes')
+        params.max_output_bytes = config['max_output_bytes']
+        params.cgroup = config.get('cgroup')
+        params.persistent = config.get('persistent', False)
+        if params.persistent:
+            params.warm_socket = os.path.abspath(config['warm_socket'])
+            params.warm_max_jobs = config['warm_max_jobs']
+            params.warm_idle_seconds = config['warm_idle_seconds']
         return params
 
 
+def read_output(params):
+    """
+    Reads the scoring script's output, up to params.max_output_bytes.
+    """
+    with open(params.script_output, 'rb') as output_file:
+        output = output_file.read(params.max_output_bytes + 1)
+    text = output[:params.max_output_bytes].decode('utf-8', errors='replace')
+    if len(output) > params.max_output_bytes:
+        if not text.endswith('\n'):
+            text += '\n'
+        text += "Scoring script output truncated to %s bytes\n" % \
+            params.max_output_bytes
+    return text
+
+
+def exit_code_from_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def usage_from_rusage(rusage, wall_time_seconds):
+    return {
+        'wall_time_ms': int(wall_time_seconds * 1000),
+        'cpu_user_ms': int(rusage.ru_utime * 1000),
+        'cpu_system_ms': int(rusage.ru_stime * 1000),
+        'max_rss_bytes': rusage.ru_maxrss * 1024,  # in KiB on Linux
+        'io_read_blocks': rusage.ru_inblock,
+        'io_write_blocks': rusage.ru_oublock,
+    }
+
+
+WORKSPACE_CHECK_INTERVAL_SECONDS = 0.5
+
+
+def disk_usage(directory):
+    total = 0
+    for path, _, names in os.walk(directory):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(path, name)).st_blocks * 512
+            except OSError:
+                pass  # removed meanwhile
+    return total
+
+
+class WorkspaceQuota(object):
+    """
+    Limit of the disk space the scoring script takes up in the directory
+    (the scoring directory) by writing files there. RLIMIT_FSIZE limits
+    just each of them.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.exceeded = False
+        # inputs etc.
+        self.base = disk_usage(directory)
+        self.next_check = time.monotonic() + WORKSPACE_CHECK_INTERVAL_SECONDS
+
+    def check(self):
+        """
+        Returns True once the quota is exceeded. It is checked every
+        WORKSPACE_CHECK_INTERVAL_SECONDS.
+        """
+        if time.monotonic() >= self.next_check:
+            self.next_check = time.monotonic() + \
+                WORKSPACE_CHECK_INTERVAL_SECONDS
+            self.exceeded = disk_usage(self.directory) - self.base > \
+                self.max_bytes
+        return self.exceeded
+
+
+def workspace_quota(directory, max_bytes):
+    return WorkspaceQuota(directory, max_bytes) if max_bytes else None
+
+
+def wait_with_timeout(pid, timeout_seconds, started_at, quota=None):
+    """
+    Waits for the child (a process group leader), killing its group after
+    the timeout, or once the quota (a WorkspaceQuota) is exceeded.
+    Leftovers in the group are killed anyway at the end. Returns
+    (exit code, timed out, usage), where usage is the child's resource
+    usage (see usage_from_rusage), counting from started_at
+    (time.monotonic()) for the wall time.
+    """
+    deadline = started_at + timeout_seconds
+    delay = 0.001
+    while True:
+        waited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if waited_pid == pid:
+            usage = usage_from_rusage(rusage, time.monotonic() - started_at)
+            kill_group(pid)
+            return exit_code_from_status(status), False, usage
+        if quota is not None and quota.check():
+            kill_group(pid)
+            _, status, rusage = os.wait4(pid, 0)
+            usage = usage_from_rusage(rusage, time.monotonic() - started_at)
+            return exit_code_from_status(status), False, usage
+        if time.monotonic() >= deadline:
+            kill_group(pid)
+            _, _, rusage = os.wait4(pid, 0)
+            usage = usage_from_rusage(rusage, time.monotonic() - started_at)
+            return None, True, usage
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass  # all gone
+
+
+# cgroup v2 isolation
+#
+# If the config has 'cgroup' settings, each scoring script runs in its own
+# cgroup, created in the 'root' cgroup, which has to be delegated to us
+# (writable, and with no processes in it). Then the memory limit is
+# memory.max, which counts the memory really used, unlike RLIMIT_AS, which
+# counts the address space (and so is hit by numpy etc. early). The CPU
+# bandwidth (cpu.max) and the number of processes (pids.max) are limited
+# too. If the cgroup can't be created, we fall back to rlimits.
+#
+# A warm server creates a parent cgroup with just memory.max, and its own
+# cgroup and those of the score calls in it, so the loaded data and what
+# the calls allocate share the memory limit.
+
+CGROUP_CONTROLLERS = ['memory', 'cpu', 'pids']
+CGROUP_PREFIX = 'scoring_'
+CGROUP_REMOVE_TIMEOUT_SECONDS = 1
+
+
+def _enable_cgroup_controllers(root):
+    with open(os.path.join(root, 'cgroup.subtree_control')) as control_file:
+        enabled = control_file.read().split()
+    missing = [controller for controller in CGROUP_CONTROLLERS
+               if controller not in enabled]
+    if missing:
+        with open(os.path.join(root, 'cgroup.subtree_control'), 'w') as \
+                control_file:
+            control_file.write(' '.join('+' + c for c in missing))
+
+
+class Cgroup(object):
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def _mkdir(cls, root):
+        try:
+            _enable_cgroup_controllers(root)
+            cgroup = cls(os.path.join(root,
+                CGROUP_PREFIX + uuid.uuid4().hex[:16]))
+            os.mkdir(cgroup.path)
+        except OSError:
+            return None
+        return cgroup
+
+    @classmethod
+    def create(cls, settings, memory_limit_bytes, parent=None):
+        """
+        Creates a cgroup with the limits, in the root cgroup or in
+        the parent one. Returns None if it's impossible.
+        """
+        cgroup = cls._mkdir(settings['root'] if parent is None
+            else parent.path)
+        if cgroup is None:
+            return None
+        try:
+            cgroup.write('memory.max', memory_limit_bytes)
+            cgroup.write('cpu.max', settings['cpu_max'])
+            cgroup.write('pids.max', settings['pids_max'])
+        except OSError:
+            cgroup.remove()
+            return None
+        cgroup.disable_swap()
+        return cgroup
+
+    @classmethod
+    def create_parent(cls, settings, memory_limit_bytes):
+        """
+        Creates a cgroup for cgroups created in it, which share its memory
+        limit. Returns None if it's impossible.
+        """
+        cgroup = cls._mkdir(settings['root'])
+        if cgroup is None:
+            return None
+        try:
+            cgroup.write('memory.max', memory_limit_bytes)
+            cgroup.write('cgroup.subtree_control',
+                ' '.join('+' + c for c in CGROUP_CONTROLLERS))
+        except OSError:
+            cgroup.remove()
+            return None
+        cgroup.disable_swap()
+        return cgroup
+
+    def write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as control_file:
+            control_file.write(str(value))
+
+    def disable_swap(self):
+        try:
+            self.write('memory.swap.max', 0)
+        except OSError:
+            pass  # no swap accounting
+
+    def join(self):
+        # 0 means the writing process
+        self.write('cgroup.procs', 0)
+
+    def oom_killed(self):
+        try:
+            with open(os.path.join(self.path, 'memory.events')) as events:
+                for line in events:
+                    key, _, value = line.partition(' ')
+                    if key == 'oom_kill':
+                        return int(value) > 0
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def kill(self):
+        try:
+            self.write('cgroup.kill', 1)
+            return
+        except OSError:
+            pass  # before Linux 5.14
+        try:
+            with open(os.path.join(self.path, 'cgroup.procs')) as procs:
+                pids = [int(pid) for pid in procs.read().split()]
+        except (OSError, ValueError):
+            return
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def remove(self):
+        """
+        Kills whatever is left in the cgroup (e.g. children of the scoring
+        script) and removes it.
+        """
+        self.kill()
+        deadline = time.monotonic() + CGROUP_REMOVE_TIMEOUT_SECONDS
+        while True:
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as e:
+                # busy until the killed processes are gone
+                if e.errno != errno.EBUSY or time.monotonic() > deadline:
+                    return
+                time.sleep(0.01)
+
+
+def _remove_empty_cgroups(root):
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(CGROUP_PREFIX):
+            path = os.path.join(root, name)
+            # a warm server's parent cgroup has its cgroup in it
+            _remove_empty_cgroups(path)
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+
+def remove_stale_cgroups(settings):
+    """
+    Removes empty cgroups left by us, e.g. by warm servers, which can't
+    remove their own cgroups, or by runners killed while scoring.
+    """
+    _remove_empty_cgroups(settings['root'])
+
+
+def limit_memory(cgroup, memory_limit_bytes):
+    if cgroup is not None:
+        cgroup.join()
+    else:
+        # TODO investigate what happens when this limit is really low
+        # Note: this limit is broken on Mac, check it on Linux
+        resource.setrlimit(
+            resource.RLIMIT_AS,
+            (memory_limit_bytes, memory_limit_bytes))
+
+
+def limit_child(cgroup, memory_limit_bytes, cpu_time_limit_ms,
+                max_file_bytes):
+    """
+    Applies the limits in the (just forked) scoring process.
+    """
+    # Own process group, so that we can kill it with all its children.
+    os.setpgid(0, 0)
+    limit_memory(cgroup, memory_limit_bytes)
+    # SIGXCPU at the soft limit, SIGKILL at the hard one
+    cpu_seconds = -(-cpu_time_limit_ms // 1000)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    if max_file_bytes is not None:
+        # Writes beyond it fail with EFBIG (SIGXFSZ is ignored, as python
+        # does). It limits the size of each file, which keeps a runaway
+        # script from filling the disk.
+        resource.setrlimit(resource.RLIMIT_FSIZE,
+            (max_file_bytes, max_file_bytes))
+
+
+def cpu_time_exceeded(params, exit_code, usage):
+    return exit_code in (-signal.SIGXCPU, -signal.SIGKILL) and \
+        usage is not None and \
+        usage['cpu_user_ms'] + usage['cpu_system_ms'] >= \
+        params.cpu_time_limit_ms
+
+
+def set_outcome(result, params, exit_code, timed_out, out_of_memory,
+                out_of_disk=False):
+    """
+    Sets result's status and output (but for the script's output itself)
+    from how the scoring script ended.
+    """
+    result.succeeded = False
+    if timed_out:
+        result.limit_exceeded = 'time'
+        result.output = "Scoring script timed out\n"
+    elif out_of_memory:
+        result.limit_exceeded = 'memory'
+        result.output = "Scoring script exceeded the memory limit\n"
+    elif out_of_disk:
+        result.limit_exceeded = 'disk'
+        result.output = "Scoring script exceeded the disk quota\n"
+    elif cpu_time_exceeded(params, exit_code, result.usage):
+        result.limit_exceeded = 'cpu_time'
+        result.output = "Scoring script exceeded the CPU time limit\n"
+    elif exit_code == 0:
+        result.succeeded = True
+    else:
+        result.output = "Scoring script exited with code %s" % \
+            exit_code + "\n"
+
+
 def run(params):
     result = Result()
     args = ['python3', params.scoring_script, params.user_output,
             params.answer]
+    cgroup = None
+    if params.cgroup:
+        cgroup = Cgroup.create(params.cgroup, params.memory_limit_bytes)
     try:
-        with open(params.scoring_log, 'w') as log_file:
+        with open(params.scoring_log, 'w') as log_file, \
+                open(params.script_output, 'wb') as output_file:
             def preexec():
-                # TODO investigate what happens when this limit is really low
-                # Note: this limit is broken on Mac, check it on Linux
-                resource.setrlimit(
-                    resource.RLIMIT_AS,
-                    (params.memory_limit_bytes, params.memory_limit_bytes))
+                limit_child(cgroup, params.memory_limit_bytes,
+                    params.cpu_time_limit_ms, params.max_file_bytes)
                 if prctl_enabled:
                     prctl.set_pdeathsig(signal.SIGKILL)
 
-            completed = subprocess.run(args, timeout=params.time_limit_ms,
-                preexec_fn=preexec, stdout=subprocess.PIPE, stderr=log_file)
-
-            if (completed.returncode == 0):
-                result.succeeded = True
-                result.output = completed.stdout.decode('utf-8',
-                    errors='replace')
-            else:
-                result.succeeded = False
-                result.output = "Scoring script exited with code %s" % \
-                    completed.returncode + "\n"
-    except subprocess.TimeoutExpired:
+            quota = workspace_quota('.', params.max_workspace_bytes)
+            started_at = time.monotonic()
+            process = subprocess.Popen(args, preexec_fn=preexec,
+                stdout=output_file, stderr=log_file)
+            # We wait ourselves, to get the rusage of the script.
+            returncode, timed_out, result.usage = wait_with_timeout(
+                process.pid, params.time_limit_ms / 1000, started_at, quota)
+            process.returncode = returncode
+        out_of_memory = cgroup is not None and cgroup.oom_killed()
+    finally:
+        if cgroup is not None:
+            cgroup.remove()
+    set_outcome(result, params, returncode, timed_out, out_of_memory,
+        quota is not None and quota.exceeded)
+    if result.succeeded:
+        result.output = read_output(params)
+    return result
+
+
+# Persistent ("warm") scoring scripts
+#
+# A persistent scoring script defines load(answer_path) and
+# score(output_path). A warm server imports it and calls load once. Then
+# for each request it forks a handler, which forks again to call score
+# with the limits applied. This way the loaded state is reused, but
+# a score call can neither break it nor affect other calls.
+#
+# The grading system gives a socket path for each script, answer and limits
+# combination. run_scoring.py connects to the server listening there,
+# starting one if there is none. Servers quit after warm_max_jobs requests
+# or warm_idle_seconds without any, so they are recycled regularly.
+
+WARM_CONNECT_TIMEOUT_SECONDS = 5
+WARM_RESPONSE_MARGIN_SECONDS = 5
+
+
+class WarmServerGone(Exception):
+    pass
+
+
+def load_scoring_module(script_path):
+    sys.path.insert(0, os.path.dirname(script_path))
+    spec = importlib.util.spec_from_file_location('scoring_script',
+        script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _score_in_child(module, request, cgroup, limits):
+    exit_code = 1
+    try:
+        limit_child(cgroup, limits['memory_limit_bytes'],
+            request['cpu_time_limit_ms'], limits['max_file_bytes'])
+        # When the shared memory limit is hit, the OOM killer should pick
+        # this call rather than the server with the loaded data.
+        try:
+            with open('/proc/self/oom_score_adj', 'w') as adj_file:
+                adj_file.write('1000')
+        except OSError:
+            pass  # not Linux
+        if request.get('workspace'):
+            # files it writes are removed with the scoring directory
+            os.chdir(request['workspace'])
+        output_fd = os.open(request['output'],
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(output_fd, 1)
+        log_fd = os.open(request['scoring_log'],
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.dup2(log_fd, 2)
+        module.score(request['user_output'])
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exit_code = e.code or 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def _read_line(connection):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def handle_warm_request(connection, module, limits):
+    request = json.loads(_read_line(connection).decode('utf-8'))
+    cgroup = None
+    if limits['cgroup']:
+        # In the server's parent cgroup, so that what score allocates and
+        # the loaded data are within the memory limit together.
+        cgroup = Cgroup.create(limits['cgroup'],
+            limits['memory_limit_bytes'], parent=limits['cgroup_parent'])
+    try:
+        quota = None
+        if request.get('workspace'):
+            quota = workspace_quota(request['workspace'],
+                request.get('max_workspace_bytes'))
+        started_at = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            _score_in_child(module, request, cgroup, limits)
+        exit_code, timed_out, usage = wait_with_timeout(pid,
+            request['time_limit_ms'] / 1000, started_at, quota)
+        out_of_memory = cgroup is not None and cgroup.oom_killed()
+    finally:
+        if cgroup is not None:
+            cgroup.remove()
+    response = {'exit_code': exit_code, 'timed_out': timed_out,
+                'out_of_memory': out_of_memory,
+                'out_of_disk': quota is not None and quota.exceeded,
+                'usage': usage}
+    connection.sendall(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def _fork_handler(listener, connection, module, limits):
+    if os.fork() == 0:
+        exit_code = 1
+        try:
+            listener.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            handle_warm_request(connection, module, limits)
+            exit_code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(exit_code)
+    connection.close()
+
+
+def warm_server(socket_path, script, answer, memory_limit_bytes,
+                time_limit_ms, max_jobs, idle_seconds, cgroup,
+                max_file_bytes=None):
+    if prctl_enabled:
+        # it should outlive the run_scoring.py which started it
+        prctl.set_pdeathsig(0)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(socket_path)
+    except OSError:
+        # Someone else started a server there in the meantime.
+        return
+    try:
+        listener.listen(64)
+        server_cgroup = None
+        parent_cgroup = None
+        if cgroup:
+            parent_cgroup = Cgroup.create_parent(cgroup, memory_limit_bytes)
+        if parent_cgroup is not None:
+            server_cgroup = Cgroup.create(cgroup, memory_limit_bytes,
+                parent=parent_cgroup)
+            if server_cgroup is None:
+                parent_cgroup.remove()
+        limit_memory(server_cgroup, memory_limit_bytes)
+        limits = {
+            'cgroup': cgroup if server_cgroup is not None else None,
+            'cgroup_parent': parent_cgroup,
+            'memory_limit_bytes': memory_limit_bytes,
+            'max_file_bytes': max_file_bytes,
+        }
+        # The default SIGALRM action kills us if loading takes too long.
+        signal.setitimer(signal.ITIMER_REAL, time_limit_ms / 1000)
+        module = load_scoring_module(script)
+        module.load(answer)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        # The scoring directory we were started from is removed once its
+        # attempt is done.
+        os.chdir(os.path.dirname(socket_path))
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # no zombie handlers
+        listener.settimeout(idle_seconds)
+        jobs = 0
+        while jobs < max_jobs:
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                break
+            _fork_handler(listener, connection, module, limits)
+            jobs += 1
+    finally:
+        os.unlink(socket_path)
+    # Serve the ones who connected before we unlinked the socket.
+    listener.setblocking(False)
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except BlockingIOError:
+            break
+        connection.setblocking(True)
+        _fork_handler(listener, connection, module, limits)
+
+
+def start_warm_server(params):
+    server_params = {
+        'socket_path': params.warm_socket,
+        'script': params.scoring_script,
+        'answer': params.answer,
+        'memory_limit_bytes': params.memory_limit_bytes,
+        'time_limit_ms': params.time_limit_ms,
+        'max_jobs': params.warm_max_jobs,
+        'idle_seconds': params.warm_idle_seconds,
+        'cgroup': params.cgroup,
+        'max_file_bytes': params.max_file_bytes,
+    }
+    if params.cgroup:
+        remove_stale_cgroups(params.cgroup)
+    os.makedirs(os.path.dirname(params.warm_socket), exist_ok=True)
+    with open(params.scoring_log, 'a') as log_file:
+        subprocess.Popen(['python3', RUNNER_PATH, '--warm-server',
+            json.dumps(server_params)], start_new_session=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=log_file)
+
+
+def connect_warm_server(params):
+    started = False
+    deadline = time.monotonic() + WARM_CONNECT_TIMEOUT_SECONDS
+    while True:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(params.warm_socket)
+            return connection
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            connection.close()
+            if not started:
+                if isinstance(e, ConnectionRefusedError):
+                    # left by a dead server
+                    try:
+                        os.unlink(params.warm_socket)
+                    except FileNotFoundError:
+                        pass
+                start_warm_server(params)
+                started = True
+            elif time.monotonic() > deadline:
+                raise WarmServerGone()
+            time.sleep(0.01)
+
+
+def warm_request(params, request):
+    connection = connect_warm_server(params)
+    with connection:
+        # Loading and scoring are limited by the server. This is just
+        # in case the server itself gets stuck.
+        connection.settimeout(2 * params.time_limit_ms / 1000 +
+            WARM_RESPONSE_MARGIN_SECONDS)
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        try:
+            response = _read_line(connection)
+        except ConnectionResetError:
+            raise WarmServerGone()
+        except socket.timeout:
+            return {'exit_code': None, 'timed_out': True, 'usage': None}
+    if not response:
+        # The server quit without handling us (or failed to load).
+        raise WarmServerGone()
+    return json.loads(response.decode('utf-8'))
+
+
+def run_persistent(params):
+    result = Result()
+    request = {
+        'user_output': params.user_output,
+        'output': params.script_output,
+        'scoring_log': params.scoring_log,
+        'time_limit_ms': params.time_limit_ms,
+        'cpu_time_limit_ms': params.cpu_time_limit_ms,
+        'workspace': os.getcwd(),
+        'max_workspace_bytes': params.max_workspace_bytes,
+    }
+    open(params.scoring_log, 'w').close()
+    response = None
+    # The server we connect to may be just quitting, so try twice.
+    for _ in range(2):
+        try:
+            response = warm_request(params, request)
+            break
+        except WarmServerGone:
+            pass
+    if response is None:
         result.succeeded = False
-        result.output = "Scoring script timed out\n"
+        result.output = "Persistent scoring script failed to load\n"
+        return result
+    result.usage = response['usage']
+    set_outcome(result, params, response['exit_code'], response['timed_out'],
+        response.get('out_of_memory'), response.get('out_of_disk'))
+    if result.succeeded:
+        result.output = read_output(params)
     return result
 
 
+def run_batch(params):
+    """
+    Scores each of params.batch (with own user_output and scoring_log) and
+    writes the result to its own result file, as a json with exit_code
+    (as of the whole run_scoring.py), output and usage.
+    """
+    for index, entry in enumerate(params.batch):
+        entry_params = copy.copy(params)
+        entry_params.user_output = os.path.abspath(entry['user_output'])
+        entry_params.scoring_log = os.path.abspath(entry['scoring_log'])
+        entry_params.script_output = os.path.abspath(
+            'script_output_%s' % index)
+        if params.persistent:
+            result = run_persistent(entry_params)
+        else:
+            result = run(entry_params)
+        with open(entry['result'], 'w') as result_file:
+            json.dump({
+                'exit_code': 0 if result.succeeded else 1,
+                'output': result.output,
+                'usage': result.usage,
+                'limit_exceeded': result.limit_exceeded,
+            }, result_file)
+
+
 def main():
     try:
+        if len(sys.argv) == 3 and sys.argv[1] == '--warm-server':
+            warm_server(**json.loads(sys.argv[2]))
+            return
         if (len(sys.argv) != 2):
             raise ParamError(usage())
         scoring_directory = sys.argv[1]
@@ -101,7 +794,17 @@ def main():
                 % scoring_directory)
         os.chdir(scoring_directory)
         params = read_params()
-        result = run(params)
+        if params.batch is not None:
+            run_batch(params)
+            sys.exit(0)
+        if params.persistent:
+            result = run_persistent(params)
+        else:
+            result = run(params)
+        if result.usage is not None:
+            with open('usage.json', 'w') as usage_file:
+                json.dump(dict(result.usage,
+                    limit_exceeded=result.limit_exceeded), usage_file)
         print(result.output, end="")
         if result.succeeded:
             sys.exit(0)
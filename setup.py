@@ -32,5 +32,6 @@ setup(
         'django-webtest>=1.7.8',
         'django-allauth>=0.25.2',
         'coverage>=4.0',
+        'numpy>=1.10',
     ]
 )
@@ -4,11 +4,13 @@ from django.contrib import admin
 from . import views
 
 import contests.urls
+import grading.urls
 
 urlpatterns = [
     url(r'^$', views.NewsList.as_view(), name="news"),
     url(r'^user-settings/$', views.user_settings, name='user_settings'),
     url(r'^', include(contests.urls)),
+    url(r'^', include(grading.urls)),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^media/(?P<path>[a-zA-Z0-9_.-]+)$',
         views.AdminDownload.as_view(), name='media_path'),